@@ -0,0 +1,10 @@
+# coding: utf-8
+from django.apps import AppConfig
+
+
+class AnalyticsConfig(AppConfig):
+    name = 'analytics'
+
+    def ready(self):
+        from analytics import signals
+        signals.connect()
@@ -0,0 +1,135 @@
+# coding: utf-8
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from bson.son import SON
+from pymongo.errors import ExecutionTimeout
+
+from analytics.connections import analytics_db, get_member_client, redis
+from analytics.scheduling import RUNNING_TASK_TTL, refresh_task
+
+db = analytics_db
+
+# Time a chart computation may spend in Mongo, in milliseconds
+CHART_TIME_BUDGET_MS = getattr(settings, 'ANALYTICS_CHART_TIME_BUDGET_MS', 30 * 1000)
+# Time an export may spend in Mongo, exports are computed by the web workers
+EXPORT_TIME_BUDGET_MS = getattr(settings, 'ANALYTICS_EXPORT_TIME_BUDGET_MS', 60 * 1000)
+ABANDONED_TTL = 60 * 60
+# How often a computation refreshes the running slot of its task
+HEARTBEAT_INTERVAL = RUNNING_TASK_TTL / 4
+
+_state = threading.local()
+
+
+class ChartAbandoned(Exception):
+    pass
+
+
+def get_query_comment(result_key):
+    return 'analytics:{}'.format(result_key)
+
+
+def get_abandoned_key(result_key):
+    return 'analytics:abandoned:{}'.format(result_key)
+
+
+@contextmanager
+def query_budget(time_budget_ms, result_key=None):
+    """
+        All the queries made through 'aggregate' and 'find' within the block share the time budget
+        and get tagged with the result key, so that they can be found and killed if the client leaves.
+    """
+    _state.deadline = time.time() + time_budget_ms / 1000.0
+    _state.result_key = result_key
+    _state.heartbeat = 0
+    try:
+        yield
+    finally:
+        _state.deadline = None
+        _state.result_key = None
+
+
+def heartbeat(result_key):
+    # the task is alive as long as it keeps querying
+    if time.time() - _state.heartbeat >= HEARTBEAT_INTERVAL:
+        _state.heartbeat = time.time()
+        refresh_task(result_key)
+
+
+def get_query_options():
+    """
+        Returns the aggregate options (maxTimeMS, comment) applying the current budget.
+    """
+    deadline = getattr(_state, 'deadline', None)
+    if deadline is None:
+        return {}
+
+    result_key = _state.result_key
+    if result_key:
+        if redis.exists(get_abandoned_key(result_key)):
+            raise ChartAbandoned(result_key)
+        heartbeat(result_key)
+
+    remaining = int((deadline - time.time()) * 1000)
+    if remaining <= 0:
+        raise ExecutionTimeout('Chart time budget exceeded', code=50)
+
+    options = {'maxTimeMS': remaining}
+    if result_key:
+        options['comment'] = get_query_comment(result_key)
+    return options
+
+
+def aggregate(collection, pipeline, **kwargs):
+    kwargs.update(get_query_options())
+    return collection.aggregate(pipeline, **kwargs)
+
+
+def find(collection, *args, **kwargs):
+    cursor = collection.find(*args, **kwargs)
+    options = get_query_options()
+    if 'maxTimeMS' in options:
+        cursor = cursor.max_time_ms(options['maxTimeMS'])
+    if 'comment' in options:
+        cursor = cursor.comment(options['comment'])
+    return cursor
+
+
+def count_documents(collection, filter, **kwargs):
+    kwargs.update(get_query_options())
+    return collection.count_documents(filter, **kwargs)
+
+
+def queryset(queryset):
+    """
+        Applies the current budget to a MongoEngine queryset.
+    """
+    options = get_query_options()
+    if 'maxTimeMS' in options:
+        queryset = queryset.max_time_ms(options['maxTimeMS'])
+    if 'comment' in options:
+        queryset = queryset.comment(options['comment'])
+    return queryset
+
+
+def kill_queries(result_key):
+    """
+        Kills the queries tagged with the result key on every member analytics read from: currentOp and killOp
+        only see the member they run on, which the read preference wouldn't necessarily pick.
+    """
+    for address in db.analytics.client.nodes:
+        admin = get_member_client(address).admin
+        in_progress = admin.command(SON([('currentOp', 1), ('command.comment', get_query_comment(result_key))]))
+        for operation in in_progress.get('inprog', []):
+            admin.command('killOp', op=operation['opid'])
+
+
+def abandon_result(result_key):
+    """
+        Stops the chart computation behind the result key: kills its running queries and makes the next ones fail.
+    """
+    redis.setex(get_abandoned_key(result_key), ABANDONED_TTL, 1)
+    kill_queries(result_key)
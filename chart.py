@@ -5,27 +5,58 @@ import json
 import copy
 import itertools
 import hashlib
+import logging
+import threading
+import time
+
+try:
+    from gevent import monkey
+    from gevent.pool import Pool
+except ImportError:
+    Pool = None
 
-from mongoengine import Q
 from leadhit_common.functions import get_minimal_url
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.translation import ugettext, ugettext_lazy as _
 
 from bson import ObjectId
 from bson.dbref import DBRef
+from pymongo.errors import ExecutionTimeout, OperationFailure
 from accounts.models import YMLOffer, YMLFile
 
 from automailer.models import Autocast
-from leads.models import Lead, TraffSource, LeadEvent, LeadOrder, Multilead, CartItem
-from analytics.utils.helpers import Period, validate_time_period, get_sum_orders_by_week
+from leads.models import Lead, TraffSource, LeadOrder, Multilead
+from analytics.utils.helpers import Period, validate_time_period
 from analytics.forms import WidgetStatForm, StatForm
+from analytics import budget
+from analytics.connections import analytics_db, delete_if_equals, redis
+from analytics.identity import resolve_customers
+from analytics.prefetch import get_reference_id
+from analytics.rawquery import raw_documents, raw_values_list
 from analytics.utils.helpers import humanize_form_errors
 from accounts.models import WidgetsConf
-from emails.models import Message, Email, UnsubscribedEmail
+from emails.models import UnsubscribedEmail
 from widgets.helpers import get_recommendations_widgets
 
-db = settings.DB
+db = analytics_db
+logger = logging.getLogger(__name__)
+
 widgets_with_conversion = ('New_Smart_final', 'wish_list')
+# Part of the period computed when a chart falls back to partial data
+PARTIAL_PERIOD = datetime.timedelta(days=7)
+# Error code of an operation killed by killOp
+QUERY_INTERRUPTED = 11601
+# Charts computed at once by a gevent worker process
+CHART_CONCURRENCY = getattr(settings, 'ANALYTICS_CHART_CONCURRENCY', 20)
+# Longest a KPI cube build may hold its lock, in seconds
+KPI_CUBE_LOCK_TIMEOUT = getattr(settings, 'KPI_CUBE_LOCK_TIMEOUT', 10 * 60)
+# How long a caller waits for the cube being built by another one before building it itself
+KPI_CUBE_LOCK_WAIT = 30
+KPI_CUBE_LOCK_POLL = 0.5
+# Rows of the weeks that are over hardly change any more, they are kept much longer than the current week's
+KPI_CUBE_CACHE_TIMEOUT = getattr(settings, 'KPI_CUBE_CACHE_TIMEOUT', 60 * 60)
+KPI_PAST_WEEKS_CACHE_TIMEOUT = getattr(settings, 'KPI_PAST_WEEKS_CACHE_TIMEOUT', 7 * 24 * 60 * 60)
 
 
 class Chart(object):
@@ -166,6 +197,26 @@ class Chart(object):
     def validate_input(self, data):
         raise NotImplementedError("validate_input is not implemented yet")
 
+    def get_export_fields(self):
+        return ['date'] + sorted(self.events.keys())
+
+    def export_rows(self, options):
+        """
+            Yields the rows of the chart series for export. Charts that can read their series
+            straight from a database cursor override it to avoid building the whole chart first.
+        """
+        for row in self.get_data(options)['chart_settings']['dataProvider']:
+            yield row
+
+    # charts that need to read their own writes query the primary
+    read_primary = False
+
+    def get_degraded_options(self, options):
+        """
+            Options of a cheaper computation to fall back to when the time budget is exceeded, or None.
+        """
+        return get_partial_period_options(options)
+
     def get_relevant_events(self, options):
         raise NotImplementedError("Should be implemented to generate graphs and axes")
 
@@ -186,6 +237,10 @@ class WidgetsChart(Chart):
 
     disabled_graphs = ('conversion', 'close', 'popup_view_10s', 'popup_view_3s')
 
+    def export_rows(self, options):
+        for row in self.get_data(options)['graph']:
+            yield row
+
     def validate_input(self, options):
         widget_id = options['widget_id']
         aggregate_period = options['aggregate_period']
@@ -588,15 +643,15 @@ class LeadsChart(Chart):
         start = options['start']
         end = options['end']
         if options['source'] == 'all':
-            dates = Lead.objects(time_added__gte=start,
-                                 time_added__lte=end,
-                                 site=self.request.site).order_by('time_added').values_list('time_added')
+            dates = raw_values_list(Lead.objects(time_added__gte=start,
+                                                 time_added__lte=end,
+                                                 site=self.request.site).order_by('time_added'), 'time_added')
         else:
             source = TraffSource.objects.get(name=options['source'])
-            dates = Lead.objects(time_added__gte=start,
-                                 time_added__lte=end,
-                                 source__in=source.domains,
-                                 site=self.request.site).values_list('time_added')
+            dates = raw_values_list(Lead.objects(time_added__gte=start,
+                                                 time_added__lte=end,
+                                                 source__in=source.domains,
+                                                 site=self.request.site), 'time_added')
         if self.period.step == 'day':
             dates = [time_added.date().strftime('%Y-%m-%d') for time_added in dates]
             temp_dict = {}
@@ -651,6 +706,18 @@ class FunnelChart(object):
             "descriptionField": "description"
         }
 
+    def get_export_fields(self):
+        return ['title', 'value', 'real_value', 'description']
+
+    def export_rows(self, options):
+        for row in self.get_data(options)['chart_settings']['dataProvider']:
+            yield row
+
+    read_primary = False
+
+    def get_degraded_options(self, options):
+        return get_partial_period_options(options)
+
 
 class EmailCampaignsChart(FunnelChart):
 
@@ -707,13 +774,13 @@ class EmailCampaignsChart(FunnelChart):
             start = options['start']
             end = options['end']
 
-            autocasts = Autocast.objects(id__in=ids)
-            messages = [acast.message for acast in autocasts]
+            # raw documents: reading the cases of Document objects would fetch their messages one autocast at a time
+            autocasts = raw_documents(Autocast.objects(id__in=ids), 'message', 'cases')
             messages = []
             for autocast in autocasts:
-                messages.append(DBRef('messages', autocast.message.id))
-                if autocast.cases:
-                    messages.extend([DBRef('messages', case.message.id) for case in autocast.cases[1:]])
+                messages.append(DBRef('messages', get_reference_id(autocast, 'message')))
+                if autocast.get('cases'):
+                    messages.extend([DBRef('messages', get_reference_id(case, 'message')) for case in autocast['cases'][1:]])
 
             match_stage = {
                 "$match": {
@@ -724,15 +791,30 @@ class EmailCampaignsChart(FunnelChart):
                     }
                 }
             }
-            emails = list(db.emails.aggregate([match_stage]))
-            total_sent = len(emails)
-            total_opened = len([email for email in emails if email['opened']])
-            total_clicked = len([email for email in emails if email['clicked']])
+            group_stage = {
+                '$group': {
+                    '_id': None,
+                    'sent': {'$sum': 1},
+                    'opened': {'$sum': {'$cond': ['$opened', 1, 0]}},
+                    'clicked': {'$sum': {'$cond': ['$clicked', 1, 0]}}
+                }
+            }
+            totals = next(budget.aggregate(db.emails, [match_stage, group_stage]), {})
+            total_sent = totals.get('sent', 0)
+            total_opened = totals.get('opened', 0)
+            total_clicked = totals.get('clicked', 0)
         else:
-            messages = Message.objects(id__in=ids)
-            total_sent = Email.objects(message__in=messages).count()
-            total_opened = Message.objects(id__in=ids).sum('opens')
-            total_clicked = Message.objects(id__in=ids).sum('clicks')
+            messages_ids = [ObjectId(message_id) for message_id in ids]
+            total_sent = budget.count_documents(
+                db.emails, {'message': {'$in': [DBRef('messages', message_id) for message_id in messages_ids]}}
+            )
+            pipeline = [
+                {'$match': {'_id': {'$in': messages_ids}}},
+                {'$group': {'_id': None, 'opened': {'$sum': '$opens'}, 'clicked': {'$sum': '$clicks'}}}
+            ]
+            totals = next(budget.aggregate(db.messages, pipeline), {})
+            total_opened = totals.get('opened', 0)
+            total_clicked = totals.get('clicked', 0)
 
         if not total_sent:
             dataProvider = []
@@ -763,8 +845,9 @@ class EmailCampaignsChart(FunnelChart):
 
 
 class RecommendationsChart(Chart):
-    def __init__(self):
+    def __init__(self, queries=None):
         super(RecommendationsChart, self).__init__()
+        self.queries = queries or DashboardQueries()
         self.events = {
             'visits': {'name': 'visits', 'verbose_name':
                     ugettext(u'Кликнуло на виджет рекомендаций'), 'color': '#168de2'},
@@ -842,36 +925,21 @@ class RecommendationsChart(Chart):
     def build_query_and_get_data(self, options):
         data = []
         if options['widget_option'] != 'all':
-            recommend_widgets_ids = [options['widget_option']]
+            req_clicks = get_rec_clicks([options['widget_option']], options['start'], options['end'])
         else:
-            recommend_widgets_ids = get_recommendations_widgets(options['site_id']).keys()
+            req_clicks = self.queries.get_rec_clicks(options['site_id'], options['start'], options['end'])
 
-        pipeline = [
-            {
-                '$match': {
-                    'time_added': {'$gte': options['start'], '$lte': options['end']},
-                    'event_type': 'click', 'init_by': {'$in': recommend_widgets_ids},
-                    'visit': {'$exists': 'true'}
-                }
-            },
-            {
-                '$group': {
-                    '_id': '$visit',
-                    'earliest_click_time': {'$min': '$time_added'}
-                }
-            },
-        ]
-        req_clicks = list(LeadEvent.objects.aggregate(*pipeline))
         req_visits = {}
-        for visit in req_clicks:
-            req_visits[visit['_id']] = {'click_time': visit['earliest_click_time']}
+        for visit, click_time in req_clicks.items():
+            req_visits[visit] = {'click_time': click_time}
 
-        req_orders = LeadOrder.objects(lead_visit__in=req_visits.keys())
+        req_orders = raw_documents(LeadOrder.objects(lead_visit__in=req_visits.keys()), 'lead_visit', 'time_added', 'cart_sum')
         for order in req_orders:
-            ref_visit = DBRef('visits', ObjectId(order.lead_visit.id))
-            if order.time_added > req_visits[ref_visit]['click_time']:
+            ref_visit = DBRef('visits', get_reference_id(order, 'lead_visit'))
+            if order['time_added'] > req_visits[ref_visit]['click_time']:
                 req_visits[ref_visit]['completed_order'] = req_visits[ref_visit].get('completed_order', 0) + 1
-                if order['cart_sum']:
+                # raw documents lack the fields never set
+                if order.get('cart_sum'):
                     req_visits[ref_visit]['sum_orders'] = req_visits[ref_visit].get('sum_orders', 0) + order['cart_sum']
 
         agg_func_param = '%Y-%m-%d'
@@ -956,10 +1024,10 @@ class EmailDynamicsChart(Chart):
                      {'$project': {'date': '$_id', 'quantity': 1, '_id': 0}}]
 
         unsubscribed = list(UnsubscribedEmail.objects(site=str(options['site_id']), time_added__gte=options['start'],
-                                                    time_added__lte=options['end'], status='all').aggregate(*pipeline))
+                                                    time_added__lte=options['end'], status='all').aggregate(*pipeline, **budget.get_query_options()))
 
         new_multileads = list(Multilead.objects(site=options['site_id'], time_added__gte=options['start'],
-                                                time_added__lte=options['end']).aggregate(*pipeline))
+                                                time_added__lte=options['end']).aggregate(*pipeline, **budget.get_query_options()))
 
         for x in unsubscribed:
             unsubscribed_quantity_by_date[x['date']] = x['quantity']
@@ -1033,7 +1101,7 @@ class VisitsChart(Chart):
                         })
         return options
 
-    def get_visits_data(self, options):
+    def get_visits_pipeline(self, options):
 
         match_stage = {
             '$match': {
@@ -1072,14 +1140,25 @@ class VisitsChart(Chart):
                 regex_query = [{'referrer': {'$regex': regex}} for regex in regexp_list]
                 match_stage['$match']['$or'] = regex_query
 
+        sort_stage = {
+            '$sort': {'_id': 1}
+        }
+
         if options['aggr_condition'] == 'visits':
-            visits = list(db.visits.aggregate([match_stage, group_stage]))
+            return [match_stage, group_stage, sort_stage]
 
         if options['aggr_condition'] == 'leads':
-            visits = list(db.visits.aggregate([match_stage, unique_leads_group_stage, group_stage]))
+            return [match_stage, unique_leads_group_stage, group_stage, sort_stage]
+
+    def iter_visits(self, options):
+        for visit in budget.aggregate(db.visits, self.get_visits_pipeline(options), allowDiskUse=True):
+            yield {'date': visit['_id'], 'visits': visit['total']}
 
-        visits = [{'date': visit['_id'], 'visits': visit['total']} for visit in visits]
-        visits = sorted(visits, key=lambda x: x['date'])
+    def export_rows(self, options):
+        return self.iter_visits(options)
+
+    def get_visits_data(self, options):
+        visits = list(self.iter_visits(options))
 
         total = sum([i['visits'] for i in visits])
         return {
@@ -1115,10 +1194,127 @@ class VisitsChart(Chart):
         return regex_query
 
 
+class DashboardQueries(object):
+    """
+        Memoizes the sub-queries shared by the dashboard charts: store managers, recommendation widgets, visitors,
+        ordering leads, recommendation clicks and orders. Charts of a dashboard batch share one instance, so each of them runs once per period.
+    """
+    def __init__(self):
+        self.results = {}
+        self.locks = {}
+
+    def __getstate__(self):
+        # instances travel to the workers with the charts, locks can't be pickled
+        return {'results': self.results}
+
+    def __setstate__(self, state):
+        self.results = state['results']
+        self.locks = {}
+
+    def memoize(self, key, func, *args):
+        # site ids come either as strings or as ObjectIds
+        key = tuple(ObjectId(item) if isinstance(item, basestring) and ObjectId.is_valid(item) else item for item in key)
+        # charts computed concurrently wait for the sub-query another one is already running
+        with self.locks.setdefault(key, threading.Lock()):
+            if key not in self.results:
+                self.results[key] = func(*args)
+        return self.results[key]
+
+    def get_store_managers(self, site_id):
+        return self.memoize(('store_managers', site_id), get_store_managers, site_id)
+
+    def get_rec_widgets_ids(self, site_id):
+        return self.memoize(('rec_widgets_ids', site_id), lambda: get_recommendations_widgets(site_id).keys())
+
+    def get_visitors(self, site_id, start, end):
+        return self.memoize(('visitors', site_id, start, end), get_visitors, site_id, start, end)
+
+    def get_ordering_leads(self, site_id, start, end):
+        return self.memoize(
+            ('ordering_leads', site_id, start, end), get_ordering_leads, site_id, start, end,
+            self.get_store_managers(site_id)
+        )
+
+    def get_rec_clicks(self, site_id, start, end):
+        return self.memoize(
+            ('rec_clicks', site_id, start, end), get_rec_clicks, self.get_rec_widgets_ids(site_id), start, end
+        )
+
+    def get_rec_orders(self, site_id, start, end):
+        return self.memoize(('rec_orders', site_id, start, end), get_rec_orders, self.get_rec_clicks(site_id, start, end))
+
+
+def get_store_managers(site_id):
+    return list(raw_values_list(Lead.objects(site=site_id, status='manager'), 'id'))
+
+
+def get_visitors(site_id, start, end):
+    """
+        Returns the set of lead refs having a visit within the period.
+    """
+    visits = budget.find(db.visits, {
+        'site': DBRef('sites', ObjectId(site_id)),
+        'start': {'$gte': start},
+        'end': {'$lte': end}
+    }, {'lead': 1, '_id': 0})
+    return set(visit['lead'] for visit in visits)
+
+
+def get_ordering_leads(site_id, start, end, store_managers):
+    """
+        Returns the set of lead refs that placed an order within the period, store managers excluded.
+    """
+    pipeline = [
+        {
+            '$match': {
+                'site': DBRef('sites', ObjectId(site_id)),
+                'lead.$id': {'$nin': store_managers},
+                'time_added': {'$gte': start, '$lte': end}
+            }
+        },
+        {'$group': {'_id': '$lead'}}
+    ]
+    return set(item['_id'] for item in budget.aggregate(db.lead_orders, pipeline))
+
+
+def get_rec_clicks(rec_widgets_ids, start, end):
+    """
+        Returns {visit ref: earliest click time} for the clicks on the given recommendation widgets within the period.
+    """
+    pipeline = [
+        {
+            '$match': {
+                'time_added': {'$gte': start, '$lte': end},
+                'event_type': 'click', 'init_by': {'$in': list(rec_widgets_ids)},
+                'visit': {'$exists': 'true'}
+            }
+        },
+        {
+            '$group': {
+                '_id': '$visit',
+                'earliest_click_time': {'$min': '$time_added'}
+            }
+        },
+    ]
+    return {click['_id']: click['earliest_click_time'] for click in budget.aggregate(db.lead_events, pipeline)}
+
+
+def get_rec_orders(rec_clicks):
+    """
+        Returns the set of ids of the orders placed during a visit after a click on a recommendation widget.
+        rec_clicks is {visit ref: earliest click time}, see get_rec_clicks. Orders are looked up by their visit.
+    """
+    orders = raw_documents(LeadOrder.objects(lead_visit__in=rec_clicks.keys()), 'lead_visit', 'time_added')
+    return set(
+        order['_id'] for order in orders
+        if order['time_added'] > rec_clicks[DBRef('visits', get_reference_id(order, 'lead_visit'))]
+    )
+
+
 class SalesFunnelChart(FunnelChart):
-    def __init__(self, site_id=None):
+    def __init__(self, site_id=None, queries=None):
         super(SalesFunnelChart, self).__init__()
-        self.store_managers = list(Lead.objects(site=site_id, status='manager').values_list('id'))
+        self.queries = queries or DashboardQueries()
 
     def validate_input(self, options):
         options = copy.deepcopy(options)
@@ -1147,16 +1343,10 @@ class SalesFunnelChart(FunnelChart):
             },
         }
 
-        norm_visits = list(db.visits.find({
-            'site': site_ref,
-            'start': {'$gte': start},
-            'end': {'$lte': end}
-        }))
-
-        norm_visits_leads = set([visit['lead'] for visit in norm_visits])
+        norm_visits_leads = self.queries.get_visitors(site_id, start, end)
 
-        incognito_visits = list(db.incognito_pageviews.find(visited_pages_query))
-        lead_visits = list(db.lead_visited_pages.find(visited_pages_query))
+        incognito_visits = list(budget.find(db.incognito_pageviews, visited_pages_query, {'lead': 1, 'page': 1, '_id': 0}))
+        lead_visits = list(budget.find(db.lead_visited_pages, visited_pages_query, {'lead': 1, 'page': 1, '_id': 0}))
 
         unique_incognito = set((visit['lead'] for visit in incognito_visits))
         unique_leads = set((visit['lead'] for visit in lead_visits))
@@ -1166,7 +1356,7 @@ class SalesFunnelChart(FunnelChart):
 
         try:
             yml_file = YMLFile.objects.get(site=site_id)
-            offers_hashes = set([offer.url_hash for offer in YMLOffer.objects(site=site_id)])
+            offers_hashes = set(raw_values_list(YMLOffer.objects(site=site_id), 'url_hash'))
         except YMLFile.DoesNotExist:
             yml_file = YMLFile()
             offers_hashes = []
@@ -1182,27 +1372,17 @@ class SalesFunnelChart(FunnelChart):
             if url_hash in offers_hashes:
                 leads_visited_offers.add(visit['lead'])
 
-        cart_items = db.cart_items.find({
+        cart_items = budget.find(db.cart_items, {
             'site': site_ref,
             'lead': {'$in': all_visitors},
             'time_added': {
                 '$gte': start,
                 '$lte': end
             }
-        })
+        }, {'lead': 1, '_id': 0})
 
         unique_leads_added_to_cart = set((cart_item['lead'] for cart_item in cart_items))
-        orders = db.lead_orders.find({
-            'site': site_ref,
-            'lead.$id': {'$nin': self.store_managers},
-            # 'lead': {'$in': all_visitors},
-            'time_added': {
-                '$gte': start,
-                '$lte': end
-            }
-        })
-
-        unique_leads_made_orders = set((order['lead'] for order in orders))
+        unique_leads_made_orders = self.queries.get_ordering_leads(site_id, start, end)
 
         total_visits = len(norm_visits_leads)
         total_offer_views = len(leads_visited_offers)
@@ -1263,108 +1443,96 @@ class SalesFunnelChart(FunnelChart):
 
 
 class SalesBarChart(Chart):
-    def __init__(self, site_id=None):
+    def __init__(self, site_id=None, queries=None):
         super(SalesBarChart, self).__init__()
-        self.store_managers = list(Lead.objects(site=site_id, status='manager').values_list('id'))
+        self.queries = queries or DashboardQueries()
 
     def validate_input(self, options):
         options = copy.deepcopy(options)
         options['status'] = 'ok'
         return options
 
-    def get_rec_widgets_based_orders(self, options):
+    def get_export_fields(self):
+        return ['date', 'store', 'leadhit', 'raw_leadhit']
+
+    def get_orders_by_source(self, options, period, agg_func_param):
+        """
+            Returns {date: {source: {'sum': cart_sum, 'count': orders_count}}} where source is one of
+            'email', 'recommendation' or 'store'. Orders are classified and bucketed in a single aggregation,
+            the recommendation orders are found beforehand from the recommendation clicks shared with
+            the other dashboard charts.
+        """
+        rec_orders = list(self.queries.get_rec_orders(options['site_id'], period.start, period.end))
+        match_stage = {
+            '$match': {
+                'site': DBRef('sites', ObjectId(options['site_id'])),
+                'time_added': {'$gte': period.start, '$lte': period.end},
+                'lead.$id': {'$nin': self.queries.get_store_managers(options['site_id'])}
+            }
+        }
 
-        period = Period.from_def_ranges(options['period'])
-        rec_widgets_ids = get_recommendations_widgets(options['site_id']).keys()
-        pipeline = [
-            {
-                '$match': {
-                    'time_added': {'$gte': period.start, '$lte': period.end},
-                    'event_type': 'click',
-                    'init_by': {'$in': rec_widgets_ids},
-                    'visit': {'$exists': 'true'},
-                    'lead.$id': {'$nin': self.store_managers}
+        project_stage = {
+            '$project': {
+                'date': {'$dateToString': {'format': agg_func_param, 'date': '$time_added'}},
+                'cart_sum': {'$ifNull': ['$cart_sum', 0]},
+                'source': {
+                    '$cond': [
+                        {
+                            '$or': [
+                                {'$ne': [{'$type': '$mass_email'}, 'missing']},
+                                {'$ne': [{'$type': '$trigger_email'}, 'missing']}
+                            ]
+                        },
+                        'email',
+                        {'$cond': [{'$in': ['$_id', rec_orders]}, 'recommendation', 'store']}
+                    ]
                 }
-            },
-            {
-                '$group': {
-                    '_id': '$visit',
-                    'earliest_click_time': {'$min': '$time_added'}
-                }
-            },
-        ]
+            }
+        }
 
-        events = {visit['_id']: visit['earliest_click_time'] for visit in db.lead_events.aggregate(pipeline)}
-        orders = LeadOrder.objects(lead_visit__in=events.keys())
+        group_stage = {
+            '$group': {
+                '_id': {'date': '$date', 'source': '$source'},
+                'sum': {'$sum': '$cart_sum'},
+                'count': {'$sum': 1}
+            }
+        }
 
-        result = []
-        for order in orders:
-            ref_visit = DBRef('visits', ObjectId(order.lead_visit.id))
-            if order.time_added > events[ref_visit]:
-                result.append(order.id)
-        return result
+        pipeline = [match_stage, project_stage, group_stage]
 
-    def get_data(self, options):
-        rec_orders = self.get_rec_widgets_based_orders(options)
+        orders_by_source = {}
+        for item in budget.aggregate(db.lead_orders, pipeline):
+            date_sources = orders_by_source.setdefault(item['_id']['date'], {})
+            date_sources[item['_id']['source']] = {'sum': float(item['sum']), 'count': item['count']}
+        return orders_by_source
 
+    def get_data(self, options):
         period = Period.from_def_ranges(options['period'])
-        query = Q(site=options['site_id'], time_added__gte=period.start, time_added__lte=period.end, lead__nin=self.store_managers)
-        query &= (Q(mass_email__exists=True) | Q(trigger_email__exists=True))
-        email_orders = LeadOrder.objects(query).values_list('id')
-
-        leadhit_based_orders = set(rec_orders)
-        leadhit_based_orders.update(set(email_orders))
-
-        all_orders = LeadOrder.objects(site=options['site_id'], time_added__gte=period.start, time_added__lte=period.end, lead__nin=self.store_managers)
-        all_orders = {order.id: {'time_added': order.time_added, 'cart_sum': order.cart_sum} for order in all_orders}
-
-        store_made_orders_ids = set(all_orders.keys())
-        store_made_orders_ids.difference_update(leadhit_based_orders)
-
-        orders_dict = {}
 
         agg_func_param = '%Y-%m-%d'
         if options['period'] == 'day':
             agg_func_param = '%Y-%m-%d %H:00'
 
-        for order in all_orders:
-            date = all_orders[order]['time_added'].strftime(agg_func_param)
-            cart_sum = float(all_orders[order]['cart_sum'] or 0)
-
-            if date not in orders_dict:
-                orders_dict[date] = {}
-                if order in store_made_orders_ids:
-                    orders_dict[date]['store'] = cart_sum
-                else:
-                    orders_dict[date]['leadhit'] = cart_sum
-            else:
-                if order in store_made_orders_ids:
-                    if 'store' not in orders_dict[date]:
-                        orders_dict[date]['store'] = cart_sum
-                    else:
-                        orders_dict[date]['store'] += cart_sum
-                else:
-                    if 'leadhit' not in orders_dict[date]:
-                        orders_dict[date]['leadhit'] = cart_sum
-                    else:
-                        orders_dict[date]['leadhit'] += cart_sum
+        orders_by_source = self.get_orders_by_source(options, period, agg_func_param)
 
+        store_orders_count = 0
+        leadhit_orders_count = 0
         dataProvider = []
-        for date in orders_dict:
+        for date, sources in orders_by_source.items():
             tmp_obj = {
                 'date': date,
             }
 
-            if 'store' in orders_dict[date]:
-                tmp_obj['store'] = orders_dict[date]['store']
+            leadhit_sources = [sources[source] for source in ('email', 'recommendation') if source in sources]
+            leadhit_orders_count += sum([source['count'] for source in leadhit_sources])
 
-            if 'store' in orders_dict[date] and 'leadhit' in orders_dict[date]:
-                tmp_obj['leadhit'] = orders_dict[date]['store'] + orders_dict[date]['leadhit']
-                tmp_obj['raw_leadhit'] = orders_dict[date]['leadhit']
+            if 'store' in sources:
+                tmp_obj['store'] = sources['store']['sum']
+                store_orders_count += sources['store']['count']
 
-            if 'store' not in orders_dict[date] and 'leadhit' in orders_dict[date]:
-                tmp_obj['leadhit'] = orders_dict[date]['leadhit']
-                tmp_obj['raw_leadhit'] = orders_dict[date]['leadhit']
+            if leadhit_sources:
+                tmp_obj['raw_leadhit'] = sum([source['sum'] for source in leadhit_sources])
+                tmp_obj['leadhit'] = tmp_obj.get('store', 0) + tmp_obj['raw_leadhit']
 
             dataProvider.append(tmp_obj)
 
@@ -1405,11 +1573,9 @@ class SalesBarChart(Chart):
             }
         ]
 
-        store_orders_count = len(store_made_orders_ids)
         store_orders_sum = sum([item['store'] for item in dataProvider if item.get('store')])
-        leadhit_orders_count = len(leadhit_based_orders)
         leadhit_orders_sum = sum([item['raw_leadhit'] for item in dataProvider if item.get('raw_leadhit')])
-        all_orders_count = len(all_orders)
+        all_orders_count = store_orders_count + leadhit_orders_count
         all_orders_sum = leadhit_orders_sum + store_orders_sum
         return {
             'chart_settings': self.chart_settings,
@@ -1436,89 +1602,31 @@ class LeadsDiscoveryChart(Chart):
         options['status'] = 'ok'
         return options
 
-    def get_lh_forms(self, site):
-
-        LH_FORM_ACTIONS = ('lh_dp', 'lh_banner', 'lh_banner_mobile')
-
-        query = {
-            'site': site,
-            '$or': [
-                {'action': {'$in': LH_FORM_ACTIONS}},
-                {'subscription': True}
-            ]
-        }
-
-        site_forms = db.forms.find(query)
-        site_forms = set([DBRef('forms', form['_id']) for form in site_forms])
-
-        return site_forms
-
-    def get_leads_ids_and_refs(self, site, period):
-
-        multi = list(db.multileads.find({
-            'site': site,
-            'time_added': {
-                '$gte': period.start,
-                '$lte': period.end
-            }
-        }, {'_id': 1}))
-
-        leads = list(db.leads.find({
-            'site': site,
-            'multilead': {'$in': [DBRef('multileads', m['_id']) for m in multi]},
-            'time_added': {
-                '$gte': period.start,
-                '$lte': period.end
-            }
-        }, {'_id': 1, 'multilead': 1}))
-
-        leads_ids = [lead['_id'] for lead in leads]
-        leads_refs = [DBRef('leads', lead) for lead in leads_ids]
-        leads_multileads_dict = {DBRef('leads', lead['_id']): lead['multilead'] for lead in leads}
-
-        return {
-            'leads_ids': leads_ids,
-            'leads_refs': leads_refs,
-            'leads_multileads_dict': leads_multileads_dict
-        }
-
-    def get_filled_forms(self, site, leads_refs):
+    def get_export_fields(self):
+        return ['date', 'store', 'leadhit', 'raw_leadhit']
 
+    def get_first_forms_by_date(self, site, period, agg_func_param):
         match_stage = {
             '$match': {
                 'site': site,
-                'lead': {'$in': leads_refs}
+                'submitted_time': {
+                    '$gte': period.start,
+                    '$lte': period.end
+                }
             }
         }
 
         group_stage = {
             '$group': {
-                '_id': '$lead',
-                'forms': {'$push': {'form_dbref': '$leadform', 'submitted_time': '$submitted_time'}}
+                '_id': {'$dateToString': {'format': agg_func_param, 'date': '$submitted_time'}},
+                'leadhit': {'$sum': {'$cond': ['$leadhit', 1, 0]}},
+                'store': {'$sum': {'$cond': ['$leadhit', 0, 1]}}
             }
         }
 
-        unwind_stage = {
-            '$unwind': '$forms'
-        }
-
-        sort_stage = {
-            '$sort': {
-                'forms': 1
-            }
-        }
-
-        second_group_stage = {
-            '$group': {
-                '_id': '$_id',
-                'filled_forms': {'$push': '$forms'}
-            }
-        }
-
-        pipeline = [match_stage, group_stage, unwind_stage, sort_stage, second_group_stage]
-        # forms is a list of objects where '_id' is lead_id and 'filled_forms' is a sorted list of forms that given lead filled
-        forms = list(db.leads_filled_forms.aggregate(pipeline))
-        return forms
+        # every multilead has a single first-touch record, kept by the sync_facts task (see facts.sync_first_forms)
+        first_forms = budget.aggregate(db.multilead_first_forms, [match_stage, group_stage])
+        return {item['_id']: {'leadhit': item['leadhit'], 'store': item['store']} for item in first_forms}
 
     def get_data(self, options):
 
@@ -1533,41 +1641,7 @@ class LeadsDiscoveryChart(Chart):
         else:
             del self.chart_settings['categoryAxis']['minPeriod']
 
-        relevant_site_forms = self.get_lh_forms(site)
-        leads = self.get_leads_ids_and_refs(site, period)
-        forms = self.get_filled_forms(site, leads['leads_refs'])
-
-        leads_multileads_dict = leads['leads_multileads_dict']
-        processed_multileads = set()
-        data = {}
-
-        for lead in forms:
-            multilead_dbref = leads_multileads_dict[lead['_id']]
-            first_form = lead['filled_forms'][0]
-
-            # no multilead case
-            if not multilead_dbref:
-                pass
-
-            if multilead_dbref in processed_multileads:
-                continue
-
-            processed_multileads.add(multilead_dbref)
-            form_submission_date = first_form['submitted_time'].strftime(agg_func_param)
-            leadhit = first_form['form_dbref'] in relevant_site_forms
-            if form_submission_date not in data:
-                data[form_submission_date] = {}
-                if not leadhit:
-                    data[form_submission_date]['leadhit'] = 0
-                    data[form_submission_date]['store'] = 1
-                else:
-                    data[form_submission_date]['leadhit'] = 1
-                    data[form_submission_date]['store'] = 0
-            else:
-                if not leadhit:
-                    data[form_submission_date]['store'] += 1
-                else:
-                    data[form_submission_date]['leadhit'] += 1
+        data = self.get_first_forms_by_date(site, period, agg_func_param)
 
         processed_data = []
         for date in data:
@@ -1670,97 +1744,183 @@ def validate_date_range(options):
     return result
 
 
-class AverageRevenuePerVisitorChart(Chart):
-    def __init__(self):
-        super(AverageRevenuePerVisitorChart, self).__init__()
-        self.events = {
-            'arpv': {'name': 'arpv', 'verbose_name': 'ARPV', 'color': '#258cbb'},
+def get_iso_weeks(period_start, period_end):
+    """
+        Returns a sorted list of ((iso_year, iso_week), first_day, last_day) tuples covering the period.
+        The first and the last weeks are cut by the period boundaries.
+    """
+    date_list = [period_start.date() + datetime.timedelta(days=x) for x
+                 in xrange((period_end - period_start).days + 1)]
+    weeks = []
+    for id_grp, grp in itertools.groupby(date_list, key=lambda x: x.isocalendar()[:2]):
+        current_week = list(grp)
+        weeks.append((id_grp, min(current_week), max(current_week)))
+    return weeks
+
+
+def get_period_query(site_id, period_start, period_end, date_field):
+    return {
+        'site': DBRef('sites', site_id),
+        date_field: {
+            '$gte': datetime.datetime.combine(period_start.date(), datetime.datetime.min.time()),
+            '$lte': datetime.datetime.combine(period_end.date(), datetime.datetime.max.time())
         }
+    }
 
-    def get_arpv_data(self, options):
-        data_by_weeks = get_sum_orders_by_week(
-            options['period_start'], options['period_end'], options['site_id']
-        )
-
-        data = []
-        for isoweek, values in sorted(data_by_weeks.items(), key=lambda x: (x[0], x[1])):
-            match_stage_current_week = {
-                '$match': {
-                    'site': DBRef('sites', options['site_id']),
-                    'start': {
-                        '$gte': datetime.datetime.combine(values['start'], datetime.datetime.min.time()),
-                        '$lte': datetime.datetime.combine(values['end'], datetime.datetime.max.time())
-                    }
-                }
-            }
-            group_unique_leads_stage = {
-                '$group': {
-                    '_id': '$lead',
-                    'start': {'$first': '$start'}
-                }
-            }
 
-            visitors = len(
-                list(db.visits.aggregate([match_stage_current_week, group_unique_leads_stage]))
-            )
-            data.append({
-                'date': values['start'].strftime('%d.%m') + '-' + values['end'].strftime('%d.%m'),
-                'arpv': round(
-                    float(values.get('revenue', 0)) / visitors, 2
-                ) if visitors else 0
-            })
+def get_isoweek_group_id(date_field, **fields):
+    group_id = {'year': {'$isoWeekYear': '$' + date_field}, 'week': {'$isoWeek': '$' + date_field}}
+    group_id.update(fields)
+    return group_id
 
-        return data
 
-    def get_data(self, options):
-        graphs_and_axes = self.generate_graphs_and_axes(self.events.keys())
-        data = self.get_arpv_data(options)
-        self.chart_settings['valueAxes'] = graphs_and_axes['axes']
-        self.chart_settings['graphs'] = graphs_and_axes['graphs']
-        self.chart_settings['dataProvider'] = data
-        self.chart_settings['legend'] = None
-        self.chart_settings['categoryAxis']['parseDates'] = False
-        return {'chart_settings': self.chart_settings}
+def build_kpi_cube(site_id, period_start, period_end):
+    """
+        Computes every column the KPI charts need for each ISO week of the period:
+        {isoweek: {'revenue', 'orders', 'paid_orders', 'customers', 'repeat_customers', 'visitors', 'multileads', 'carts'}}
+        'customers' are unique multileads that made orders, 'multileads' are unique multileads that visited the site.
+    """
+    cube = {}
 
+    def get_row(group_id):
+        return cube.setdefault((group_id['year'], group_id['week']), {
+            'revenue': 0, 'orders': 0, 'paid_orders': 0, 'customers': 0,
+            'repeat_customers': 0, 'visitors': 0, 'multileads': 0, 'carts': 0
+        })
 
-class AverageRevenuePerUserChart(Chart):
-    def __init__(self):
-        super(AverageRevenuePerUserChart, self).__init__()
-        self.events = {
-            'arpu': {'name': 'arpu', 'verbose_name': 'ARPU', 'color': '#258cbb'},
+    # order_facts already have the customer resolved and are kept in sync by the sync_facts task
+    orders_pipeline = [
+        {'$match': get_period_query(site_id, period_start, period_end, 'time_added')},
+        {
+            '$group': {
+                '_id': {'year': '$iso_year', 'week': '$iso_week', 'customer': '$customer'},
+                'revenue': {'$sum': '$cart_sum'},
+                'orders': {'$sum': 1},
+                'paid_orders': {'$sum': {'$cond': [{'$eq': ['$status', 'paid']}, 1, 0]}}
+            }
         }
+    ]
+    for item in budget.aggregate(db.order_facts, orders_pipeline, allowDiskUse=True):
+        row = get_row(item['_id'])
+        row['revenue'] += item['revenue']
+        row['orders'] += item['orders']
+        row['paid_orders'] += item['paid_orders']
+        row['customers'] += 1
+        if item['orders'] > 1:
+            row['repeat_customers'] += 1
+
+    visits_pipeline = [
+        {'$match': get_period_query(site_id, period_start, period_end, 'start')},
+        {'$group': {'_id': get_isoweek_group_id('start', lead='$lead')}}
+    ]
+    visits = list(budget.aggregate(db.visits, visits_pipeline, allowDiskUse=True))
+    customers = resolve_customers(site_id, [item['_id']['lead'].id for item in visits])
+
+    visitors_multileads = {}
+    for item in visits:
+        get_row(item['_id'])['visitors'] += 1
+        lead_id = item['_id']['lead'].id
+        visitors_multileads.setdefault((item['_id']['year'], item['_id']['week']), set()).add(customers.get(lead_id, lead_id))
+
+    for isoweek, multileads in visitors_multileads.items():
+        cube[isoweek]['multileads'] = len(multileads)
+
+    carts_match = get_period_query(site_id, period_start, period_end, 'time_added')
+    carts_match['order_id'] = {'$exists': True}
+    carts_pipeline = [
+        {'$match': carts_match},
+        {'$group': {'_id': get_isoweek_group_id('time_added', order_id='$order_id')}},
+        {'$group': {'_id': {'year': '$_id.year', 'week': '$_id.week'}, 'carts': {'$sum': 1}}}
+    ]
+    for item in budget.aggregate(db.cart_items, carts_pipeline, allowDiskUse=True):
+        get_row(item['_id'])['carts'] = item['carts']
+
+    return cube
+
+
+def get_kpi_week_key(site_id, first_day, last_day):
+    return 'analytics:kpi_cube:{}:{}:{}'.format(site_id, first_day.strftime('%Y%m%d'), last_day.strftime('%Y%m%d'))
+
+
+def get_kpi_cube(site_id, period_start, period_end):
+    """
+        Returns the KPI cube of the period. Rows are cached per ISO week (per part of a week at the period
+        boundaries), so that any period reuses the weeks already computed, e.g. by the warming.
+        The weeks missing from the cache are built with a single build_kpi_cube over their span.
+        Concurrent callers wait a little for the span being built by the first one, then build it themselves.
+    """
+    iso_weeks = get_iso_weeks(period_start, period_end)
+    weeks = {isoweek: get_kpi_week_key(site_id, first_day, last_day) for isoweek, first_day, last_day in iso_weeks}
+    cached = cache.get_many(weeks.values())
+    missing = [week for week in iso_weeks if weeks[week[0]] not in cached]
+    if missing:
+        span_start = datetime.datetime.combine(missing[0][1], datetime.datetime.min.time())
+        span_end = datetime.datetime.combine(missing[-1][2], datetime.datetime.max.time())
+        lock_key = get_kpi_week_key(site_id, span_start, span_end) + ':lock'
+        lock_token = str(ObjectId())
+
+        waited = 0
+        locked = redis.set(lock_key, lock_token, nx=True, ex=KPI_CUBE_LOCK_TIMEOUT)
+        while not locked and waited < KPI_CUBE_LOCK_WAIT:
+            time.sleep(KPI_CUBE_LOCK_POLL)
+            waited += KPI_CUBE_LOCK_POLL
+            cached.update(cache.get_many([weeks[isoweek] for isoweek, first_day, last_day in missing]))
+            missing = [week for week in missing if weeks[week[0]] not in cached]
+            if not missing:
+                break
+            # the builder may have failed and released the lock
+            locked = redis.set(lock_key, lock_token, nx=True, ex=KPI_CUBE_LOCK_TIMEOUT)
+
+        if missing:
+            try:
+                built = build_kpi_cube(site_id, span_start, span_end)
+                today = datetime.date.today()
+                for past in (True, False):
+                    # weeks without any data are cached as empty rows
+                    rows = {
+                        weeks[isoweek]: built.get(isoweek, {}) for isoweek, first_day, last_day in missing
+                        if (last_day < today) == past
+                    }
+                    cache.set_many(rows, KPI_PAST_WEEKS_CACHE_TIMEOUT if past else KPI_CUBE_CACHE_TIMEOUT)
+                    cached.update(rows)
+            finally:
+                if locked:
+                    delete_if_equals(lock_key, lock_token)
 
-    def get_arpu_data(self, options):
-        data_by_weeks = get_sum_orders_by_week(
-            options['period_start'], options['period_end'], options['site_id']
-        )
-        data = []
+    return {isoweek: cached[key] for isoweek, key in weeks.items() if cached.get(key)}
 
-        for isoweek, values in sorted(data_by_weeks.items(), key=lambda x: (x[0], x[1])):
-            current_week_visitors = db.visits.find({
-                "start": {
-                    '$gte': datetime.datetime.combine(values['start'], datetime.datetime.min.time()),
-                    '$lte': datetime.datetime.combine(values['end'], datetime.datetime.max.time())
-                },
-                "site": DBRef('sites', options['site_id'])
-            }).distinct('lead')
 
-            current_week_multileads = len(db.leads.find({
-                "_id": {'$in': [lead.id for lead in current_week_visitors]},
-            }).distinct('multilead'))
+class KPIChart(Chart):
+    """
+        Base class for the weekly shop KPI charts.
+        Each subclass declares 'kpi' (the valueField of the graph) and implements 'get_week_value'
+        which computes the KPI from a row of the KPI cube.
+    """
+    kpi = None
 
+    def get_week_value(self, row):
+        """
+            Computes the KPI of a week from its row of the KPI cube.
+        """
+        raise NotImplementedError
+
+    def get_weekly_values(self, options):
+        cube = get_kpi_cube(options['site_id'], options['period_start'], options['period_end'])
+        return {isoweek: self.get_week_value(row) for isoweek, row in cube.items()}
+
+    def get_kpi_data(self, options):
+        values = self.get_weekly_values(options)
+        data = []
+        for isoweek, week_start, week_end in get_iso_weeks(options['period_start'], options['period_end']):
             data.append({
-                'date': values['start'].strftime('%d.%m') + '-' + values['end'].strftime('%d.%m'),
-                'arpu': round(
-                    float(values.get('revenue', 0)) / current_week_multileads, 2
-                ) if current_week_multileads else 0
+                'date': week_start.strftime('%d.%m') + '-' + week_end.strftime('%d.%m'),
+                self.kpi: values.get(isoweek, 0)
             })
-
         return data
 
     def get_data(self, options):
         graphs_and_axes = self.generate_graphs_and_axes(self.events.keys())
-        data = self.get_arpu_data(options)
+        data = self.get_kpi_data(options)
         self.chart_settings['valueAxes'] = graphs_and_axes['axes']
         self.chart_settings['graphs'] = graphs_and_axes['graphs']
         self.chart_settings['dataProvider'] = data
@@ -1769,317 +1929,243 @@ class AverageRevenuePerUserChart(Chart):
         return {'chart_settings': self.chart_settings}
 
 
-class AverageRevenuePerPayingUserChart(Chart):
+class AverageRevenuePerVisitorChart(KPIChart):
+    kpi = 'arpv'
+
     def __init__(self):
-        super(AverageRevenuePerPayingUserChart, self).__init__()
+        super(AverageRevenuePerVisitorChart, self).__init__()
         self.events = {
-            'arppu': {'name': 'arppu', 'verbose_name': 'ARPPU', 'color': '#258cbb'},
+            'arpv': {'name': 'arpv', 'verbose_name': 'ARPV', 'color': '#258cbb'},
         }
 
-    def get_arppu_data(self, options):
-        period_start = options['period_start']
-        period_end = options['period_end']
-
-        date_list = [period_start.date() + datetime.timedelta(days=x) for x
-                       in xrange((period_end - period_start).days + 1)]
-        data_by_weeks = {}
-        for id_grp, grp in itertools.groupby(date_list, key=lambda x: x.isocalendar()[:2]):
-            current_week = list(grp)
-            data_by_weeks[id_grp] = {'start': min(current_week), 'end': max(current_week)}
+    def get_week_value(self, row):
+        return round(float(row['revenue']) / row['visitors'], 2) if row['visitors'] else 0
 
-        data = []
-        for isoweek, values in sorted(data_by_weeks.items(), key=lambda x: (x[0], x[1])):
-            week_orders = LeadOrder.objects(
-                site=DBRef('sites', options['site_id']),
-                time_added__gte=datetime.datetime.combine(values['start'], datetime.datetime.min.time()),
-                time_added__lte=datetime.datetime.combine(values['end'], datetime.datetime.max.time())
-            )
 
-            solvent_leads = week_orders.no_dereference().values_list('lead')
-            solvent_multileads = Lead.objects(
-                id__in=[x.id for x in solvent_leads]
-            ).no_dereference().scalar('multilead', 'id')
-            solvent_multileads = {x[0] if x[0] else x[1] for x in solvent_multileads}
-            week_unique_customers = len(solvent_multileads)
+class AverageRevenuePerUserChart(KPIChart):
+    kpi = 'arpu'
 
-            data.append({
-                'date': values['start'].strftime('%d.%m') + '-' + values['end'].strftime('%d.%m'),
-                'arppu': round(
-                    float(week_orders.sum('cart_sum')) / week_unique_customers, 2
-                ) if week_unique_customers else 0
-            })
+    def __init__(self):
+        super(AverageRevenuePerUserChart, self).__init__()
+        self.events = {
+            'arpu': {'name': 'arpu', 'verbose_name': 'ARPU', 'color': '#258cbb'},
+        }
 
-        return data
+    def get_week_value(self, row):
+        return round(float(row['revenue']) / row['multileads'], 2) if row['multileads'] else 0
 
-    def get_data(self, options):
-        graphs_and_axes = self.generate_graphs_and_axes(self.events.keys())
-        data = self.get_arppu_data(options)
-        self.chart_settings['valueAxes'] = graphs_and_axes['axes']
-        self.chart_settings['graphs'] = graphs_and_axes['graphs']
-        self.chart_settings['dataProvider'] = data
-        self.chart_settings['legend'] = None
-        self.chart_settings['categoryAxis']['parseDates'] = False
-        return {'chart_settings': self.chart_settings}
 
+class AverageRevenuePerPayingUserChart(KPIChart):
+    kpi = 'arppu'
 
-class CartAbandonmentRateChart(Chart):
     def __init__(self):
-        super(CartAbandonmentRateChart, self).__init__()
+        super(AverageRevenuePerPayingUserChart, self).__init__()
         self.events = {
-            'car': {'name': 'car', 'verbose_name': 'Cart abandonment rate', 'color': '#258cbb'},
+            'arppu': {'name': 'arppu', 'verbose_name': 'ARPPU', 'color': '#258cbb'},
         }
 
-    def get_car_data(self, options):
-        period_start = options['period_start']
-        period_end = options['period_end']
+    def get_week_value(self, row):
+        return round(float(row['revenue']) / row['customers'], 2) if row['customers'] else 0
 
-        date_list = [period_start.date() + datetime.timedelta(days=x) for x
-                     in xrange((period_end - period_start).days + 1)]
-        data_by_weeks = {}
-        for id_grp, grp in itertools.groupby(date_list, key=lambda x: x.isocalendar()[:2]):
-            current_week = list(grp)
-            data_by_weeks[id_grp] = {'start': min(current_week), 'end': max(current_week)}
 
-        data = []
-        for isoweek, values in sorted(data_by_weeks.items(), key=lambda x: (x[0], x[1])):
-            week_orders_number = LeadOrder.objects(
-                site=DBRef('sites', options['site_id']),
-                time_added__gte=datetime.datetime.combine(values['start'], datetime.datetime.min.time()),
-                time_added__lte=datetime.datetime.combine(values['end'], datetime.datetime.max.time())
-            ).count()
-
-            week_baskets_number = len(CartItem.objects(
-                site=DBRef('sites', options['site_id']),
-                time_added__gte=datetime.datetime.combine(values['start'], datetime.datetime.min.time()),
-                time_added__lte=datetime.datetime.combine(values['end'], datetime.datetime.max.time()),
-                order_id__exists=True
-            ).distinct('order_id'))
+class CartAbandonmentRateChart(KPIChart):
+    kpi = 'car'
 
-            data.append({
-                'date': values['start'].strftime('%d.%m') + '-' + values['end'].strftime('%d.%m'),
-                'car': round(
-                    float(week_baskets_number - week_orders_number) / week_baskets_number * 100, 2
-                ) if week_orders_number else 0
-            })
+    def __init__(self):
+        super(CartAbandonmentRateChart, self).__init__()
+        self.events = {
+            'car': {'name': 'car', 'verbose_name': 'Cart abandonment rate', 'color': '#258cbb'},
+        }
 
-        return data
+    def get_week_value(self, row):
+        return round(
+            float(row['carts'] - row['orders']) / row['carts'] * 100, 2
+        ) if row['orders'] and row['carts'] else 0
 
-    def get_data(self, options):
-        graphs_and_axes = self.generate_graphs_and_axes(self.events.keys())
-        data = self.get_car_data(options)
-        self.chart_settings['valueAxes'] = graphs_and_axes['axes']
-        self.chart_settings['graphs'] = graphs_and_axes['graphs']
-        self.chart_settings['dataProvider'] = data
-        self.chart_settings['legend'] = None
-        self.chart_settings['categoryAxis']['parseDates'] = False
-        return {'chart_settings': self.chart_settings}
 
+class AverageCheckChart(KPIChart):
+    kpi = 'average_check'
 
-class AverageCheckChart(Chart):
     def __init__(self):
         super(AverageCheckChart, self).__init__()
         self.events = {
             'average_check': {'name': 'average_check', 'verbose_name': 'Average check', 'color': '#258cbb'},
         }
 
-    def get_graph_data(self, options):
-        period_start = options['period_start']
-        period_end = options['period_end']
-        date_list = [period_start.date() + datetime.timedelta(days=x) for x
-                     in xrange((period_end - period_start).days + 1)]
-        data_by_weeks = {}
+    def get_week_value(self, row):
+        return round(float(row['revenue']) / row['orders'], 2) if row['orders'] else 0
 
-        for id_grp, grp in itertools.groupby(date_list, key=lambda x: x.isocalendar()[:2]):
-            current_week = list(grp)
-            data_by_weeks[id_grp] = {'start': min(current_week), 'end': max(current_week)}
-
-        data = []
-        for isoweek, values in sorted(data_by_weeks.items(), key=lambda x: (x[0], x[1])):
-            week_orders = LeadOrder.objects(
-                site=DBRef('sites', options['site_id']),
-                time_added__gte=datetime.datetime.combine(values['start'], datetime.datetime.min.time()),
-                time_added__lte=datetime.datetime.combine(values['end'], datetime.datetime.max.time())
-            )
-            week_orders_number = week_orders.count()
-            data.append({
-                'date': values['start'].strftime('%d.%m') + '-' + values['end'].strftime('%d.%m'),
-                'average_check': round(
-                    float(week_orders.sum('cart_sum')) / week_orders_number, 2
-                ) if week_orders_number else 0
-            })
 
-        return data
+class PurchaseFrequencyChart(KPIChart):
+    kpi = 'purchase_frequency'
 
-    def get_data(self, options):
-        graphs_and_axes = self.generate_graphs_and_axes(self.events.keys())
-        data = self.get_graph_data(options)
-        self.chart_settings['valueAxes'] = graphs_and_axes['axes']
-        self.chart_settings['graphs'] = graphs_and_axes['graphs']
-        self.chart_settings['dataProvider'] = data
-        self.chart_settings['legend'] = None
-        self.chart_settings['categoryAxis']['parseDates'] = False
-        return {'chart_settings': self.chart_settings}
-
-
-class PurchaseFrequencyChart(Chart):
     def __init__(self):
         super(PurchaseFrequencyChart, self).__init__()
         self.events = {
             'purchase_frequency': {'name': 'purchase_frequency', 'verbose_name': 'Purchase frequency', 'color': '#258cbb'},
         }
 
-    def get_graph_data(self, options):
-        period_start = options['period_start']
-        period_end = options['period_end']
-        date_list = [period_start.date() + datetime.timedelta(days=x) for x
-                     in xrange((period_end - period_start).days + 1)]
-        data_by_weeks = {}
+    def get_week_value(self, row):
+        return round(float(row['orders']) / row['customers'], 2) if row['customers'] else 0
 
-        for id_grp, grp in itertools.groupby(date_list, key=lambda x: x.isocalendar()[:2]):
-            current_week = list(grp)
-            data_by_weeks[id_grp] = {'start': min(current_week), 'end': max(current_week)}
 
-        data = []
-        for isoweek, values in sorted(data_by_weeks.items(), key=lambda x: (x[0], x[1])):
-            week_orders = LeadOrder.objects(
-                site=DBRef('sites', options['site_id']),
-                time_added__gte=datetime.datetime.combine(values['start'], datetime.datetime.min.time()),
-                time_added__lte=datetime.datetime.combine(values['end'], datetime.datetime.max.time())
-            )
+class PaidOrdersRateChart(KPIChart):
+    kpi = 'paid_orders_rate'
 
-            solvent_leads = week_orders.no_dereference().values_list('lead')
-            solvent_multileads = Lead.objects(
-                id__in=[x.id for x in solvent_leads]
-            ).no_dereference().scalar('multilead', 'id')
-            solvent_multileads = {x[0] if x[0] else x[1] for x in solvent_multileads}
-            week_unique_customers = len(solvent_multileads)
-            week_orders_number = week_orders.count()
+    def __init__(self):
+        super(PaidOrdersRateChart, self).__init__()
+        self.events = {
+            'paid_orders_rate': {'name': 'paid_orders_rate', 'verbose_name': 'Paid orders rate', 'color': '#258cbb'},
+        }
 
-            data.append({
-                'date': values['start'].strftime('%d.%m') + '-' + values['end'].strftime('%d.%m'),
-                'purchase_frequency': round(
-                    float(week_orders_number) / week_unique_customers, 2
-                ) if week_unique_customers else 0
-            })
+    def get_week_value(self, row):
+        return round(float(row['paid_orders']) / row['orders'] * 100, 2) if row['orders'] else 0
 
-        return data
-
-    def get_data(self, options):
-        graphs_and_axes = self.generate_graphs_and_axes(self.events.keys())
-        data = self.get_graph_data(options)
-        self.chart_settings['valueAxes'] = graphs_and_axes['axes']
-        self.chart_settings['graphs'] = graphs_and_axes['graphs']
-        self.chart_settings['dataProvider'] = data
-        self.chart_settings['legend'] = None
-        self.chart_settings['categoryAxis']['parseDates'] = False
-        return {'chart_settings': self.chart_settings}
 
+class RepeatCustomerRateChart(KPIChart):
+    kpi = 'rcr'
 
-class PaidOrdersRateChart(Chart):
     def __init__(self):
-        super(PaidOrdersRateChart, self).__init__()
+        super(RepeatCustomerRateChart, self).__init__()
         self.events = {
-            'paid_orders_rate': {'name': 'paid_orders_rate', 'verbose_name': 'Paid orders rate', 'color': '#258cbb'},
+            'rcr': {'name': 'rcr', 'verbose_name': 'Repeat customer rate', 'color': '#258cbb'},
         }
 
-    def get_graph_data(self, options):
-        period_start = options['period_start']
-        period_end = options['period_end']
-        date_list = [period_start.date() + datetime.timedelta(days=x) for x
-                     in xrange((period_end - period_start).days + 1)]
-        data_by_weeks = {}
+    def get_week_value(self, row):
+        return round(float(row['repeat_customers']) / row['customers'] * 100, 2) if row['customers'] else 0
 
-        for id_grp, grp in itertools.groupby(date_list, key=lambda x: x.isocalendar()[:2]):
-            current_week = list(grp)
-            data_by_weeks[id_grp] = {'start': min(current_week), 'end': max(current_week)}
 
-        data = []
-        for isoweek, values in sorted(data_by_weeks.items(), key=lambda x: (x[0], x[1])):
-            week_orders = LeadOrder.objects(
-                site=DBRef('sites', options['site_id']),
-                time_added__gte=datetime.datetime.combine(values['start'], datetime.datetime.min.time()),
-                time_added__lte=datetime.datetime.combine(values['end'], datetime.datetime.max.time())
-            )
-            week_orders_number = week_orders.count()
+KPI_CHARTS = {
+    'arpv': AverageRevenuePerVisitorChart,
+    'arpu': AverageRevenuePerUserChart,
+    'arppu': AverageRevenuePerPayingUserChart,
+    'car': CartAbandonmentRateChart,
+    'average_check': AverageCheckChart,
+    'purchase_frequency': PurchaseFrequencyChart,
+    'paid_orders_rate': PaidOrdersRateChart,
+    'rcr': RepeatCustomerRateChart
+}
 
-            data.append({
-                'date': values['start'].strftime('%d.%m') + '-' + values['end'].strftime('%d.%m'),
-                'paid_orders_rate': round(
-                    float(week_orders(status='paid').count()) / week_orders_number * 100, 2
-                ) if week_orders_number else 0
-            })
 
+def get_partial_period_options(options):
+    """
+        Keeps the most recent part of the period only. Returns None for options having no explicit dates.
+    """
+    for start_field, end_field in (('start', 'end'), ('period_start', 'period_end')):
+        start, end = options.get(start_field), options.get(end_field)
+        if isinstance(start, datetime.datetime) and isinstance(end, datetime.datetime) and end - start > PARTIAL_PERIOD:
+            options = copy.copy(options)
+            options[start_field] = end - PARTIAL_PERIOD
+            return options
+    return None
+
+
+def get_chart_data(chart, options, result_key=None):
+    """
+        Computes a chart within its time budget. When the budget is exceeded, the chart is computed again with
+        its degraded options (e.g. for a part of the period) and the result is marked as 'degraded'.
+        Has to be used by the analytics tasks instead of calling 'get_data' directly.
+    """
+    time_budget_ms = getattr(chart, 'time_budget_ms', budget.CHART_TIME_BUDGET_MS)
+    attempts = [options]
+    degraded_options = chart.get_degraded_options(options)
+    if degraded_options is not None:
+        attempts.append(degraded_options)
+
+    for attempt in attempts:
+        # get_data modifies the chart settings, every attempt starts from the pristine ones
+        attempt_chart = copy.copy(chart)
+        attempt_chart.chart_settings = copy.deepcopy(chart.chart_settings)
+        try:
+            with budget.query_budget(time_budget_ms, result_key), analytics_db.primary_reads(chart.read_primary):
+                data = attempt_chart.get_data(attempt)
+        except ExecutionTimeout:
+            continue
+        except (budget.ChartAbandoned, OperationFailure) as e:
+            if isinstance(e, OperationFailure) and e.code != QUERY_INTERRUPTED:
+                raise
+            return {'status': 'error', 'abandoned': True}
+
+        if attempt is not options:
+            data['degraded'] = True
         return data
 
-    def get_data(self, options):
-        graphs_and_axes = self.generate_graphs_and_axes(self.events.keys())
-        data = self.get_graph_data(options)
-        self.chart_settings['valueAxes'] = graphs_and_axes['axes']
-        self.chart_settings['graphs'] = graphs_and_axes['graphs']
-        self.chart_settings['dataProvider'] = data
-        self.chart_settings['legend'] = None
-        self.chart_settings['categoryAxis']['parseDates'] = False
-        return {'chart_settings': self.chart_settings}
+    return {
+        'status': 'error',
+        'degraded': True,
+        'errors': {ugettext(u'Период'): [ugettext(u'Расчет занимает слишком много времени, выберите период короче')]}
+    }
 
 
-class RepeatCustomerRateChart(Chart):
-    def __init__(self):
-        super(RepeatCustomerRateChart, self).__init__()
-        self.events = {
-            'rcr': {'name': 'rcr', 'verbose_name': 'Repeat customer rate', 'color': '#258cbb'},
-        }
+def iter_export_rows(chart, options):
+    """
+        Yields the export rows of a chart within the export time budget, a query running out of it raises
+        ExecutionTimeout. Charts without a cursor based export_rows compute their whole series before the first row.
+    """
+    time_budget_ms = getattr(chart, 'export_time_budget_ms', budget.EXPORT_TIME_BUDGET_MS)
+    with budget.query_budget(time_budget_ms), analytics_db.primary_reads(chart.read_primary):
+        for row in chart.export_rows(options):
+            yield row
 
-    def get_rcr_data(self, options):
-        period_start = options['period_start']
-        period_end = options['period_end']
-        date_list = [period_start.date() + datetime.timedelta(days=x) for x
-                       in xrange((period_end - period_start).days + 1)]
-        data_by_weeks = {}
 
-        for id_grp, grp in itertools.groupby(date_list, key=lambda x: x.isocalendar()[:2]):
-            current_week = list(grp)
-            data_by_weeks[id_grp] = {'start': min(current_week), 'end': max(current_week)}
+DASHBOARD_GRAPHS = ('visits', 'sales_funnel', 'sales_bar', 'recommendations', 'emails', 'leads_discovery')
 
-        data = []
-        for isoweek, values in sorted(data_by_weeks.items(), key=lambda x: (x[0], x[1])):
-            solvent_leads = LeadOrder.objects(
-                site=DBRef('sites', options['site_id']),
-                time_added__gte=datetime.datetime.combine(values['start'], datetime.datetime.min.time()),
-                time_added__lte=datetime.datetime.combine(values['end'], datetime.datetime.max.time())
-            ).no_dereference().values_list('lead')
-            solvent_multileads = Lead.objects(
-                id__in=[x.id for x in solvent_leads]
-            ).no_dereference().values_list('multilead', 'id')
-            solvent_multileads = {x[1]: x[0] if x[0] else x[1] for x in solvent_multileads}
-
-            solvent_multileads_counter = {}
-            for lead in solvent_leads:
-                multilead = solvent_multileads[lead.id]
-                solvent_multileads_counter[multilead] = solvent_multileads_counter.get(multilead, 0) + 1
-
-            total_solvent_multileads = len(solvent_multileads_counter)
-            total_repeat_multileads = len(
-                [value for value in solvent_multileads_counter.values() if value > 1]
-            )
 
-            data.append({
-                'date': values['start'].strftime('%d.%m') + '-' + values['end'].strftime('%d.%m'),
-                'rcr': round(
-                    float(total_repeat_multileads) / total_solvent_multileads * 100, 2
-                ) if total_solvent_multileads else 0
-            })
+def get_dashboard_chart(graph, site_id, queries=None):
+    if graph == 'visits':
+        return VisitsChart()
+    if graph == 'sales_funnel':
+        return SalesFunnelChart(site_id=site_id, queries=queries)
+    if graph == 'sales_bar':
+        return SalesBarChart(site_id=site_id, queries=queries)
+    if graph == 'recommendations':
+        return RecommendationsChart(queries=queries)
+    if graph == 'emails':
+        return EmailDynamicsChart()
+    if graph == 'leads_discovery':
+        return LeadsDiscoveryChart()
 
-        return data
 
-    def get_data(self, options):
-        graphs_and_axes = self.generate_graphs_and_axes(self.events.keys())
-        data = self.get_rcr_data(options)
-        self.chart_settings['valueAxes'] = graphs_and_axes['axes']
-        self.chart_settings['graphs'] = graphs_and_axes['graphs']
-        self.chart_settings['dataProvider'] = data
-        self.chart_settings['legend'] = None
-        self.chart_settings['categoryAxis']['parseDates'] = False
-        return {'chart_settings': self.chart_settings}
+def is_cooperative():
+    """
+        True in gevent workers (celery -P gevent), where waiting on Mongo and Redis switches to other greenlets.
+    """
+    return Pool is not None and monkey.is_module_patched('socket')
+
+
+def get_chart_data_by_item(item):
+    chart, options, result_key = item
+    try:
+        return result_key, get_chart_data(chart, options, result_key)
+    except Exception:
+        # the other charts of the batch go on, the slot of the batch is released with the last of its results
+        logger.exception('Dashboard chart %s failed', type(chart).__name__)
+        return result_key, {'status': 'error'}
+
+
+def get_dashboard_data(batch):
+    """
+        Computes a dashboard batch: a list of (chart, options, result_key) whose charts share one DashboardQueries.
+        Yields (result_key, data) as soon as each chart is computed, so the results can be published one by one.
+        A chart failing yields an error result, every result key of the batch gets one.
+        In gevent workers the charts are computed concurrently, otherwise one after another.
+    """
+    if not is_cooperative():
+        for item in batch:
+            yield get_chart_data_by_item(item)
+        return
+
+    pool = Pool(CHART_CONCURRENCY)
+    for result in pool.imap_unordered(get_chart_data_by_item, batch):
+        yield result
+
+
+def get_shop_metrics_data(site_id, period_start, period_end):
+    """
+        Returns {kpi: [{'date': ..., kpi: value}, ...]} for all KPI charts computed from a single KPI cube.
+    """
+    options = {'site_id': site_id, 'period_start': period_start, 'period_end': period_end}
+    return {kpi: chart().get_kpi_data(options) for kpi, chart in KPI_CHARTS.items()}
 
 
 def replace_period_with_dates(options):
@@ -0,0 +1,135 @@
+# coding: utf-8
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from pymongo import MongoClient, uri_parser
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from redis import StrictRedis
+
+# Redis used by analytics for its own data structures (identity maps, locks etc.)
+redis = StrictRedis.from_url(settings.ANALYTICS_REDIS_URL)
+
+# Deletes the key only if it still holds the given value
+_DELETE_IF_EQUALS = redis.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+
+def delete_if_equals(key, value):
+    """
+        Releases a lock or a claim only if it is still the caller's, it may have expired and been taken by another.
+    """
+    return _DELETE_IF_EQUALS(keys=[key], args=[value])
+
+
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def get_analytics_read_preference():
+    mode = getattr(settings, 'ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')
+    if mode == 'primary':
+        return Primary()
+    # staleness can't be lower than 90 seconds
+    return READ_PREFERENCES[mode](
+        tag_sets=getattr(settings, 'ANALYTICS_READ_TAGS', None),
+        max_staleness=getattr(settings, 'ANALYTICS_MAX_STALENESS_SECONDS', 120)
+    )
+
+
+def get_analytics_database():
+    """
+        With ANALYTICS_MONGO_URI set, analytics get a client of their own: a pool sized for long aggregations that
+        doesn't compete with the tracker for connections. The URI may point straight at a hidden analytics member.
+        Otherwise the main client is reused with the analytics read preference.
+    """
+    read_preference = get_analytics_read_preference()
+    uri = getattr(settings, 'ANALYTICS_MONGO_URI', None)
+    if not uri:
+        return settings.DB.with_options(read_preference=read_preference)
+
+    client = MongoClient(
+        uri,
+        maxPoolSize=getattr(settings, 'ANALYTICS_MONGO_POOL_SIZE', 20),
+        socketTimeoutMS=None,
+        # the client is created at import time, before the workers fork
+        connect=False
+    )
+    return client.get_database(settings.DB.name, read_preference=read_preference)
+
+
+_member_clients = {}
+_member_clients_lock = threading.Lock()
+
+
+def get_member_options():
+    """
+        Connection options (credentials etc.) of the direct connections to the members.
+        Taken from ANALYTICS_MONGO_URI or, when analytics share the main client, from ANALYTICS_MONGO_MEMBER_OPTIONS.
+    """
+    uri = getattr(settings, 'ANALYTICS_MONGO_URI', None)
+    if not uri:
+        return dict(getattr(settings, 'ANALYTICS_MONGO_MEMBER_OPTIONS', {}))
+
+    parsed = uri_parser.parse_uri(uri)
+    # a direct connection mustn't look for the rest of the replica set
+    options = {key.lower(): value for key, value in parsed['options'].items()
+               if key.lower() not in ('replicaset', 'readpreference', 'readpreferencetags', 'maxstalenessseconds')}
+    if parsed['username']:
+        options.update(username=parsed['username'], password=parsed['password'])
+        options.setdefault('authsource', parsed['database'] or 'admin')
+    return options
+
+
+def get_member_client(address):
+    """
+        Direct client to a single member, for the commands that only see the member they run on (currentOp, killOp).
+    """
+    with _member_clients_lock:
+        if address not in _member_clients:
+            host, port = address
+            _member_clients[address] = MongoClient(host, port, connect=False, **get_member_options())
+        return _member_clients[address]
+
+
+class QueryRouter(object):
+    """
+        Database proxy for analytics reads. Queries go to the analytics members by default
+        and to the primary within 'primary_reads', for the charts that need to read their own writes.
+    """
+    def __init__(self, primary, analytics):
+        self.primary = primary
+        self.analytics = analytics
+        self._state = threading.local()
+
+    @property
+    def current(self):
+        return self.primary if getattr(self._state, 'primary', False) else self.analytics
+
+    def __getattr__(self, name):
+        return getattr(self.current, name)
+
+    def __getitem__(self, name):
+        return self.current[name]
+
+    @contextmanager
+    def primary_reads(self, enabled=True):
+        previous = getattr(self._state, 'primary', False)
+        self._state.primary = previous or enabled
+        try:
+            yield
+        finally:
+            self._state.primary = previous
+
+
+analytics_db = QueryRouter(settings.DB, get_analytics_database())
@@ -0,0 +1,52 @@
+# coding: utf-8
+import csv
+import json
+import datetime
+
+from django.http import StreamingHttpResponse
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class Echo(object):
+    """
+        File-like object returning what is written to it, lets csv.writer produce lines for a generator.
+    """
+    def write(self, value):
+        return value
+
+
+def to_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def iter_csv(rows, fields):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([to_csv_value(row.get(field)) for field in fields])
+
+
+def iter_ndjson(rows, fields):
+    for row in rows:
+        yield json.dumps({field: row.get(field) for field in fields}, default=str) + '\n'
+
+
+def streaming_export_response(rows, fields, export_format, filename):
+    """
+        Streams rows (an iterable of dicts) as CSV or NDJSON. Rows are serialized one by one
+        so that the export is never held in memory as a whole.
+    """
+    serializer = iter_csv if export_format == 'csv' else iter_ndjson
+    response = StreamingHttpResponse(serializer(rows, fields), content_type=EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(filename, export_format)
+    return response
@@ -0,0 +1,278 @@
+# coding: utf-8
+import datetime
+import itertools
+
+from django.conf import settings
+
+from bson import ObjectId
+from bson.dbref import DBRef
+from pymongo import ASCENDING, ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+from widgets.helpers import get_recommendations_widgets
+from analytics import budget
+from analytics.connections import redis
+from analytics.identity import resolve_customers
+
+db = settings.DB
+
+LH_FORM_ACTIONS = ('lh_dp', 'lh_banner', 'lh_banner_mobile')
+# Source documents processed per batch when the facts catch up
+FACTS_BATCH_SIZE = 1000
+# ObjectIds of concurrent writers aren't strictly increasing, a sync goes over the last ones again
+SYNC_OVERLAP = datetime.timedelta(minutes=5)
+
+
+def ensure_indexes():
+    db.multilead_first_forms.create_index([('site', ASCENDING), ('submitted_time', ASCENDING)])
+    # the facts catch up with the source collections in _id order
+    db.leads_filled_forms.create_index([('site', ASCENDING), ('_id', ASCENDING)])
+    db.lead_orders.create_index([('site', ASCENDING), ('_id', ASCENDING)])
+    db.order_facts.create_index([('site', ASCENDING), ('time_added', ASCENDING)])
+    db.order_facts.create_index([('lead', ASCENDING)])
+
+
+def is_leadhit_form(form):
+    return form.get('action') in LH_FORM_ACTIONS or bool(form.get('subscription'))
+
+
+def get_leadhit_forms_ids(site_id):
+    query = {
+        'site': DBRef('sites', site_id),
+        '$or': [{'action': {'$in': LH_FORM_ACTIONS}}, {'subscription': True}]
+    }
+    return set(form['_id'] for form in db.forms.find(query, {'_id': 1}))
+
+
+def record_form_submission(site_id, multilead_id, form_id, submitted_time, leadhit=None):
+    """
+        Keeps the first-touch form of a multilead in 'multilead_first_forms'.
+        The record gets replaced only by an earlier submission. Submissions get recorded by sync_first_forms,
+        form submission handlers may call it right away as well.
+    """
+    if leadhit is None:
+        leadhit = is_leadhit_form(db.forms.find_one({'_id': form_id}, {'action': 1, 'subscription': 1}) or {})
+    record = {
+        'site': DBRef('sites', site_id),
+        'multilead': DBRef('multileads', multilead_id),
+        'form': DBRef('forms', form_id),
+        'submitted_time': submitted_time,
+        'leadhit': leadhit,
+    }
+    try:
+        db.multilead_first_forms.update_one(
+            {'_id': multilead_id, 'submitted_time': {'$gt': submitted_time}},
+            {'$set': record},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # the multilead already has a record with an earlier (or the same) submission
+        pass
+
+
+def record_form_submissions(site_id, submissions, leadhit_forms_ids):
+    customers = resolve_customers(site_id, [submission['lead'].id for submission in submissions])
+    for submission in submissions:
+        lead_id = submission['lead'].id
+        multilead_id = customers.get(lead_id)
+        # leads having no multilead are their own customers and don't get a first-touch record
+        if multilead_id and multilead_id != lead_id:
+            form_id = submission['leadform'].id
+            record_form_submission(
+                site_id, multilead_id, form_id, submission['submitted_time'], leadhit=form_id in leadhit_forms_ids
+            )
+
+
+def sync_first_forms(site_id):
+    """
+        Records the form submissions of a site made since the previous sync into 'multilead_first_forms'.
+        The first sync of a site backfills all its submissions. Progress is saved after every batch,
+        so an interrupted sync resumes where it stopped.
+    """
+    site_id = ObjectId(site_id)
+    state = db.analytics_facts_state.find_one({'_id': site_id}, {'first_forms_last_id': 1}) or {}
+    query = {'site': DBRef('sites', site_id)}
+    if state.get('first_forms_last_id'):
+        query['_id'] = {'$gt': ObjectId.from_datetime(state['first_forms_last_id'].generation_time - SYNC_OVERLAP)}
+
+    submissions = budget.find(
+        db.leads_filled_forms, query, {'lead': 1, 'leadform': 1, 'submitted_time': 1}
+    ).sort('_id', ASCENDING).batch_size(FACTS_BATCH_SIZE)
+
+    leadhit_forms_ids = None
+    batch = []
+    for submission in itertools.chain(submissions, [None]):
+        if submission is not None and submission.get('lead') and submission.get('leadform'):
+            batch.append(submission)
+        if batch and (submission is None or len(batch) == FACTS_BATCH_SIZE):
+            if leadhit_forms_ids is None:
+                leadhit_forms_ids = get_leadhit_forms_ids(site_id)
+            record_form_submissions(site_id, batch, leadhit_forms_ids)
+            db.analytics_facts_state.update_one(
+                {'_id': site_id}, {'$set': {'first_forms_last_id': batch[-1]['_id']}}, upsert=True
+            )
+            batch = []
+
+
+def rebuild_first_forms(site_id):
+    """
+        Rebuilds 'multilead_first_forms' of a site from all of its 'leads_filled_forms'.
+    """
+    site_id = ObjectId(site_id)
+    db.multilead_first_forms.delete_many({'site': DBRef('sites', site_id)})
+    db.analytics_facts_state.update_one({'_id': site_id}, {'$unset': {'first_forms_last_id': 1}})
+    sync_first_forms(site_id)
+
+
+def get_store_managers_ids(site_id):
+    return [lead['_id'] for lead in db.leads.find({'site': DBRef('sites', site_id), 'status': 'manager'}, {'_id': 1})]
+
+
+def get_rec_clicks_times(orders, rec_widgets_ids, store_managers_ids):
+    """
+        Returns {visit ref: earliest recommendation widget click} for the visits of the orders.
+        Store managers' clicks don't count, as in SalesBarChart.
+    """
+    visits = list(set(order['lead_visit'] for order in orders if order.get('lead_visit')))
+    if not visits or not rec_widgets_ids:
+        return {}
+
+    pipeline = [
+        {
+            '$match': {
+                'visit': {'$in': visits},
+                'event_type': 'click',
+                'init_by': {'$in': list(rec_widgets_ids)},
+                'lead.$id': {'$nin': store_managers_ids}
+            }
+        },
+        {'$group': {'_id': '$visit', 'earliest_click_time': {'$min': '$time_added'}}}
+    ]
+    return {click['_id']: click['earliest_click_time'] for click in db.lead_events.aggregate(pipeline)}
+
+
+def get_order_fact(order, customers, rec_clicks_times):
+    iso_year, iso_week = order['time_added'].isocalendar()[:2]
+    lead_id = order['lead'].id if order.get('lead') else None
+    click_time = rec_clicks_times.get(order.get('lead_visit'))
+    return {
+        'site': order['site'],
+        'order_id': order.get('order_id'),
+        'time_added': order['time_added'],
+        'iso_year': iso_year,
+        'iso_week': iso_week,
+        'cart_sum': order.get('cart_sum') or 0,
+        'status': order.get('status'),
+        'lead': lead_id,
+        # an order of an unknown lead can't be tied to other orders, it is a customer of its own
+        'customer': customers.get(lead_id, lead_id) if lead_id else order['_id'],
+        'email': 'mass_email' in order or 'trigger_email' in order,
+        'recommendation': bool(click_time and click_time < order['time_added']),
+    }
+
+
+def record_order_facts(site_id, orders):
+    """
+        Upserts the 'order_facts' records of orders of a site: their ISO week, cart sum, status, the customer
+        (multilead id or lead id for leads having no multilead) and the attribution flags.
+    """
+    if not orders:
+        return
+
+    customers = resolve_customers(site_id, [order['lead'].id for order in orders if order.get('lead')])
+    rec_clicks_times = get_rec_clicks_times(
+        orders, get_recommendations_widgets(site_id).keys(), get_store_managers_ids(site_id)
+    )
+    db.order_facts.bulk_write([
+        ReplaceOne({'_id': order['_id']}, get_order_fact(order, customers, rec_clicks_times), upsert=True)
+        for order in orders
+    ], ordered=False)
+
+
+def record_order_fact(order_id):
+    """
+        Brings the 'order_facts' record of an order up to date, deletes it if the order is gone.
+        Queued when an order is saved or deleted (see analytics.signals).
+    """
+    order = db.lead_orders.find_one({'_id': order_id})
+    if not order:
+        db.order_facts.delete_one({'_id': order_id})
+        return
+    record_order_facts(order['site'].id, [order])
+
+
+def update_order_facts_customer(leads_ids, multilead_id):
+    """
+        Has to be called when leads get (re)assigned to a multilead, e.g. on merge.
+    """
+    db.order_facts.update_many({'lead': {'$in': list(leads_ids)}}, {'$set': {'customer': multilead_id}})
+
+
+def get_dirty_orders_key(site_id):
+    return 'analytics:dirty_orders:{}'.format(site_id)
+
+
+def mark_orders_dirty(site_id, orders_ids):
+    """
+        Has to be called by the writes changing or deleting orders without the documents (QuerySet.update,
+        raw updates): saved and deleted documents get their facts updated through the signals, created orders
+        get picked up by sync_order_facts whatever wrote them. The facts of the marked orders are updated
+        by the next sync.
+    """
+    if orders_ids:
+        redis.sadd(get_dirty_orders_key(site_id), *[str(order_id) for order_id in orders_ids])
+
+
+def sync_dirty_orders(site_id):
+    key = get_dirty_orders_key(site_id)
+    while True:
+        orders_ids = redis.spop(key, FACTS_BATCH_SIZE)
+        if not orders_ids:
+            break
+        orders_ids = [ObjectId(order_id) for order_id in orders_ids]
+        try:
+            orders = list(db.lead_orders.find({'_id': {'$in': orders_ids}}))
+            record_order_facts(site_id, orders)
+            found = set(order['_id'] for order in orders)
+            db.order_facts.delete_many({'_id': {'$in': [order_id for order_id in orders_ids if order_id not in found]}})
+        except Exception:
+            # left for the next sync
+            mark_orders_dirty(site_id, orders_ids)
+            raise
+
+
+def sync_order_facts(site_id):
+    """
+        Records the orders of a site created since the previous sync, whatever wrote them, and the orders
+        marked dirty (see mark_orders_dirty). The first sync of a site backfills all its orders. Progress is saved
+        after every batch, so an interrupted sync resumes where it stopped.
+    """
+    site_id = ObjectId(site_id)
+    state = db.analytics_facts_state.find_one({'_id': site_id}, {'order_facts_last_id': 1}) or {}
+    query = {'site': DBRef('sites', site_id)}
+    if state.get('order_facts_last_id'):
+        query['_id'] = {'$gt': ObjectId.from_datetime(state['order_facts_last_id'].generation_time - SYNC_OVERLAP)}
+
+    orders = budget.find(db.lead_orders, query).sort('_id', ASCENDING).batch_size(FACTS_BATCH_SIZE)
+    batch = []
+    for order in itertools.chain(orders, [None]):
+        if order is not None:
+            batch.append(order)
+        if batch and (order is None or len(batch) == FACTS_BATCH_SIZE):
+            record_order_facts(site_id, batch)
+            db.analytics_facts_state.update_one(
+                {'_id': site_id}, {'$set': {'order_facts_last_id': batch[-1]['_id']}}, upsert=True
+            )
+            batch = []
+
+    sync_dirty_orders(site_id)
+
+
+def rebuild_order_facts(site_id):
+    """
+        Rebuilds 'order_facts' of a site from all of its 'lead_orders'.
+    """
+    site_id = ObjectId(site_id)
+    db.order_facts.delete_many({'site': DBRef('sites', site_id)})
+    db.analytics_facts_state.update_one({'_id': site_id}, {'$unset': {'order_facts_last_id': 1}})
+    sync_order_facts(site_id)
@@ -0,0 +1,147 @@
+# coding: utf-8
+from django.conf import settings
+
+from bson import ObjectId
+from bson.dbref import DBRef
+
+from analytics import budget
+from analytics.connections import redis
+
+db = settings.DB
+
+# Number of leads resolved (or written) per Redis round trip
+IDENTITY_CHUNK_SIZE = 10000
+# A lead having no multilead may get one any moment, such entries are dropped that often
+SOLO_IDENTITIES_TTL = 60 * 60
+# Writes go to the map being rebuilt as well for that long at most
+IDENTITY_REBUILD_TIMEOUT = 60 * 60
+
+# KEYS: map, solo map, rebuild marker, map being rebuilt; ARGV: solo map ttl, then lead and customer pairs.
+# A lead is its own customer (solo) or a multilead's one, never both. While the map is being rebuilt the writes
+# go to the new map too, so that they aren't lost on its rename.
+_WRITE_IDENTITIES = redis.register_script("""
+local rebuilding = redis.call('exists', KEYS[3]) == 1
+for i = 2, #ARGV, 2 do
+    local lead, customer = ARGV[i], ARGV[i + 1]
+    if lead == customer then
+        redis.call('hset', KEYS[2], lead, customer)
+        redis.call('hdel', KEYS[1], lead)
+    else
+        redis.call('hset', KEYS[1], lead, customer)
+        redis.call('hdel', KEYS[2], lead)
+    end
+    if rebuilding then
+        redis.call('hset', KEYS[4], lead, customer)
+    end
+end
+if redis.call('ttl', KEYS[2]) == -1 then
+    redis.call('expire', KEYS[2], ARGV[1])
+end
+""")
+
+# KEYS: map, map being rebuilt, rebuild marker
+_REPLACE_IDENTITY_MAP = redis.register_script("""
+if redis.call('exists', KEYS[2]) == 1 then
+    redis.call('rename', KEYS[2], KEYS[1])
+else
+    redis.call('del', KEYS[1])
+end
+redis.call('del', KEYS[3])
+""")
+
+
+def get_identity_map_key(site_id):
+    return 'analytics:identity:{}'.format(site_id)
+
+
+def get_identity_keys(site_id):
+    """
+        Returns the keys of the map of leads having a multilead, of the expiring map of leads having none,
+        of the rebuild marker and of the map being rebuilt.
+    """
+    key = get_identity_map_key(site_id)
+    return [key, key + ':solo', key + ':rebuilding', key + ':rebuild']
+
+
+def _write_identities(site_id, identities):
+    """
+        identities is a list of (lead_id, customer_id) pairs. Ids are stored as 12 byte binaries to keep the hash compact.
+    """
+    keys = get_identity_keys(site_id)
+    for i in xrange(0, len(identities), IDENTITY_CHUNK_SIZE):
+        args = [SOLO_IDENTITIES_TTL]
+        for lead_id, customer_id in identities[i:i + IDENTITY_CHUNK_SIZE]:
+            args.extend((lead_id.binary, customer_id.binary))
+        _WRITE_IDENTITIES(keys=keys, args=args)
+
+
+def _load_identities(leads):
+    return [(lead['_id'], lead['multilead'].id if lead.get('multilead') else lead['_id']) for lead in leads]
+
+
+def set_leads_customer(site_id, leads_ids, customer_id):
+    """
+        Queued when a lead is saved (see analytics.signals), has to be called as well when leads get (re)assigned
+        to a multilead bypassing the documents, e.g. on merge by a queryset update.
+        customer_id is the multilead id or the lead id itself for a lead having no multilead.
+        On merge 'order_facts' have to be updated as well, see facts.update_order_facts_customer.
+    """
+    customer_id = ObjectId(customer_id)
+    _write_identities(site_id, [(ObjectId(lead_id), customer_id) for lead_id in leads_ids])
+
+
+def resolve_customers(site_id, leads_ids):
+    """
+        Maps leads ids to customers ids (multileads ids, or leads ids for leads having no multilead).
+        Leads missing from the identity map are resolved through 'leads' and added to the map.
+        Leads that don't exist are left out of the result.
+    """
+    key, solo_key = get_identity_keys(site_id)[:2]
+    leads_ids = list(set(leads_ids))
+
+    customers = {}
+    missing = []
+    for i in xrange(0, len(leads_ids), IDENTITY_CHUNK_SIZE):
+        chunk = leads_ids[i:i + IDENTITY_CHUNK_SIZE]
+        fields = [lead_id.binary for lead_id in chunk]
+        pipe = redis.pipeline()
+        pipe.hmget(key, fields)
+        pipe.hmget(solo_key, fields)
+        mapped, solo = pipe.execute()
+        for lead_id, customer_id, solo_id in zip(chunk, mapped, solo):
+            if customer_id is None:
+                customer_id = solo_id
+            if customer_id is None:
+                missing.append(lead_id)
+            else:
+                customers[lead_id] = ObjectId(customer_id)
+
+    if missing:
+        identities = _load_identities(budget.find(db.leads, {'_id': {'$in': missing}}, {'multilead': 1}))
+        _write_identities(site_id, identities)
+        customers.update(identities)
+
+    return customers
+
+
+def rebuild_identity_map(site_id):
+    """
+        Rebuilds the map of leads having a multilead from 'leads' and atomically replaces the current one.
+        Identities written meanwhile go to both maps and aren't overwritten by the rebuild.
+    """
+    key, _, marker_key, tmp_key = get_identity_keys(site_id)
+    redis.delete(tmp_key)
+    redis.setex(marker_key, IDENTITY_REBUILD_TIMEOUT, 1)
+
+    leads = db.leads.find(
+        {'site': DBRef('sites', site_id), 'multilead': {'$ne': None}}, {'multilead': 1}
+    ).batch_size(IDENTITY_CHUNK_SIZE)
+    pipe = redis.pipeline(transaction=False)
+    for i, (lead_id, customer_id) in enumerate(_load_identities(leads), 1):
+        # a lead already there has been written since the rebuild started, the leads read may be older
+        pipe.hsetnx(tmp_key, lead_id.binary, customer_id.binary)
+        if i % IDENTITY_CHUNK_SIZE == 0:
+            pipe.execute()
+    pipe.execute()
+
+    _REPLACE_IDENTITY_MAP(keys=[key, tmp_key, marker_key])
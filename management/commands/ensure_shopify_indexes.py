@@ -0,0 +1,11 @@
+# coding: utf-8
+from django.core.management.base import BaseCommand
+
+from analytics import shopify_feed
+
+
+class Command(BaseCommand):
+    help = 'Creates the indexes of the Shopify feed offers and of the shops the webhooks come from'
+
+    def handle(self, *args, **options):
+        shopify_feed.ensure_indexes()
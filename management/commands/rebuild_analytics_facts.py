@@ -0,0 +1,31 @@
+# coding: utf-8
+from django.core.management.base import BaseCommand
+
+from bson import ObjectId
+
+from accounts.models import Site
+from analytics import facts
+from analytics.identity import rebuild_identity_map
+
+
+class Command(BaseCommand):
+    help = 'Creates the analytics facts indexes and backfills the facts of the sites (all the active ones by default)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--site', action='append', dest='sites', default=[], help='Id of a site to backfill')
+
+    def handle(self, *args, **options):
+        facts.ensure_indexes()
+
+        if options['sites']:
+            sites_ids = [ObjectId(site_id) for site_id in options['sites']]
+        else:
+            sites_ids = [site.id for site in Site.objects(is_active=True).only('id')]
+
+        for site_id in sites_ids:
+            self.stdout.write('{}: identity map'.format(site_id))
+            rebuild_identity_map(site_id)
+            self.stdout.write('{}: multilead first forms'.format(site_id))
+            facts.rebuild_first_forms(site_id)
+            self.stdout.write('{}: order facts'.format(site_id))
+            facts.rebuild_order_facts(site_id)
@@ -0,0 +1,59 @@
+# coding: utf-8
+from bson import ObjectId
+from bson.dbref import DBRef
+
+
+def _get_raw(holder, field):
+    # raw documents are dicts, MongoEngine documents keep unresolved references in _data
+    if isinstance(holder, dict):
+        return holder.get(field)
+    return holder._data.get(field)
+
+
+def _set_raw(holder, field, value):
+    if isinstance(holder, dict):
+        holder[field] = value
+    else:
+        holder._data[field] = value
+
+
+def _to_id(value):
+    if value is None or isinstance(value, ObjectId):
+        return value
+    if isinstance(value, DBRef):
+        return value.id
+    if isinstance(value, dict):
+        return value.get('_id')
+    return value.pk
+
+
+def get_reference_id(holder, field):
+    """
+        Returns the id of the document referenced by holder's field without dereferencing it.
+        holder is a MongoEngine (embedded) document or a raw document.
+    """
+    return _to_id(_get_raw(holder, field))
+
+
+def prefetch_references(document_cls, holders, field, only=None):
+    """
+        Resolves the 'field' reference of every holder with a single query to document_cls collection
+        and attaches the fetched documents to the holders, so that accessing the field doesn't query the database.
+        References to missing documents stay unresolved.
+        Returns {id: document} of the fetched documents.
+    """
+    holders = [holder for holder in holders if get_reference_id(holder, field) is not None]
+    ids = set(get_reference_id(holder, field) for holder in holders)
+    if not ids:
+        return {}
+
+    queryset = document_cls.objects(id__in=list(ids))
+    if only:
+        queryset = queryset.only(*only)
+    documents = {document.pk: document for document in queryset}
+
+    for holder in holders:
+        document = documents.get(get_reference_id(holder, field))
+        if document is not None:
+            _set_raw(holder, field, document)
+    return documents
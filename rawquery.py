@@ -0,0 +1,23 @@
+# coding: utf-8
+from analytics import budget
+
+
+def raw_documents(queryset, *fields):
+    """
+        Runs a MongoEngine queryset with a projection of the given fields and returns raw documents (dicts keyed by
+        the db field names) without building Document objects. References stay DBRefs.
+        Runs within the current query budget, if any.
+    """
+    return budget.queryset(queryset.only(*fields).no_dereference().as_pymongo())
+
+
+def raw_values_list(queryset, *fields):
+    """
+        Raw counterpart of QuerySet.values_list: yields a tuple of values per document,
+        or a single value if a single field is requested.
+    """
+    document_fields = queryset._document._fields
+    db_fields = [document_fields[field].db_field for field in fields]
+    for document in raw_documents(queryset, *fields):
+        values = tuple(document.get(db_field) for db_field in db_fields)
+        yield values[0] if len(values) == 1 else values
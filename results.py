@@ -0,0 +1,143 @@
+# coding: utf-8
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from bson import DBRef, ObjectId
+
+from lib.helpers import generate_redis_result_key
+from analytics.connections import delete_if_equals, redis
+from analytics.budget import abandon_result
+from analytics.scheduling import release_task
+
+# How long a computed chart result stays available for the client, in seconds
+RESULT_TTL = getattr(settings, 'ANALYTICS_RESULT_TTL', 600)
+# How long an identical request keeps attaching to a running task. Expires the claim if the worker dies.
+INFLIGHT_TTL = getattr(settings, 'ANALYTICS_INFLIGHT_TTL', 300)
+
+# Request fields that don't affect the computed result
+IGNORED_REQUEST_FIELDS = ('csrfmiddlewaretoken', 'status')
+
+
+class RequestKeyEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # validated options carry the site as an ObjectId
+        if isinstance(o, (ObjectId, DBRef)):
+            return str(getattr(o, 'id', o))
+        return super(RequestKeyEncoder, self).default(o)
+
+
+def get_result_key(result_key):
+    return 'analytics:result:{}'.format(result_key)
+
+
+def get_result_channel(result_key):
+    return 'analytics:result_ready:{}'.format(result_key)
+
+
+def get_request_key(name, options):
+    options = {key: value for key, value in options.items() if key not in IGNORED_REQUEST_FIELDS}
+    normalized = json.dumps(options, cls=RequestKeyEncoder, sort_keys=True)
+    return 'analytics:inflight:{}:{}'.format(name, hashlib.md5(normalized).hexdigest())
+
+
+def get_request_ref_key(result_key):
+    return 'analytics:inflight_request:{}'.format(result_key)
+
+
+def claim_result_key(name, options):
+    """
+        Single-flight for chart tasks. Returns (result_key, created): created is False when an identical request
+        (same name and options) is already being computed, in which case the caller has to wait for its result key
+        instead of queueing a new task.
+    """
+    request_key = get_request_key(name, options)
+    while True:
+        result_key = generate_redis_result_key()
+        if redis.set(request_key, result_key, nx=True, ex=INFLIGHT_TTL):
+            redis.setex(get_request_ref_key(result_key), INFLIGHT_TTL, request_key)
+            return result_key, True
+
+        existing_key = redis.get(request_key)
+        # the claim may have expired or been released in between, try again then
+        if existing_key is not None:
+            return existing_key, False
+
+
+def publish_result(result_key, data, ttl=RESULT_TTL):
+    """
+        Stores the result of a chart task, notifies the clients waiting for it and releases the single-flight claim.
+        Has to be called by the analytics tasks once a result is computed.
+    """
+    payload = json.dumps(data, cls=DjangoJSONEncoder)
+    request_key = redis.get(get_request_ref_key(result_key))
+
+    pipe = redis.pipeline()
+    pipe.setex(get_result_key(result_key), ttl, payload)
+    pipe.publish(get_result_channel(result_key), payload)
+    pipe.delete(get_request_ref_key(result_key))
+    pipe.execute()
+    if request_key is not None:
+        # the claim may have expired and been taken by a newer computation in between
+        delete_if_equals(request_key, result_key)
+
+    release_task(result_key)
+
+
+def has_result(result_key):
+    return bool(redis.exists(get_result_key(result_key)))
+
+
+def get_results(result_keys):
+    """
+        Returns {result_key: json payload} for the results already computed.
+    """
+    payloads = redis.mget([get_result_key(result_key) for result_key in result_keys])
+    return {result_key: payload for result_key, payload in zip(result_keys, payloads) if payload is not None}
+
+
+def iter_results(result_keys, timeout, heartbeat=None):
+    """
+        Yields (result_key, json payload) for every result key as soon as its result is published, until all of
+        them are delivered or the timeout expires. If heartbeat is set, yields (None, None) every 'heartbeat' seconds
+        of silence so that the caller can keep its connection alive.
+    """
+    pending = set(result_keys)
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    # subscribe before reading the stored results, otherwise a result published in between would be lost
+    pubsub.subscribe(*[get_result_channel(result_key) for result_key in pending])
+    channels = {get_result_channel(result_key): result_key for result_key in pending}
+    try:
+        for result_key, payload in get_results(list(pending)).items():
+            pending.discard(result_key)
+            yield result_key, payload
+
+        deadline = time.time() + timeout
+        last_message = time.time()
+        while pending and time.time() < deadline:
+            message = pubsub.get_message(timeout=1)
+            if message is None:
+                if heartbeat and time.time() - last_message >= heartbeat:
+                    last_message = time.time()
+                    yield None, None
+                continue
+
+            last_message = time.time()
+            result_key = channels.get(message['channel'])
+            if result_key in pending:
+                pending.discard(result_key)
+                yield result_key, message['data']
+    finally:
+        pubsub.close()
+
+
+def abandon_results(result_keys):
+    """
+        Called when a client stops waiting for results. Computations nobody else is waiting for get stopped.
+    """
+    for result_key in result_keys:
+        if not redis.pubsub_numsub(get_result_channel(result_key))[0][1]:
+            abandon_result(result_key)
@@ -0,0 +1,222 @@
+# coding: utf-8
+import cPickle as pickle
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+
+from bson import ObjectId
+from bson.dbref import DBRef
+
+from analytics.connections import analytics_db, redis
+from analytics.utils.helpers import Period
+
+db = analytics_db
+
+# Relative cost of one day of data for a chart of an average site
+CHART_COSTS = {
+    'VisitsChart': 1,
+    'EmailDynamicsChart': 1,
+    'LeadsDiscoveryChart': 1,
+    'SalesBarChart': 2,
+    'RecommendationsChart': 2,
+    'SalesFunnelChart': 4,
+    'shop_metrics': 3,
+}
+# KPI charts and anything not listed
+DEFAULT_CHART_COST = 3
+
+# Lanes from the most to the least interactive: (queue, celery priority, max cost, running tasks allowed per site).
+# Workers have to consume each queue separately so that batch computations never hold the interactive workers.
+ANALYTICS_LANES = getattr(settings, 'ANALYTICS_LANES', (
+    ('analytics_interactive', 9, 50, 4),
+    ('analytics_default', 5, 1000, 2),
+    ('analytics_batch', 0, None, 1),
+))
+
+# Visits per 30 days of an average site, the site size factor is relative to it
+AVERAGE_SITE_VISITS = 10000
+SITE_SIZE_CACHE_TIMEOUT = 60 * 60 * 24
+# A task waiting in its queue holds its slot that long at most
+QUEUED_TASK_TTL = 30 * 60
+# A started task refreshes its slot while it runs (see refresh_task), a dead one frees it by then
+RUNNING_TASK_TTL = 2 * 60
+# Sites having tasks deferred because they reached their cap, in round-robin order
+DEFERRED_SITES_KEY = 'analytics:deferred_sites'
+
+
+def get_site_size_factor(site_id):
+    cache_key = 'analytics:site_size:{}'.format(site_id)
+    factor = cache.get(cache_key)
+    if factor is None:
+        visits = db.visits.count_documents({
+            'site': DBRef('sites', ObjectId(site_id)),
+            'start': {'$gte': datetime.now() - timedelta(days=30)}
+        })
+        factor = max(1, float(visits) / AVERAGE_SITE_VISITS)
+        cache.set(cache_key, factor, SITE_SIZE_CACHE_TIMEOUT)
+    return factor
+
+
+def get_period_days(options):
+    for start_field, end_field in (('start', 'end'), ('period_start', 'period_end')):
+        start, end = options.get(start_field), options.get(end_field)
+        if isinstance(start, datetime) and isinstance(end, datetime):
+            return max(1, (end - start).days + 1)
+
+    if options.get('period'):
+        period = Period.from_def_ranges(options['period'])
+        return max(1, (period.end - period.start).days + 1)
+    return 1
+
+
+def estimate_cost(name, options, site_id):
+    """
+        Estimated cost of a chart computation: chart weight x period length in days x site size.
+    """
+    return CHART_COSTS.get(name, DEFAULT_CHART_COST) * get_period_days(options) * get_site_size_factor(site_id)
+
+
+def get_running_tasks_key(site_id, queue):
+    return 'analytics:running:{}:{}'.format(site_id, queue)
+
+
+def get_running_tasks_count(site_id, queue):
+    key = get_running_tasks_key(site_id, queue)
+    redis.zremrangebyscore(key, '-inf', time.time())
+    return redis.zcard(key)
+
+
+def get_lane(site_id, cost):
+    """
+        Picks the lane by cost. A site already running as many tasks as its lane allows gets moved to the next,
+        less interactive lane, so that one site can't take all the workers of a lane.
+        Returns None when the site has reached its cap in every lane the task may go to.
+    """
+    for queue, priority, max_cost, site_limit in ANALYTICS_LANES:
+        if max_cost is not None and cost > max_cost:
+            continue
+        if get_running_tasks_count(site_id, queue) < site_limit:
+            return queue, priority
+    return None
+
+
+def get_deferred_tasks_key(site_id):
+    return 'analytics:deferred:{}'.format(site_id)
+
+
+def get_task_slot_key(result_key):
+    return 'analytics:task_slot:{}'.format(result_key)
+
+
+def get_slot_lane_key(slot):
+    return 'analytics:slot_lane:{}'.format(slot)
+
+
+def get_slot_pending_key(slot):
+    return 'analytics:slot_pending:{}'.format(slot)
+
+
+def start_task(signature, site_id, lane, result_keys):
+    queue, priority = lane
+    key = get_running_tasks_key(site_id, queue)
+
+    # results of a batch get published in completion order, the slot is released with the last one of them
+    slot = result_keys[0]
+    pipe = redis.pipeline()
+    pipe.zadd(key, {slot: time.time() + QUEUED_TASK_TTL})
+    pipe.setex(get_slot_lane_key(slot), QUEUED_TASK_TTL, key)
+    pipe.sadd(get_slot_pending_key(slot), *result_keys)
+    pipe.expire(get_slot_pending_key(slot), QUEUED_TASK_TTL)
+    for result_key in result_keys:
+        pipe.setex(get_task_slot_key(result_key), QUEUED_TASK_TTL, slot)
+    pipe.execute()
+
+    signature.apply_async(queue=queue, priority=priority)
+
+
+def schedule_task(task, args, kwargs, site_id, cost, result_keys):
+    """
+        Queues an analytics task into its lane and counts it as running for the site until all its results
+        get published. A task publishing several results (a dashboard batch) holds a single slot.
+        A site having reached its cap in every lane gets the task deferred until one of its tasks is done.
+    """
+    signature = task.signature(args, kwargs)
+    lane = get_lane(site_id, cost)
+    if lane is None:
+        # the slots of dead tasks may have expired since the last dispatch, the earlier tasks start first
+        dispatch_deferred()
+        deferred = pickle.dumps((signature, cost, result_keys), pickle.HIGHEST_PROTOCOL)
+        # the site joins the round-robin with its first deferred task
+        if redis.rpush(get_deferred_tasks_key(site_id), deferred) == 1:
+            redis.rpush(DEFERRED_SITES_KEY, str(site_id))
+        return
+    start_task(signature, site_id, lane, result_keys)
+
+
+def dispatch_deferred():
+    """
+        Starts the deferred tasks of the sites that are below their cap again, one task per site in turn so that
+        a site with many deferred tasks doesn't hold back the others. Runs whenever a slot is released and has to be
+        scheduled periodically as well: the slots of dead tasks expire without a release.
+    """
+    for _ in range(redis.llen(DEFERRED_SITES_KEY)):
+        site_id = redis.lpop(DEFERRED_SITES_KEY)
+        if site_id is None:
+            break
+
+        key = get_deferred_tasks_key(site_id)
+        deferred = redis.lindex(key, 0)
+        if deferred is None:
+            continue
+        signature, cost, result_keys = pickle.loads(deferred)
+        lane = get_lane(site_id, cost)
+        # another dispatcher may have started it in between
+        if lane is not None and redis.lrem(key, 1, deferred):
+            start_task(signature, site_id, lane, result_keys)
+        # back to the end of the round while it has tasks left
+        if redis.llen(key):
+            redis.rpush(DEFERRED_SITES_KEY, site_id)
+
+
+def refresh_task(result_key):
+    """
+        Keeps the slot of a running task for another RUNNING_TASK_TTL. Called by the task while it computes.
+    """
+    slot = redis.get(get_task_slot_key(result_key))
+    key = slot and redis.get(get_slot_lane_key(slot))
+    if key is None:
+        return
+
+    result_keys = redis.smembers(get_slot_pending_key(slot))
+    pipe = redis.pipeline()
+    # a slot already released or expired is not taken again
+    pipe.zadd(key, {slot: time.time() + RUNNING_TASK_TTL}, xx=True)
+    for mapping_key in [get_slot_lane_key(slot), get_slot_pending_key(slot)] + map(get_task_slot_key, result_keys):
+        pipe.expire(mapping_key, QUEUED_TASK_TTL)
+    pipe.execute()
+
+
+def release_task(result_key):
+    """
+        Marks the result key as published. Once all the results of its task are, the task stops counting
+        as running for the site. Called once a result is published.
+    """
+    slot = redis.get(get_task_slot_key(result_key))
+    if slot is None:
+        return
+
+    pipe = redis.pipeline()
+    pipe.srem(get_slot_pending_key(slot), result_key)
+    pipe.scard(get_slot_pending_key(slot))
+    pipe.delete(get_task_slot_key(result_key))
+    pending = pipe.execute()[1]
+    if pending:
+        return
+
+    key = redis.get(get_slot_lane_key(slot))
+    if key is not None:
+        redis.zrem(key, slot)
+    redis.delete(get_slot_lane_key(slot), get_slot_pending_key(slot))
+    dispatch_deferred()
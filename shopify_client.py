@@ -0,0 +1,176 @@
+# coding: utf-8
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+import requests
+
+shopify_logger = logging.getLogger('shopify.request')
+
+SHOPIFY_API_VERSION = getattr(settings, 'SHOPIFY_API_VERSION', '2020-01')
+# Maximum page size of the Shopify REST API
+SHOPIFY_PAGE_SIZE = 250
+# Calls left free in the bucket for the other clients of the shop (e.g. the tracker installation)
+BUCKET_MARGIN = 2
+MAX_RETRIES = 5
+# Methods safe to repeat after a server error or a lost connection, the request may have been carried out
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+BACKOFF_SECONDS = 1
+REQUEST_TIMEOUT = 60
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class ShopifyAPIError(Exception):
+    def __init__(self, response):
+        super(ShopifyAPIError, self).__init__('{} {}: {}'.format(response.status_code, response.url, response.text[:500]))
+        self.response = response
+
+
+class CallBucket(object):
+    """
+        Client side model of a shop's leaky bucket (X-Shopify-Shop-Api-Call-Limit): requests wait
+        for the bucket to leak instead of being throttled with 429.
+    """
+    def __init__(self, size=40):
+        self.size = size
+        self.used = 0
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    @property
+    def leak_rate(self):
+        # 40 calls bucket leaks 2 calls a second, the 80 calls one of Shopify Plus leaks 4
+        return self.size / 20.0
+
+    def get_level(self, now):
+        return max(0, self.used - (now - self.updated) * self.leak_rate)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                level = self.get_level(now)
+                if level + 1 <= self.size - BUCKET_MARGIN:
+                    self.used = level + 1
+                    self.updated = now
+                    return
+                wait = (level + 1 - (self.size - BUCKET_MARGIN)) / self.leak_rate
+            time.sleep(wait)
+
+    def update(self, header):
+        used, size = [int(value) for value in header.split('/')]
+        with self.lock:
+            self.used = used
+            self.size = size
+            self.updated = time.time()
+
+
+def get_bucket(shop):
+    with _buckets_lock:
+        if shop not in _buckets:
+            _buckets[shop] = CallBucket()
+        return _buckets[shop]
+
+
+class ShopifyClient(object):
+    """
+        Shopify REST Admin API client sharing the call bucket of the shop between threads.
+        Retries throttled and failed requests with backoff, pages with cursors and runs independent
+        requests concurrently within the bucket. 'base_url' allows to point it at a local stub server.
+    """
+    def __init__(self, shop, access_token, base_url=None, max_workers=4):
+        self.shop = shop
+        self.base_url = base_url or 'https://{}/admin/api/{}'.format(shop, SHOPIFY_API_VERSION)
+        self.bucket = get_bucket(shop)
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        self.session.headers.update({'X-Shopify-Access-Token': access_token, 'Accept': 'application/json'})
+
+    def get_url(self, path):
+        return '{}/{}.json'.format(self.base_url, path)
+
+    def send(self, method, url, **kwargs):
+        """
+            Throttled requests are retried whatever the method, server errors and connection failures
+            only for the idempotent ones: a POST may have created its resource before failing.
+        """
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        for attempt in range(MAX_RETRIES + 1):
+            self.bucket.acquire()
+            try:
+                response = self.session.request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+            except requests.ConnectTimeout:
+                # the request never reached the shop
+                if attempt == MAX_RETRIES:
+                    raise
+                time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+                continue
+            except requests.RequestException:
+                if attempt == MAX_RETRIES or not idempotent:
+                    raise
+                time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+                continue
+
+            if response.headers.get('X-Shopify-Shop-Api-Call-Limit'):
+                self.bucket.update(response.headers['X-Shopify-Shop-Api-Call-Limit'])
+
+            if response.status_code == 429 or (response.status_code >= 500 and idempotent):
+                if attempt == MAX_RETRIES:
+                    raise ShopifyAPIError(response)
+                retry_after = response.headers.get('Retry-After')
+                time.sleep(float(retry_after) if retry_after else BACKOFF_SECONDS * 2 ** attempt)
+                continue
+
+            if response.status_code >= 400:
+                shopify_logger.warning('%s %s: %s', method, url, response.text[:500])
+                raise ShopifyAPIError(response)
+            return response
+
+    def request(self, method, path, params=None, data=None):
+        response = self.send(method, self.get_url(path), params=params, json=data)
+        return response.json() if response.content else {}
+
+    def get(self, path, **params):
+        return self.request('GET', path, params=params)
+
+    def post(self, path, data):
+        return self.request('POST', path, data=data)
+
+    def put(self, path, data):
+        return self.request('PUT', path, data=data)
+
+    def iter_pages(self, path, key, **params):
+        """
+            Yields the pages of a list endpoint, following the cursors of the Link header.
+        """
+        params.setdefault('limit', SHOPIFY_PAGE_SIZE)
+        response = self.send('GET', self.get_url(path), params=params)
+        while True:
+            yield response.json()[key]
+            next_link = response.links.get('next')
+            if not next_link:
+                break
+            response = self.send('GET', next_link['url'])
+
+    def iter_all(self, path, key, **params):
+        for page in self.iter_pages(path, key, **params):
+            for record in page:
+                yield record
+
+    def get_all(self, path, key, **params):
+        return list(self.iter_all(path, key, **params))
+
+    def run_concurrently(self, calls):
+        """
+            Runs independent calls ((function, args) pairs) concurrently, returns their results in order.
+        """
+        pool = ThreadPool(min(self.max_workers, len(calls)) or 1)
+        try:
+            return pool.map(lambda call: call[0](*call[1]), calls)
+        finally:
+            pool.close()
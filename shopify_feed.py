@@ -0,0 +1,530 @@
+# coding: utf-8
+import copy
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.cache import cache
+
+from celery import shared_task
+from lxml import etree
+from pymongo import ASCENDING
+import requests
+
+from accounts.models import Site
+from analytics.shopify_client import ShopifyAPIError, ShopifyClient
+
+db = settings.DB
+shopify_logger = logging.getLogger('shopify.request')
+
+# Smart collection rule columns on variants and the variant fields they check
+SMART_COLLECTION_VARIANT_FIELDS = {
+    'variant_price': 'price',
+    'variant_compare_at_price': 'compare_at_price',
+    'variant_weight': 'weight',
+    'variant_inventory': 'inventory_quantity',
+    'variant_title': 'title',
+}
+# Products updated that long before the previous sync started get fetched again
+SYNC_OVERLAP = datetime.timedelta(minutes=5)
+
+# Changing it makes the next sync rebuild the saved offers of every product
+FRAGMENTS_FORMAT = 2
+# Generate the compact feeds in the background instead of the full ones, for importers supporting them
+COMPACT_FEEDS = getattr(settings, 'SHOPIFY_COMPACT_FEEDS', False)
+
+# Pre-generated feeds served by FakeYMLView
+FEEDS_DIR = getattr(settings, 'SHOPIFY_FEEDS_DIR', os.path.join(settings.MEDIA_ROOT, 'shopify_feeds'))
+FEED_READ_CHUNK_SIZE = 64 * 1024
+# A feed asked for before it exists is queued once per that many seconds
+FEED_GENERATION_TIMEOUT = 10 * 60
+
+
+def get_catalog(client):
+    """
+        Returns (shop, custom collections, smart collections, collections_ids), everything needed to build
+        the offers of a product. Custom collections are keyed by id. The requests are made concurrently.
+    """
+    shop, custom_collections, smart_collections, collects = client.run_concurrently([
+        (client.get, ('shop',)),
+        (client.get_all, ('custom_collections', 'custom_collections')),
+        (client.get_all, ('smart_collections', 'smart_collections')),
+        (client.get_all, ('collects', 'collects')),
+    ])
+    custom_collections = {collection['id']: collection for collection in custom_collections}
+    return shop['shop'], custom_collections, smart_collections, get_custom_collections_ids(collects)
+
+
+def get_custom_collections_ids(collects):
+    """
+        Maps products ids to the ids of the custom collections they belong to.
+    """
+    collections_ids = {}
+    for collect in collects:
+        collections_ids.setdefault(collect['product_id'], []).append(collect['collection_id'])
+    return collections_ids
+
+
+def match_rule_value(value, relation, condition):
+    if value is None:
+        return False
+    if relation in ('greater_than', 'less_than'):
+        try:
+            value, condition = float(value), float(condition)
+        except (TypeError, ValueError):
+            return False
+        return value > condition if relation == 'greater_than' else value < condition
+
+    # smart collection conditions are case insensitive
+    value, condition = unicode(value).lower(), unicode(condition).lower()
+    if relation == 'equals':
+        return value == condition
+    if relation == 'not_equals':
+        return value != condition
+    if relation == 'starts_with':
+        return value.startswith(condition)
+    if relation == 'ends_with':
+        return value.endswith(condition)
+    if relation == 'contains':
+        return condition in value
+    if relation == 'not_contains':
+        return condition not in value
+    return False
+
+
+def get_rule_values(product, column):
+    if column == 'title':
+        return [product.get('title')]
+    if column == 'type':
+        return [product.get('product_type')]
+    if column == 'vendor':
+        return [product.get('vendor')]
+    if column == 'tag':
+        return [tag.strip() for tag in (product.get('tags') or '').split(',') if tag.strip()]
+    if column.startswith('variant_'):
+        field = SMART_COLLECTION_VARIANT_FIELDS.get(column)
+        return [variant.get(field) for variant in product['variants']] if field else []
+    return []
+
+
+def match_smart_collection(collection, product):
+    """
+        Evaluates the rules of a smart collection against a product, the way Shopify does:
+        a rule matches if any of the product values (tags, variants) matches it.
+    """
+    results = []
+    for rule in collection.get('rules') or []:
+        relation = rule['relation']
+        condition = rule['condition']
+        values = get_rule_values(product, rule['column'])
+        if relation in ('not_equals', 'not_contains'):
+            results.append(all(match_rule_value(value, relation, condition) for value in values))
+        else:
+            results.append(any(match_rule_value(value, relation, condition) for value in values))
+    if not results:
+        return False
+    return any(results) if collection.get('disjunctive') else all(results)
+
+
+def get_product_collections(product, custom_collections, smart_collections, collections_ids):
+    collections = [custom_collections[collection_id] for collection_id in collections_ids.get(product['id'], [])
+                   if collection_id in custom_collections]
+    collections.extend(collection for collection in smart_collections if match_smart_collection(collection, product))
+    return collections
+
+
+def get_product_offers(product, catalog):
+    """
+        Builds the compact offer elements of a product (see iter_offers).
+        Product memberships come from the collects and the smart collections rules, so no API call per collection.
+    """
+    shop, custom_collections, smart_collections, collections_ids = catalog
+    categories = get_product_collections(product, custom_collections, smart_collections, collections_ids)
+    return list(iter_offers(product, categories, shop['domain'], shop.get('currency') or 'USD'))
+
+
+def write_yml_file(output, shopify_shop, shop_categories, offers):
+    """
+        Writes the YML feed to the 'output' file incrementally: 'offers' may be a generator,
+        offers get written as soon as they are produced.
+    """
+    now = str(datetime.datetime.now()).rsplit(':', 1)[0]
+    currencyId = shopify_shop.get('currency') or 'USD'
+
+    with etree.xmlfile(output, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element('yml_catalog', date=now):
+            with xf.element('shop'):
+                # setup shop subelements 'name', 'company', 'url' and 'currency'
+                shop_name = etree.Element('name')
+                shop_name.text = shopify_shop.get('name')
+                xf.write(shop_name, pretty_print=True)
+                shop_company = etree.Element('company')
+                shop_company.text = shopify_shop.get('name')
+                xf.write(shop_company, pretty_print=True)
+                shop_url = etree.Element('url')
+                shop_url.text = 'https://' + shopify_shop['domain']
+                xf.write(shop_url, pretty_print=True)
+                shop_currencies = etree.Element('currencies')
+                etree.SubElement(shop_currencies, 'currency', id=currencyId)
+                xf.write(shop_currencies, pretty_print=True)
+
+                categories_tag = etree.Element('categories')
+                for category in shop_categories:
+                    cur_category = etree.SubElement(categories_tag, 'category', id=str(category['id']))
+                    cur_category.text = category['title']
+                etree.SubElement(categories_tag, 'category', id='Main')
+                xf.write(categories_tag, pretty_print=True)
+
+                with xf.element('offers'):
+                    for offer in offers:
+                        xf.write(offer, pretty_print=True)
+
+
+def iter_variant_offers(product, categories, shop_domain, currencyId):
+    """
+        Yields the offer fields of every variant of a product, with the plain product url.
+    """
+    picture = None
+    if product.get('image'):
+        picture = product['image']['src']
+        if '?v=' in picture:
+            picture = picture[:picture.find('?v=')]
+
+    for variant in product['variants']:
+        name = product['title'] if variant['title'] == 'Default Title' else product['title'] + ', ' + variant['title']
+        yield {
+            'id': str(variant['id']),
+            'parent_id': str(product['id']),
+            'available': bool(variant.get('inventory_quantity')),
+            'name': name,
+            'url': 'https://' + shop_domain + '/products/' + product['handle'],
+            'price': variant['price'],
+            'currencyId': currencyId,
+            'picture': picture,
+            'collections': [(str(category['id']), category['handle']) for category in categories],
+        }
+
+
+def iter_offer_urls(url, collections):
+    """
+        Yields the (url, categoryId) pairs a variant is offered with in the full feed: for every collection
+        the product url and the collection url of the product, both in that collection.
+    """
+    if not collections:
+        # offers with no category get assigned "Main" category
+        yield url, 'Main'
+        return
+
+    base_url, product_path = url.split('/products/', 1)
+    for collection_id, handle in collections:
+        yield url, collection_id
+        yield base_url + '/collections/' + handle + '/products/' + product_path, collection_id
+
+
+def iter_offers(product, categories, shop_domain, currencyId):
+    """
+        Yields the compact offers of a product: one per variant, with the plain product url, the first collection
+        as categoryId and all the collections of the product listed in <collections>.
+    """
+    for offer in iter_variant_offers(product, categories, shop_domain, currencyId):
+        available = 'true' if offer['available'] else 'false'
+        cur_product = etree.Element('offer', parent_id=offer['parent_id'], id=offer['id'], available=available)
+
+        for field in ('name', 'url', 'price', 'currencyId', 'picture'):
+            if offer[field] is not None:
+                etree.SubElement(cur_product, field).text = offer[field]
+
+        product_category = etree.SubElement(cur_product, 'categoryId')
+        if offer['collections']:
+            product_category.text = offer['collections'][0][0]
+            collections = etree.SubElement(cur_product, 'collections')
+            for collection_id, handle in offer['collections']:
+                etree.SubElement(collections, 'collection', id=collection_id, handle=handle)
+        else:
+            product_category.text = 'Main'
+
+        yield cur_product
+
+
+def expand_compact_offer(offer):
+    """
+        Turns a compact offer into the offers of the full feed (see iter_offer_urls).
+        Importers reading compact feeds use it to get the same offers as from full ones.
+    """
+    collections = offer.find('collections')
+    if collections is None:
+        yield offer
+        return
+
+    offer.remove(collections)
+    collections = [(collection.get('id'), collection.get('handle')) for collection in collections]
+    for url, category_id in iter_offer_urls(offer.findtext('url'), collections):
+        expanded = copy.deepcopy(offer)
+        expanded.find('url').text = url
+        expanded.find('categoryId').text = category_id
+        yield expanded
+
+
+def ensure_indexes():
+    db.shopify_offer_fragments.create_index([('site', ASCENDING), ('product_id', ASCENDING)], unique=True)
+    db.shopify_shops.create_index([('site', ASCENDING)])
+
+
+def set_site_shop(site_id, shop):
+    """
+        Remembers the myshopify domain of a site: webhooks and API calls use it, the site is stored under
+        the shop's primary domain.
+    """
+    db.shopify_shops.delete_many({'site': site_id, '_id': {'$ne': shop.lower()}})
+    db.shopify_shops.replace_one({'_id': shop.lower()}, {'site': site_id}, upsert=True)
+
+
+def get_shop_site(shop):
+    """
+        Returns the site installed from the shop (a myshopify domain), None for an unknown shop.
+    """
+    shop = shop.lower()
+    mapping = db.shopify_shops.find_one({'_id': shop})
+    if mapping:
+        return Site.objects(id=mapping['site']).only('id', 'domain', 'shopify_token').first()
+    # the sites installed before the shops were remembered, for the shops with no primary domain of their own
+    return Site.objects(domain='https://' + shop).only('id', 'domain', 'shopify_token').first()
+
+
+def get_site_client(site):
+    mapping = db.shopify_shops.find_one({'site': site.id})
+    shop = mapping['_id'] if mapping else site.domain.replace('https://', '')
+    return ShopifyClient(shop, site.shopify_token)
+
+
+def get_collections_hash(catalog):
+    """
+        Changes whenever collections, their rules or memberships change: these don't update the products
+        'updated_at', so the offers of all the products have to be rebuilt then.
+    """
+    shop, custom_collections, smart_collections, collections_ids = catalog
+    state = {
+        'format': FRAGMENTS_FORMAT,
+        'shop': [shop['domain'], shop.get('currency')],
+        'custom': sorted([collection['id'], collection['handle'], collection['title']]
+                         for collection in custom_collections.values()),
+        'smart': sorted([collection['id'], collection['handle'], collection['title'], collection.get('rules'),
+                         collection.get('disjunctive')] for collection in smart_collections),
+        'collects': sorted((product_id, sorted(ids)) for product_id, ids in collections_ids.items()),
+    }
+    return hashlib.md5(json.dumps(state, sort_keys=True)).hexdigest()
+
+
+def save_product_offers(site_id, product, catalog):
+    """
+        Keeps the serialized offers of a product in 'shopify_offer_fragments'.
+    """
+    db.shopify_offer_fragments.replace_one({'site': site_id, 'product_id': product['id']}, {
+        'site': site_id,
+        'product_id': product['id'],
+        'updated_at': product.get('updated_at'),
+        'offers': [etree.tostring(offer) for offer in get_product_offers(product, catalog)],
+    }, upsert=True)
+
+
+def delete_product_offers(site_id, products_ids):
+    db.shopify_offer_fragments.delete_many({'site': site_id, 'product_id': {'$in': list(products_ids)}})
+
+
+def iter_saved_offers(site_id):
+    fragments = db.shopify_offer_fragments.find({'site': site_id}, {'offers': 1}).sort('product_id', ASCENDING)
+    for fragment in fragments:
+        for offer in fragment['offers']:
+            yield etree.fromstring(offer)
+
+
+def sync_products(site_id, client, catalog=None):
+    """
+        Brings the saved offers of a site up to date: only the products updated since the last sync are fetched,
+        unless the collections changed or the site was never synced, in which case all of them are.
+        Returns the catalog.
+    """
+    catalog = catalog or get_catalog(client)
+    state = db.shopify_feed_state.find_one({'_id': site_id}) or {}
+    collections_hash = get_collections_hash(catalog)
+    full_sync = state.get('collections_hash') != collections_hash or not state.get('synced_at')
+
+    # overlap with the previous sync to be safe from clock skew
+    sync_started = datetime.datetime.utcnow() - SYNC_OVERLAP
+    params = {} if full_sync else {'updated_at_min': state['synced_at'].strftime('%Y-%m-%dT%H:%M:%S+00:00')}
+
+    synced_products = set()
+    for product in client.iter_all('products', 'products', **params):
+        save_product_offers(site_id, product, catalog)
+        synced_products.add(product['id'])
+
+    if full_sync:
+        # the products deleted without a webhook
+        db.shopify_offer_fragments.delete_many({'site': site_id, 'product_id': {'$nin': list(synced_products)}})
+
+    db.shopify_feed_state.update_one(
+        {'_id': site_id},
+        {'$set': {'synced_at': sync_started, 'collections_hash': collections_hash}},
+        upsert=True
+    )
+    return catalog
+
+
+def update_products(site_id, client, products_ids):
+    """
+        Rebuilds the offers of the given products only, e.g. the ones named in product webhooks.
+    """
+    shop, custom_collections, smart_collections = client.run_concurrently([
+        (client.get, ('shop',)),
+        (client.get_all, ('custom_collections', 'custom_collections')),
+        (client.get_all, ('smart_collections', 'smart_collections')),
+    ])
+    collects = []
+    for product_id in products_ids:
+        collects.extend(client.get_all('collects', 'collects', product_id=product_id))
+    custom_collections = {collection['id']: collection for collection in custom_collections}
+    catalog = (shop['shop'], custom_collections, smart_collections, get_custom_collections_ids(collects))
+
+    found = set()
+    ids = ','.join(str(product_id) for product_id in products_ids)
+    for product in client.iter_all('products', 'products', ids=ids):
+        save_product_offers(site_id, product, catalog)
+        found.add(product['id'])
+    delete_product_offers(site_id, set(products_ids) - found)
+
+
+@shared_task
+def update_shopify_products(site_id, products_ids):
+    """
+        Queued by the product webhooks, which have to be answered within 5 seconds.
+    """
+    site = Site.objects.only('id', 'domain', 'shopify_token').get(id=site_id)
+    update_products(site.id, get_site_client(site), products_ids)
+
+
+def write_site_feed(output, site_id, client, compact=False):
+    """
+        Syncs the changed products and writes the whole feed from the saved offers.
+        The compact feed has a single offer per variant listing the variant's collections,
+        the full one repeats the variant twice per collection (see expand_compact_offer).
+    """
+    catalog = sync_products(site_id, client)
+    shop, custom_collections, smart_collections, collections_ids = catalog
+    offers = iter_saved_offers(site_id)
+    if not compact:
+        offers = (expanded for offer in offers for expanded in expand_compact_offer(offer))
+    write_yml_file(output, shop, smart_collections + custom_collections.values(), offers)
+
+
+def get_feed_path(site_id, compact=False):
+    return os.path.join(FEEDS_DIR, '{}{}.xml'.format(site_id, '.compact' if compact else ''))
+
+
+def get_feed_etag(path):
+    """
+        Hash of the feed content but the generation date of its header, so that a regenerated feed
+        with the same offers keeps its ETag.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as feed:
+        chunk = feed.read(FEED_READ_CHUNK_SIZE)
+        start = chunk.find(b'<shop>')
+        # a header longer than the chunk is hashed as a whole, the ETag then changes with every generation
+        if start != -1:
+            chunk = chunk[start:]
+        while chunk:
+            md5.update(chunk)
+            chunk = feed.read(FEED_READ_CHUNK_SIZE)
+    return md5.hexdigest()
+
+
+def get_feed_state(site_id, compact=False):
+    """
+        Returns {'etag': ..., 'modified': ...} of the site's feed file.
+    """
+    mode = 'compact' if compact else 'full'
+    state = db.shopify_feed_state.find_one({'_id': site_id}, {'feeds.' + mode: 1}) or {}
+    return state.get('feeds', {}).get(mode, {})
+
+
+def generate_feed_file(site_id, client, compact=False):
+    """
+        Writes the feed of a site next to the served one and swaps it in atomically.
+        The served file, its ETag and Last-Modified stay untouched if the offers didn't change.
+    """
+    if not os.path.isdir(FEEDS_DIR):
+        os.makedirs(FEEDS_DIR)
+
+    path = get_feed_path(site_id, compact)
+    fd, tmp_path = tempfile.mkstemp(dir=FEEDS_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            write_site_feed(output, site_id, client, compact)
+        # mkstemp makes the file readable by its owner only, nginx serves it
+        os.chmod(tmp_path, 0o644)
+        etag = get_feed_etag(tmp_path)
+        if get_feed_state(site_id, compact).get('etag') == etag and os.path.exists(path):
+            os.remove(tmp_path)
+            return
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    mode = 'compact' if compact else 'full'
+    db.shopify_feed_state.update_one(
+        {'_id': site_id},
+        {'$set': {'feeds.' + mode: {'etag': etag, 'modified': datetime.datetime.utcnow().replace(microsecond=0)}}},
+        upsert=True
+    )
+
+
+def get_feed_modes(site_id):
+    """
+        Returns the compact flags of the feeds of a site that have been generated, the default one included.
+    """
+    state = db.shopify_feed_state.find_one({'_id': site_id}, {'feeds': 1}) or {}
+    return sorted(set([COMPACT_FEEDS]) | set(mode == 'compact' for mode in state.get('feeds', {})))
+
+
+def get_feed_generation_key(site_id, compact):
+    return 'shopify:feed_generation:{}:{}'.format(site_id, 'compact' if compact else 'full')
+
+
+def queue_feed_generation(site_id, compact=False):
+    """
+        Queues the generation of a feed unless it is already queued.
+    """
+    if cache.add(get_feed_generation_key(site_id, compact), 1, FEED_GENERATION_TIMEOUT):
+        generate_shopify_feed.apply_async(args=[str(site_id), compact])
+
+
+@shared_task
+def generate_shopify_feed(site_id, compact=False):
+    site = Site.objects.only('id', 'domain', 'shopify_token').get(id=site_id)
+    try:
+        generate_feed_file(site.id, get_site_client(site), compact)
+    finally:
+        cache.delete(get_feed_generation_key(site_id, compact))
+
+
+@shared_task
+def refresh_feeds():
+    """
+        Periodic job regenerating the feeds of the active Shopify sites in the background,
+        every mode an importer has asked for. Has to be scheduled in CELERYBEAT_SCHEDULE, e.g. hourly.
+    """
+    for site in Site.objects(shopify_token__exists=True, is_active=True).only('id', 'domain', 'shopify_token'):
+        try:
+            client = get_site_client(site)
+            for compact in get_feed_modes(site.id):
+                generate_feed_file(site.id, client, compact=compact)
+        except (ShopifyAPIError, requests.RequestException, EnvironmentError):
+            # a shop that uninstalled the app, is frozen or unreachable, a full disk: the other sites go on
+            shopify_logger.exception('Feed refresh of site %s failed', site.id)
@@ -0,0 +1,118 @@
+# coding: utf-8
+import hashlib
+
+from celery import shared_task
+from pymongo import ASCENDING, InsertOne, UpdateOne
+
+from accounts.models import Site, YMLFile, YMLOffer
+from leadhit_common.functions import get_minimal_url
+from analytics.shopify_feed import (
+    get_catalog, get_product_collections, get_site_client, iter_offer_urls, iter_variant_offers
+)
+
+# Offers written per bulk_write
+IMPORT_BATCH_SIZE = 1000
+# YMLOffer fields an imported offer is made of
+OFFER_FIELDS = (
+    'site', 'yml_file', 'offer_id', 'group_id', 'available', 'name', 'url', 'url_hash', 'price', 'currency_id',
+    'picture', 'category_id',
+)
+
+
+def get_url_hash(url, yml_file):
+    # the same hash the visited pages get matched against
+    return hashlib.md5(get_minimal_url(url, yml_file.significant_params, regex=yml_file.offer_regex)).hexdigest()[:12]
+
+
+def get_offer_fields():
+    """
+        Returns {field: db field} of the OFFER_FIELDS the YMLOffer model has, the others are not written.
+    """
+    return {field: YMLOffer._fields[field].db_field for field in OFFER_FIELDS if field in YMLOffer._fields}
+
+
+def iter_offer_documents(product, catalog, yml_file, fields, base_document):
+    """
+        Yields the raw YMLOffer documents of a product, the ones the YML import stores from its offers
+        in the full feed: every variant once per url and category (see iter_offer_urls).
+        The plain product url comes once per collection of the product. Documents are built as dicts,
+        base_document holds the fields common to all the offers of the site.
+    """
+    shop, custom_collections, smart_collections, collections_ids = catalog
+    categories = get_product_collections(product, custom_collections, smart_collections, collections_ids)
+    for offer in iter_variant_offers(product, categories, shop['domain'], shop.get('currency') or 'USD'):
+        for url, category_id in iter_offer_urls(offer['url'], offer['collections']):
+            values = {
+                'offer_id': offer['id'],
+                'group_id': offer['parent_id'],
+                'available': offer['available'],
+                'name': offer['name'],
+                'url': url,
+                'url_hash': get_url_hash(url, yml_file),
+                'price': float(offer['price']),
+                'currency_id': offer['currencyId'],
+                'picture': offer['picture'],
+                'category_id': category_id,
+            }
+            document = dict(base_document)
+            document.update((fields[field], value) for field, value in values.items() if field in fields)
+            yield document
+
+
+def import_site_offers(site, client=None):
+    """
+        Imports the Shopify catalog of a site straight into its YMLOffers, without building and parsing a feed.
+        Offers are matched by (offer_id, url_hash) and written in bulk batches, a single offer is kept per key:
+        the plain product url goes with the first collection of the product, as the compact feed's categoryId.
+        The offers gone from the shop and the duplicates of a key get deleted. Returns the number of offers imported.
+    """
+    client = client or get_site_client(site)
+    yml_file = YMLFile.objects.get(site=site)
+    collection = YMLOffer._get_collection()
+    catalog = get_catalog(client)
+
+    fields = get_offer_fields()
+    site_filter = YMLOffer.objects(site=site.id)._query
+    base_document = {
+        fields[field]: YMLOffer._fields[field].to_mongo(value)
+        for field, value in (('site', site), ('yml_file', yml_file)) if field in fields
+    }
+    if '_cls' in site_filter:
+        base_document['_cls'] = YMLOffer._class_name
+
+    key_fields = fields['offer_id'], fields['url_hash']
+    existing = {}
+    for document in collection.find(site_filter, dict.fromkeys(key_fields, 1)).sort('_id', ASCENDING):
+        existing.setdefault(tuple(document.get(field) for field in key_fields), []).append(document['_id'])
+
+    imported = set()
+    operations = []
+    for product in client.iter_all('products', 'products'):
+        for document in iter_offer_documents(product, catalog, yml_file, fields, base_document):
+            key = tuple(document[field] for field in key_fields)
+            if key in imported:
+                # the plain product url within the next collections of the product
+                continue
+            imported.add(key)
+            if key in existing:
+                operations.append(UpdateOne({'_id': existing[key][0]}, {'$set': document}))
+            else:
+                operations.append(InsertOne(document))
+            if len(operations) >= IMPORT_BATCH_SIZE:
+                collection.bulk_write(operations, ordered=False)
+                operations = []
+
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+
+    # the oldest offer of a key is the one kept up to date
+    removed = [_id for key, ids in existing.items() for _id in (ids if key not in imported else ids[1:])]
+    for start in range(0, len(removed), IMPORT_BATCH_SIZE):
+        collection.delete_many({'_id': {'$in': removed[start:start + IMPORT_BATCH_SIZE]}})
+    return len(imported)
+
+
+@shared_task
+def import_shopify_offers(site_id):
+    site = Site.objects.get(id=site_id)
+    return import_site_offers(site)
@@ -6,7 +6,8 @@ from django.core.urlresolvers import reverse
 from django.contrib.auth import login, logout
 from django.views.generic import View
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse, HttpResponse
+from django.views.decorators.http import condition
+from django.http import JsonResponse, HttpResponse, FileResponse
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from accounts.registration import ShopifyUserRegistration
@@ -18,19 +19,32 @@ from profile.views import LeadForm, Leadlist, EmailTemplate, Autocast
 from django.utils.decorators import decorator_from_middleware, method_decorator
 from middleware import LoginProtection
 from profile.views import TRACKER_CODE
-from profile.celery.yml import upload_yml_file
 from lib.core.acl import role_required, permission_required
-
-from lxml import etree
+from analytics.shopify_client import ShopifyClient
+from analytics.shopify_import import import_shopify_offers
+from analytics.shopify_feed import (
+    delete_product_offers, get_feed_path, get_feed_state, get_shop_site, queue_feed_generation, set_site_shop,
+    update_shopify_products
+)
 
 import string
 import random
 import shopify
 import datetime
+import hashlib
+import hmac
+import base64
 import logging
+import os
 
 shopify_logger = logging.getLogger('shopify.request')
 
+PRODUCT_WEBHOOK_TOPICS = ('products/create', 'products/update', 'products/delete')
+# Internal nginx location of SHOPIFY_FEEDS_DIR, e.g. '/protected/shopify_feeds/'
+FEEDS_ACCEL_REDIRECT = getattr(settings, 'SHOPIFY_FEEDS_ACCEL_REDIRECT', None)
+# Seconds an importer is asked to wait for a feed being generated
+FEED_RETRY_AFTER = 120
+
 
 @method_decorator(decorator_from_middleware(LoginProtection), name='dispatch')
 class LoginView(View):
@@ -71,10 +85,11 @@ class FinalizeView(View):
             return JsonResponse({'status': 'error',
                                  'error': _(u'Некорретные данные запроса')})
 
+        client = ShopifyClient(shop, access_token)
         with shopify.Session.temp(shop, access_token):
 
-            current_shop = shopify.Shop.current()
-            site_name = 'https://' + current_shop.domain
+            current_shop = client.get('shop')['shop']
+            site_name = 'https://' + current_shop['domain']
 
             site = Site.objects(domain=site_name).first()
 
@@ -100,11 +115,12 @@ class FinalizeView(View):
                     # В случае с тестовым магазином данный случай протестировать нереально.
                     # Также это кейс возможен в случае отказа от платежа при установке и последющей попытке зайти в сервис
                     site.update(shopify_token=access_token)  # Токен обновляется на случай если, магазин удалил наше приложение и установил заново
+                    set_site_shop(site.id, shop)
 
                     charge = shopify.RecurringApplicationCharge()
                     charge.price = 29
                     charge.name = 'LeadHit installation charge'
-                    if current_shop.attributes['plan_name'] == 'affiliate':
+                    if current_shop['plan_name'] == 'affiliate':
                         charge.test = True
                     # Также такой случай возможен в случае удаления и последующей установки магазином нашего приложения
                     # Ниже обрабатывается именно этот случай
@@ -128,23 +144,25 @@ class FinalizeView(View):
                 if not user.is_active:
                     user.update(is_active=True)
                 site.update(shopify_token=access_token)
+                set_site_shop(site.id, shop)
                 if not request.user.is_anonymous:
                     logout(request)
                 return_url = request.build_absolute_uri(reverse('shopify_app:process_charge'))
 
-                self.check_or_update_tracker(request, str(site.id))
+                self.check_or_update_tracker(request, client, str(site.id))
                 login(request, user)
                 return redirect('/?site_id={}'.format(site.id))
             else:
                 # Registration request
-                username = current_shop.email
+                username = current_shop['email']
                 password = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-                phone = current_shop.phone
+                phone = current_shop['phone']
                 tariff_name = 'Shopify'
                 host = ''.join([request.scheme, '://', request.get_host()])
                 registration = ShopifyUserRegistration(username, password, phone, tariff_name, site_name, host)
                 user, site = registration.register()
                 site.update(shopify_token=access_token)
+                set_site_shop(site.id, shop)
                 yml_file = YMLFile.objects.get(site=site)
 
                 # create the default coupon for a site
@@ -163,7 +181,7 @@ class FinalizeView(View):
                 charge.price = 29
                 charge.name = 'LeadHit app installation'
                 charge.trial_days = 30
-                if current_shop.attributes['plan_name'] == 'affiliate':
+                if current_shop['plan_name'] == 'affiliate':
                     charge.test = True
                 return_url = request.build_absolute_uri(reverse('shopify_app:process_charge'))
                 if 'https' not in return_url:
@@ -175,15 +193,12 @@ class FinalizeView(View):
                 confirmation_url = charge.attributes['confirmation_url']
                 return redirect(confirmation_url)
 
-    def check_or_update_tracker(self, request, site_id):
+    def check_or_update_tracker(self, request, client, site_id):
         script_url = request.build_absolute_uri(reverse('shopify_app:site_tracker')) + '?site_id={}'.format(site_id)
         script_url = script_url.replace('http://', 'https://')
-        script_tag = shopify.ScriptTag.find(src=script_url)
-        if not script_tag:
-            script_tag = shopify.ScriptTag()
-            script_tag.src = script_url
-            script_tag.event = 'onload'
-            script_tag.save()
+        script_tags = client.get('script_tags', src=script_url)['script_tags']
+        if not script_tags:
+            client.post('script_tags', {'script_tag': {'src': script_url, 'event': 'onload'}})
 
 
 # @method_decorator(decorator_from_middleware(LoginProtection), name='dispatch')
@@ -200,19 +215,25 @@ class ProcessChargeView(View):
             response['Access-Control-Allow-Origin'] = '*'
             return response
 
-        yml_file = YMLFile.objects.get(site=site)
         with shopify.Session.temp(shop, site.shopify_token):
             charge = shopify.RecurringApplicationCharge.find(charge_id)
             webhook = shopify.Webhook()
             webhook.topic = 'app/uninstalled'
             webhook.address = 'https://service.leadhit.ru/shopify/app_delete/'
             webhook.save()
+            # keep the saved offers of the feed up to date between the catalog syncs
+            for topic in PRODUCT_WEBHOOK_TOPICS:
+                webhook = shopify.Webhook()
+                webhook.topic = topic
+                webhook.address = 'https://service.leadhit.ru/shopify/product_update/'
+                webhook.save()
             if charge.attributes['status'] == 'accepted':
                 charge.activate()
                 redirect_uri = request.build_absolute_uri(reverse('shopify_app:login'))
                 redirect_uri = redirect_uri.replace('http', 'https') + '?shop=' + shop + '&charge_id=' + charge_id
                 response = redirect(redirect_uri)
-                upload_yml_file.apply_async(args=[yml_file, 'force'])
+                # the catalog goes straight into the offers, without the feed round trip of upload_yml_file
+                import_shopify_offers.apply_async(args=[str(site.id)])
                 autocasts = Autocast.objects(site=site)
                 for a in autocasts:
                     a.sender = u'shopify@leadhit.io'
@@ -245,117 +266,45 @@ class SiteTrackerView(View):
         return HttpResponse(code, content_type='application/javascript')
 
 
-@method_decorator(decorator_from_middleware(LoginProtection), name='dispatch')
-class FakeYMLView(View):
+def is_compact_feed(request):
+    # importers supporting the compact feed (one offer per variant with its collections) ask for it
+    return request.GET.get('compact') == '1'
 
-    def get(self, request):
 
-        site = Site.objects.get(domain=request.GET.get('site'))
-        shop = site.domain.replace('https://', '')
-        access_token = site.shopify_token
-        with shopify.Session.temp(shop, access_token):
-            shopify_shop_obj = shopify.Shop.current()
-            shop_collects = shopify.Collect.find()
-            shop_products = shopify.Product.find()
-            shop_categories = shopify.SmartCollection.find()
-            shop_categories += shopify.CustomCollection.find()
-            yml_file = generate_yml_file(shopify_shop_obj, shop_categories, shop_products, shop_collects)
-        return HttpResponse(yml_file, content_type='text/xml')
-
-
-def generate_yml_file(shopify_shop, shop_categories, products, collects):
-    now = str(datetime.datetime.now()).rsplit(':', 1)[0]
-    # setup root element
-    root = etree.Element('yml_catalog', date=now)
-
-    # setup shop subelement and it`s subelements 'name', 'company', 'url' and 'currency'
-    shop = etree.SubElement(root, 'shop')
-    shop_name = etree.SubElement(shop, 'name')
-    shop_name.text = shopify_shop.attributes.get('name')
-    shop_company = etree.SubElement(shop, 'company')
-    shop_company.text = shopify_shop.attributes.get('name')
-    shop_url = etree.SubElement(shop, 'url')
-    shop_url.text = 'https://' + shopify_shop.attributes.get('domain')
-    shop_currencies = etree.SubElement(shop, 'currencies')
-    shop_single_currency = etree.SubElement(shop_currencies, 'currency', id=shopify_shop.attributes.get('currency', 'USD'))
-    offers = etree.SubElement(shop, 'offers')
-
-    categories = {category.id: category for category in shop_categories}
-    categories_tag = etree.SubElement(shop, 'categories')
-    for category in categories:
-        cat_obj = categories[category]
-        cur_category = etree.SubElement(categories_tag, 'category', id=str(cat_obj.id))
-        cur_category.text = cat_obj.attributes['title']
-    default_category = etree.SubElement(categories_tag, 'category', id='Main')
-
-    # data for yml offers to add
-    products = {product.id: product for product in products}
-    processed_products = set()
-    shop_domain = shopify_shop.attributes['domain']
-    currencyId = shopify_shop.attributes.get('currency', 'USD')
-
-    for category in shop_categories:
-        category_products = category.products()
-        for product in category_products:
-            add_yml_offer(parent_element=offers, product=product, category=category, shop_domain=shop_domain, currencyId=currencyId)
-            processed_products.add(product.id)
-
-    # removing processed products belonging to any category
-    # products having no category stay in products dict and get assigned the default category
-    for processed_product in processed_products:
-        if processed_product in products:
-            del products[processed_product]
-
-    for prd_id in products:
-        product = products[prd_id]
-        add_yml_offer(parent_element=offers, product=product, category=None, shop_domain=shop_domain, currencyId=currencyId)
-
-    return etree.tostring(root, pretty_print=True)
-
-
-def add_yml_offer(parent_element=None, product=None, category=None, shop_domain=None, currencyId=None):
-    if not category:
-        # offers with no category get assigned "Main" category
-        add_offer(parent_element=parent_element, product=product, category=category, shop_domain=shop_domain, currencyId=currencyId)
-    else:
-        add_offer(based_on_category=False, parent_element=parent_element, product=product, category=category, shop_domain=shop_domain, currencyId=currencyId)
-        add_offer(parent_element=parent_element, product=product, category=category, shop_domain=shop_domain, currencyId=currencyId)
+def get_feed_etag(request):
+    site = Site.objects(domain=request.GET.get('site')).only('id').first()
+    etag = site and get_feed_state(site.id, is_compact_feed(request)).get('etag')
+    return '"{}"'.format(etag) if etag else None
 
 
-def add_offer(based_on_category=True, parent_element=None, product=None, category=None, shop_domain=None, currencyId=None):
-    for variant in product.variants:
-        availability = 'true' if variant.inventory_quantity else 'false'
-        cur_product = etree.SubElement(parent_element, 'offer', parent_id=str(product.id), id=str(variant.id), available=availability)
+def get_feed_modified(request):
+    site = Site.objects(domain=request.GET.get('site')).only('id').first()
+    return site and get_feed_state(site.id, is_compact_feed(request)).get('modified')
 
-        name = product.attributes['title'] if variant.title == 'Default Title' else product.attributes['title'] + ', ' + variant.title
-        product_name = etree.SubElement(cur_product, 'name')
-        product_name.text = name
 
-        product_url = etree.SubElement(cur_product, 'url')
-
-        if based_on_category and category:
-            product_url.text = 'https://' + shop_domain + '/collections/' + category.handle + '/products/' + product.attributes['handle']
-        else:
-            product_url.text = 'https://' + shop_domain + '/products/' + product.attributes['handle']
-
-        product_price = etree.SubElement(cur_product, 'price')
-        product_price.text = variant.attributes['price']
+@method_decorator(decorator_from_middleware(LoginProtection), name='dispatch')
+@method_decorator(condition(etag_func=get_feed_etag, last_modified_func=get_feed_modified), name='get')
+class FakeYMLView(View):
 
-        product_currency = etree.SubElement(cur_product, 'currencyId')
-        product_currency.text = currencyId
+    def get(self, request):
 
-        if product.attributes.get('image'):
-            product_picture = etree.SubElement(cur_product, 'picture')
-            image_url = product.attributes['image'].attributes['src']
-            if '?v=' in image_url:
-                image_url = image_url[:image_url.find('?v=')]
-            product_picture.text = image_url
+        site = Site.objects.get(domain=request.GET.get('site'))
+        compact = is_compact_feed(request)
+        path = get_feed_path(site.id, compact)
+        if not os.path.exists(path):
+            # the feeds are generated in the background (shopify_feed.refresh_feeds), the first one gets queued
+            queue_feed_generation(site.id, compact)
+            response = HttpResponse(status=503)
+            response['Retry-After'] = FEED_RETRY_AFTER
+            return response
 
-        product_category = etree.SubElement(cur_product, 'categoryId')
-        if category:
-            product_category.text = str(category.id)
-        else:
-            product_category.text = 'Main'
+        if FEEDS_ACCEL_REDIRECT:
+            # nginx sends the file itself
+            response = HttpResponse(content_type='text/xml')
+            response['X-Accel-Redirect'] = FEEDS_ACCEL_REDIRECT + os.path.basename(path)
+            return response
+        # served with the server's wsgi.file_wrapper (sendfile) when available
+        return FileResponse(open(path, 'rb'), content_type='text/xml')
 
 
 @role_required(('master', 'manager'))
@@ -441,5 +390,32 @@ def app_delete(request):
     return HttpResponse(status=200)
 
 
+def is_valid_webhook(request):
+    digest = hmac.new(settings.SHOPIFY_API_SECRET, request.body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest), request.META.get('HTTP_X_SHOPIFY_HMAC_SHA256', ''))
+
+
+@csrf_exempt
+def product_update(request):
+    '''
+    Gets triggered by products/create, products/update and products/delete webhooks (routed at /shopify/product_update/).
+    Deletes the saved feed offers of the product or queues their rebuild: Shopify waits 5 seconds for the answer
+    '''
+    if not is_valid_webhook(request):
+        return HttpResponse(status=401)
+
+    body = json.loads(request.body)
+    # the myshopify domain of the shop, remembered at install
+    site = get_shop_site(request.META.get('HTTP_X_SHOPIFY_SHOP_DOMAIN', ''))
+    if site is None:
+        return HttpResponse(status=200)
+
+    if request.META.get('HTTP_X_SHOPIFY_TOPIC') == 'products/delete':
+        delete_product_offers(site.id, [body['id']])
+    else:
+        update_shopify_products.apply_async(args=[str(site.id), [body['id']]])
+    return HttpResponse(status=200)
+
+
 def get_store_second_level_domain(address):
     return address.strip('/').split('.')[-2]
@@ -0,0 +1,28 @@
+# coding: utf-8
+from mongoengine import signals
+
+from leads.models import Lead, LeadOrder
+from analytics.prefetch import get_reference_id
+from analytics.tasks import update_lead_customer, update_order_fact
+
+
+def order_changed(sender, document, **kwargs):
+    update_order_fact.delay(str(document.id))
+
+
+def lead_saved(sender, document, **kwargs):
+    multilead_id = get_reference_id(document, 'multilead')
+    update_lead_customer.delay(
+        str(get_reference_id(document, 'site')), str(document.id), multilead_id and str(multilead_id)
+    )
+
+
+def connect():
+    """
+        Keeps the analytics facts in sync with the documents they are built from, in the background: the saves
+        only queue the updates. Orders created bypassing the documents are picked up by the sync_facts task,
+        the ones updated or deleted that way have to be marked with facts.mark_orders_dirty.
+    """
+    signals.post_save.connect(lead_saved, sender=Lead)
+    signals.post_save.connect(order_changed, sender=LeadOrder)
+    signals.post_delete.connect(order_changed, sender=LeadOrder)
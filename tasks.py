@@ -0,0 +1,111 @@
+# coding: utf-8
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils import translation
+from django.utils.translation import ugettext
+
+from bson import ObjectId
+from celery import shared_task
+from pymongo.errors import ExecutionTimeout
+
+from accounts.models import Site
+from analytics import budget, facts
+from analytics.chart import get_chart_data, get_dashboard_data, get_shop_metrics_data
+from analytics.identity import set_leads_customer
+from analytics.results import has_result, publish_result
+from analytics.scheduling import dispatch_deferred
+
+
+@contextmanager
+def publishing_errors(result_keys):
+    """
+        Every result left unpublished by a failing task gets published as an error: the clients stop waiting
+        and the running slot of the task is released.
+    """
+    try:
+        yield
+    except Exception:
+        for result_key in result_keys:
+            if not has_result(result_key):
+                publish_result(result_key, {'status': 'error'})
+        raise
+
+
+@shared_task
+def fetch_chart_data(chart, options, result_key, language=settings.LANGUAGE_CODE):
+    """
+        Computes a chart within its time budget and publishes its result under result_key
+        for the clients waiting for it.
+    """
+    with publishing_errors([result_key]), translation.override(language):
+        publish_result(result_key, get_chart_data(chart, options, result_key))
+
+
+@shared_task
+def fetch_dashboard_data(batch, language=settings.LANGUAGE_CODE):
+    """
+        Computes a dashboard batch, a list of (chart, options, result_key) sharing their queries,
+        and publishes every result as soon as its chart is computed.
+    """
+    with publishing_errors([result_key for chart, options, result_key in batch]), translation.override(language):
+        for result_key, data in get_dashboard_data(batch):
+            publish_result(result_key, data)
+
+
+@shared_task
+def get_shop_metrics(site_id, period_start, period_end, result_key, language=settings.LANGUAGE_CODE):
+    """
+        Publishes all the KPI series of the period, read from the site's KPI cube.
+        The weeks missing from the cache are built within the chart time budget.
+    """
+    with publishing_errors([result_key]), translation.override(language):
+        try:
+            with budget.query_budget(budget.CHART_TIME_BUDGET_MS, result_key):
+                data = get_shop_metrics_data(site_id, period_start, period_end)
+        except ExecutionTimeout:
+            data = {
+                'status': 'error',
+                'errors': {
+                    ugettext(u'Период'): [ugettext(u'Расчет занимает слишком много времени, выберите период короче')]
+                }
+            }
+        except budget.ChartAbandoned:
+            data = {'status': 'error', 'abandoned': True}
+        publish_result(result_key, data)
+
+
+@shared_task
+def dispatch_deferred_tasks():
+    """
+        Starts the deferred tasks freed by the slots of dead tasks expiring, which no release dispatches.
+        Has to be scheduled in CELERYBEAT_SCHEDULE every minute.
+    """
+    dispatch_deferred()
+
+
+@shared_task
+def update_order_fact(order_id):
+    facts.record_order_fact(ObjectId(order_id))
+
+
+@shared_task
+def update_lead_customer(site_id, lead_id, multilead_id=None):
+    """
+        Keeps the identity map and the customer of the lead's order facts up to date after the lead got saved.
+    """
+    set_leads_customer(ObjectId(site_id), [lead_id], multilead_id or lead_id)
+    if multilead_id:
+        facts.update_order_facts_customer([ObjectId(lead_id)], ObjectId(multilead_id))
+
+
+@shared_task
+def sync_facts():
+    """
+        Periodic job bringing the facts of the active sites up to date: the first-touch forms of the multileads,
+        new orders and the orders marked dirty.
+        Has to be scheduled in CELERYBEAT_SCHEDULE every 5 minutes.
+    """
+    for site in Site.objects(is_active=True).only('id'):
+        facts.sync_first_forms(site.id)
+        facts.sync_order_facts(site.id)
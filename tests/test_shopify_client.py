@@ -0,0 +1,144 @@
+# coding: utf-8
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from django.test import SimpleTestCase
+
+import requests
+
+from analytics import shopify_client
+from analytics.shopify_client import CallBucket, ShopifyAPIError, ShopifyClient
+
+# Request timeout of the tests, a TIMEOUT response answers later than that
+REQUEST_TIMEOUT = 0.2
+TIMEOUT = None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+        Answers with the next of the server's queued (status, body) responses and records the requests.
+        A TIMEOUT response doesn't answer before the client times out.
+    """
+    def respond(self):
+        self.server.requests.append(self.command)
+        response = self.server.responses.pop(0)
+        if response is TIMEOUT:
+            time.sleep(REQUEST_TIMEOUT * 3)
+            return
+        status, body = response
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if self.server.call_limit:
+            self.send_header('X-Shopify-Shop-Api-Call-Limit', self.server.call_limit)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    # a request left waiting for its timeout doesn't hold up the retry
+    daemon_threads = True
+
+
+class ShopifyClientRetriesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        self.server.requests = []
+        self.server.responses = []
+        self.server.call_limit = None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.backoff_seconds = shopify_client.BACKOFF_SECONDS
+        self.request_timeout = shopify_client.REQUEST_TIMEOUT
+        shopify_client.BACKOFF_SECONDS = 0
+        shopify_client.REQUEST_TIMEOUT = REQUEST_TIMEOUT
+        # every test starts with an empty bucket of the stub shop
+        shopify_client._buckets.clear()
+        self.client = ShopifyClient('stub.myshopify.com', 'token',
+                                    base_url='http://127.0.0.1:{}'.format(self.server.server_port))
+
+    def tearDown(self):
+        shopify_client.BACKOFF_SECONDS = self.backoff_seconds
+        shopify_client.REQUEST_TIMEOUT = self.request_timeout
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_is_retried_on_server_error(self):
+        self.server.responses = [(502, '{}'), (200, '{"shop": {"id": 1}}')]
+        self.assertEqual(self.client.get('shop'), {'shop': {'id': 1}})
+        self.assertEqual(self.server.requests, ['GET', 'GET'])
+
+    def test_post_is_not_retried_on_server_error(self):
+        self.server.responses = [(500, '{}'), (201, '{}')]
+        with self.assertRaises(ShopifyAPIError):
+            self.client.post('script_tags', {'script_tag': {}})
+        self.assertEqual(self.server.requests, ['POST'])
+
+    def test_post_is_retried_when_throttled(self):
+        self.server.responses = [(429, '{}'), (201, '{"script_tag": {"id": 1}}')]
+        self.assertEqual(self.client.post('script_tags', {'script_tag': {}}), {'script_tag': {'id': 1}})
+        self.assertEqual(self.server.requests, ['POST', 'POST'])
+
+    def test_put_is_retried_on_server_error(self):
+        self.server.responses = [(503, '{}'), (200, '{}')]
+        self.client.put('products/1', {'product': {}})
+        self.assertEqual(self.server.requests, ['PUT', 'PUT'])
+
+    def test_retries_are_limited(self):
+        self.server.responses = [(500, '{}')] * (shopify_client.MAX_RETRIES + 1)
+        with self.assertRaises(ShopifyAPIError):
+            self.client.get('shop')
+        self.assertEqual(len(self.server.requests), shopify_client.MAX_RETRIES + 1)
+
+    def test_post_is_not_retried_on_read_timeout(self):
+        self.server.responses = [TIMEOUT, (201, '{}')]
+        with self.assertRaises(requests.ReadTimeout):
+            self.client.post('script_tags', {'script_tag': {}})
+        self.assertEqual(self.server.requests, ['POST'])
+
+    def test_get_is_retried_on_read_timeout(self):
+        self.server.responses = [TIMEOUT, (200, '{"shop": {"id": 1}}')]
+        self.assertEqual(self.client.get('shop'), {'shop': {'id': 1}})
+        self.assertEqual(self.server.requests, ['GET', 'GET'])
+
+    def test_bucket_follows_call_limit_header(self):
+        self.server.responses = [(200, '{}')]
+        self.server.call_limit = '39/80'
+        self.client.get('shop')
+        self.assertEqual(self.client.bucket.size, 80)
+        self.assertAlmostEqual(self.client.bucket.get_level(self.client.bucket.updated), 39)
+
+
+class CallBucketTest(SimpleTestCase):
+
+    def test_bucket_leaks(self):
+        bucket = CallBucket()
+        bucket.update('30/40')
+        self.assertEqual(bucket.get_level(bucket.updated + 5), 20)
+        self.assertEqual(bucket.get_level(bucket.updated + 60), 0)
+
+    def test_full_bucket_waits_for_leak(self):
+        bucket = CallBucket()
+        # filled up to the margin: waits half a second for one call to leak at 2 calls a second
+        bucket.update('{}/40'.format(40 - shopify_client.BUCKET_MARGIN))
+        started = time.time()
+        bucket.acquire()
+        self.assertGreaterEqual(time.time() - started, 0.4)
+        self.assertLessEqual(bucket.used, 40 - shopify_client.BUCKET_MARGIN)
+
+    def test_bucket_with_room_does_not_wait(self):
+        bucket = CallBucket()
+        bucket.update('10/40')
+        started = time.time()
+        bucket.acquire()
+        self.assertLess(time.time() - started, 0.1)
@@ -2,9 +2,10 @@
 import json
 from copy import deepcopy
 from datetime import datetime, timedelta
+from itertools import chain, islice
 
 from django.conf import settings
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, Http404, StreamingHttpResponse
 from django.urls import reverse
 from django.views.generic import View, TemplateView
 from django.utils.decorators import method_decorator
@@ -12,6 +13,7 @@ from django.utils.translation import ugettext, get_language
 
 from bson import DBRef
 from bson.objectid import ObjectId
+from pymongo.errors import ExecutionTimeout
 
 from automailer.models import Autocast
 from accounts.models import WidgetsConf
@@ -25,8 +27,7 @@ from utils.helpers import (
     Period as P,
     process_autocasts_query_timeframe,
     humanize_form_errors,
-    validate_time_period,
-    get_messages_and_msg_to_autocast_dict
+    validate_time_period
 )
 from .chart import (
     WidgetsChart,
@@ -38,21 +39,98 @@ from .chart import (
     SalesFunnelChart,
     SalesBarChart,
     LeadsDiscoveryChart,
+    DashboardQueries,
+    DASHBOARD_GRAPHS,
+    get_dashboard_chart,
+    iter_export_rows,
     AverageRevenuePerVisitorChart,
-    AverageRevenuePerUserChart,
-    AverageRevenuePerPayingUserChart,
-    CartAbandonmentRateChart,
-    AverageCheckChart,
-    PurchaseFrequencyChart,
-    PaidOrdersRateChart,
-    RepeatCustomerRateChart
+    KPI_CHARTS
 )
 
-from .celery import tasks
-from lib.helpers import generate_redis_result_key
+from .prefetch import get_reference_id, prefetch_references
+from .export import EXPORT_FORMATS, streaming_export_response
+from .results import abandon_results, claim_result_key, get_results, iter_results
+from .scheduling import estimate_cost, schedule_task
+from .warming import get_warm_result_key
+from .connections import analytics_db
+from .tasks import fetch_chart_data, fetch_dashboard_data, get_shop_metrics
 from widgets.helpers import get_recommendations_widgets
 
-db = settings.DB
+db = analytics_db
+
+
+EXPORT_CHARTS = {
+    'widgets': WidgetsChart,
+    'leads': LeadsChart,
+    'emails': EmailCampaignsChart,
+    'recommendations': RecommendationsChart,
+    'emails_dynamics': EmailDynamicsChart,
+    'visits': VisitsChart,
+    'sales_funnel': SalesFunnelChart,
+    'sales_bar': SalesBarChart,
+    'leads_discovery': LeadsDiscoveryChart,
+}
+
+# Maximum number of result keys a client can wait for over one connection
+RESULT_KEYS_LIMIT = 20
+RESULT_STREAM_TIMEOUT = getattr(settings, 'ANALYTICS_RESULT_STREAM_TIMEOUT', 120)
+RESULT_STREAM_HEARTBEAT = 15
+RESULT_POLL_TIMEOUT = getattr(settings, 'ANALYTICS_RESULT_POLL_TIMEOUT', 30)
+
+# Number of autocasts formatted per batch when the stats table gets exported
+EXPORT_CHUNK_SIZE = 500
+
+AUTOCAST_STATS_FIELDS = (
+    'recipients_count', 'delivered', 'opened', 'clicked', 'unsubscribed',
+    'test_recipients_count', 'test_delivered', 'test_opened', 'test_clicked', 'test_unsubscribed'
+)
+
+
+def get_percentage(x, y):
+    return '{:.3g}%'.format(float(x) / y * 100 if y else 0)
+
+
+def validate_kpi_period(data, align_to_weeks=False):
+    validation_result = validate_time_period(data.get('period_start'), data.get('period_end'), date_format='%d.%m.%Y')
+    if validation_result['status'] == 'error':
+        return validation_result
+
+    period_start = validation_result['start']
+    period_end = validation_result['end']
+
+    current_week, current_day = datetime.now().isocalendar()[1:]
+
+    if (period_end - period_start).days < 6:
+        if not(period_start.isocalendar()[1:] == (current_week, 1) and
+               period_end.isocalendar()[1] == current_week and period_end.isocalendar()[2] >= current_day):
+            return {
+                'status': 'error',
+                'errors': {ugettext(u'Период'): [ugettext(u'Минимальный период для выбора составляет 7 дней')]}
+            }
+
+    if align_to_weeks:
+        period_start = period_start - timedelta(days=period_start.weekday())
+        period_end = period_end + timedelta(days=6 - period_end.weekday())
+
+    return {'status': 'ok', 'period_start': period_start, 'period_end': period_end}
+
+
+def get_chart_task_name(chart):
+    # results contain translated strings
+    return '{}:{}'.format(type(chart).__name__, get_language())
+
+
+def start_chart_task(chart, options):
+    """
+        Queues fetch_chart_data unless an identical computation is already running. Returns the result key to wait for.
+    """
+    result_key, created = claim_result_key(get_chart_task_name(chart), options)
+    if created:
+        schedule_task(
+            fetch_chart_data, [chart, options, result_key], {'language': get_language()},
+            options['site_id'], estimate_cost(type(chart).__name__, options, options['site_id']), [result_key]
+        )
+    return result_key
 
 
 def get_widgets(site_id):
@@ -414,20 +492,11 @@ class DashBoardView(VisitsChart, TemplateView):
             site.interface_configuration.dashboard['default_period'] = period
             site.save()
             data = {'status': 'success'}
+        elif request.POST.get('batch'):
+            data = self.start_batch(request)
         else:
             graph = request.POST.get('graph')
-            if graph == 'visits':
-                chart = VisitsChart()
-            if graph == 'sales_funnel':
-                chart = SalesFunnelChart(site_id=site.id)
-            if graph == 'sales_bar':
-                chart = SalesBarChart(site_id=site.id)
-            if graph == 'recommendations':
-                chart = RecommendationsChart()
-            if graph == 'emails':
-                chart = EmailDynamicsChart()
-            if graph == 'leads_discovery':
-                chart = LeadsDiscoveryChart()
+            chart = get_dashboard_chart(graph, site.id)
 
             result = chart.validate_input(request.POST)
             result.update({'site_id': site.id})
@@ -435,12 +504,107 @@ class DashBoardView(VisitsChart, TemplateView):
             if result.get('status') == 'error':
                 return JsonResponse(result)
 
-            result_key = generate_redis_result_key()
-            tasks.fetch_chart_data.apply_async(args=[chart, result, result_key], kwargs={'language': get_language()})
-            data = {'result_key': result_key}
+            data = {'result_key': start_chart_task(chart, result)}
+            # the warmed result is only good for the first paint, the fresh one follows under result_key
+            warm_result_key = get_warm_result_key(site, graph, request.POST, get_language())
+            if warm_result_key is not None:
+                data['warm_result_key'] = warm_result_key
 
         return JsonResponse(data)
 
+    def start_batch(self, request):
+        """
+            Computes all the requested dashboard graphs in a single task sharing visitors, orders and
+            recommendation clicks. Every graph gets its own result key, published as soon as the graph is ready.
+            Warmed results of the graphs are returned under warm_result_keys for the first paint.
+        """
+        site = request.site
+        queries = DashboardQueries()
+        batch = []
+        result_keys = {}
+        warm_result_keys = {}
+        errors = {}
+        for graph in request.POST.getlist('graphs') or DASHBOARD_GRAPHS:
+            chart = get_dashboard_chart(graph, site.id, queries)
+            if chart is None:
+                continue
+
+            warm_result_key = get_warm_result_key(site, graph, request.POST, get_language())
+            if warm_result_key is not None:
+                warm_result_keys[graph] = warm_result_key
+
+            result = chart.validate_input(request.POST)
+            result.update({'site_id': site.id})
+            if result.get('status') == 'error':
+                errors[graph] = result
+                continue
+
+            result_keys[graph], created = claim_result_key(get_chart_task_name(chart), result)
+            if created:
+                batch.append((chart, result, result_keys[graph]))
+
+        if batch:
+            cost = sum(estimate_cost(type(chart).__name__, options, site.id) for chart, options, result_key in batch)
+            schedule_task(
+                fetch_dashboard_data, [batch], {'language': get_language()},
+                site.id, cost, [result_key for chart, options, result_key in batch]
+            )
+        return {'result_keys': result_keys, 'warm_result_keys': warm_result_keys, 'errors': errors}
+
+
+@method_decorator(permission_required('analytics'), name="dispatch")
+class ChartResultsView(View):
+    """
+        Delivers the results of chart tasks as soon as they are published instead of having the client poll.
+        GET ?result_key=<key>&result_key=<key>... streams Server-Sent Events, one 'result' event per key.
+        With mode=poll it waits until at least one result is ready and returns all the ready ones as JSON.
+    """
+    http_method_names = ['get']
+
+    def get(self, request):
+        result_keys = request.GET.getlist('result_key')[:RESULT_KEYS_LIMIT]
+        if not result_keys:
+            return JsonResponse({'status': 'error', 'errors': {'result_key': [ugettext(u'Обязательное поле.')]}})
+
+        if request.GET.get('mode') == 'poll':
+            return self.long_poll(result_keys)
+
+        response = StreamingHttpResponse(self.iter_events(result_keys), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # keeps nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def iter_events(self, result_keys):
+        pending = set(result_keys)
+        results = iter_results(result_keys, RESULT_STREAM_TIMEOUT, heartbeat=RESULT_STREAM_HEARTBEAT)
+        try:
+            for result_key, payload in results:
+                if result_key is None:
+                    yield ': heartbeat\n\n'
+                else:
+                    pending.discard(result_key)
+                    yield 'event: result\nid: {}\ndata: {}\n\n'.format(result_key, payload)
+            yield 'event: end\ndata: {}\n\n'
+        except GeneratorExit:
+            # the client has gone, a heartbeat or a result couldn't be written.
+            # Unsubscribe first, otherwise this connection would still count as waiting for the results.
+            results.close()
+            abandon_results(pending)
+            raise
+
+    def long_poll(self, result_keys):
+        results = get_results(result_keys)
+        if not results:
+            for result_key, payload in iter_results(result_keys, RESULT_POLL_TIMEOUT):
+                results[result_key] = payload
+                break
+            results.update(get_results([result_key for result_key in result_keys if result_key not in results]))
+
+        # payloads are JSON already
+        content = '{%s}' % ', '.join('%s: %s' % (json.dumps(key), payload) for key, payload in results.items())
+        return HttpResponse(content, content_type='application/json')
+
 
 class AutocastsStatsView(TemplateView):
     template_name = 'analytics/autocasts.html'
@@ -450,181 +614,63 @@ class AutocastsStatsView(TemplateView):
         context['autocasts'] = Autocast.objects(site=self.request.site).count()
         return context
 
-    def post(self, request):
+    def get_filters(self, data):
         booleans_dict = {
             'false': False,
             'true': True
         }
 
-        include_test_emails = booleans_dict[request.POST.get('test_emails')]
-        include_archived = booleans_dict[request.POST.get('show_archived')]
         date_format = '%Y-%m-%d'
 
-        start = request.POST.get('period_start')
-        end = request.POST.get('period_end')
+        start = data.get('period_start')
+        end = data.get('period_end')
 
         if start:
             start = datetime.strptime(start, date_format)
         if end:
             end = datetime.strptime(end, date_format)
 
-        start, end, errors = process_autocasts_query_timeframe(start, end, request.site)
-        if errors.values():
-            return JsonResponse({'status': 'error', 'errors': errors, 'data': [], 'recordsTotal': 0})
+        start, end, errors = process_autocasts_query_timeframe(start, end, self.request.site)
+        return {
+            'include_test_emails': booleans_dict[data.get('test_emails')],
+            'include_archived': booleans_dict[data.get('show_archived')],
+            'start': start,
+            'end': end,
+            'errors': errors
+        }
 
-        autocasts = Autocast.objects(site=request.site, message__exists=True)
+    def get_autocasts(self, include_archived):
+        autocasts = Autocast.objects(site=self.request.site, message__exists=True)
         if not include_archived:
             autocasts = autocasts(archived__ne=True)
+        # raw documents: references stay unresolved until the visible page is formatted
+        return autocasts.only('name', 'message', 'cases', 'archived').as_pymongo()
 
-        message_ids, messages_to_autocasts_dict = get_messages_and_msg_to_autocast_dict(autocasts)
-
-        message_ids = [DBRef('messages', mid) for mid in message_ids]
-
-        match = {
-            '$match': {
-                'message': {'$in': message_ids},
-                'lead_id': {'$ne': 'None'},
-                'time_added': {'$gte': start, '$lte': end}
-            }
-        }
-
-        match_test_emails = deepcopy(match)
-        match_test_emails['$match']['lead_id'] = 'None'
+    def get_message_ids(self, autocasts):
+        message_ids = set()
+        for autocast in autocasts:
+            message_ids.add(get_reference_id(autocast, 'message'))
+            message_ids.update(get_reference_id(case, 'message') for case in autocast.get('cases') or [])
+        return message_ids
 
-        group = {
-            '$group': {
-                '_id': '$message',
-                'recipients_count': {'$sum': 1},
-                'delivered': {'$sum': {'$cond': [{'$eq': ['$status', 'delivered']}, 1, 0]}},
-                'opened': {'$sum': {'$cond': [{'$eq': ['$opened', True]}, 1, 0]}},
-                'clicked': {'$sum': {'$cond': [{'$eq': ['$clicked', True]}, 1, 0]}},
-                'unsubscribed': {'$sum': {'$cond': [{'$eq': ['$unsubscribed', True]}, 1, 0]}},
-            }
-        }
-
-        project = {
-            '$project': {
-                'recipients_count': 1,
-                'delivered': 1,
-                'clicked': 1,
-                'opened': 1,
-                'unsubscribed': 1,
-                'delivered_percentage': {'$cond': [{'$eq': ['$recipients_count', 0]}, 0, {'$divide': ['$delivered', '$recipients_count']}]},
-                'opened_percentage': {'$cond': [{'$eq': ['$delivered', 0]}, 0, {'$divide': ['$opened', '$delivered']}]},
-                'clicked_percentage': {'$cond': [{'$eq': ['$opened', 0]}, 0, {'$divide': ['$clicked', '$opened']}]},
-                'unsubscribed_percentage': {'$cond': [{'$eq': ['$delivered', 0]}, 0, {'$divide': ['$unsubscribed', '$delivered']}]}
-            }
-        }
+    def post(self, request):
+        filters = self.get_filters(request.POST)
+        if filters['errors'].values():
+            return JsonResponse({'status': 'error', 'errors': filters['errors'], 'data': [], 'recordsTotal': 0})
 
-        aggregated_data = db.emails.aggregate([match, group, project])
-        aggregated_data = {item['_id'].id: item for item in aggregated_data}
+        include_test_emails = filters['include_test_emails']
+        autocasts = list(self.get_autocasts(filters['include_archived']))
 
-        if include_test_emails:
-            test_emails_aggrgegated_data = db.emails.aggregate([match_test_emails, group, project])
-            test_emails_aggrgegated_data = {item['_id'].id: item for item in test_emails_aggrgegated_data}
-
-        data = []
-        for key in messages_to_autocasts_dict:
-            autocast = messages_to_autocasts_dict[key]['autocast']
-
-            formatted_data = {
-                'id': str(autocast.id),
-                'name': autocast.name,
-                'message_name': autocast.message.name,
-                'cases': autocast.cases,
-                'archived': autocast.archived,
-            }
-
-            autocast_aggr_data = aggregated_data.get(key, {})
-            stats = {
-                'recipients_count': {
-                    'real': autocast_aggr_data.get('recipients_count', 0),
-                },
-                'delivered_emails': {
-                    'real': autocast_aggr_data.get('delivered', 0),
-                    'percentage': '{:.3g}%'.format(autocast_aggr_data.get('delivered_percentage', 0) * 100)
-                },
-                'opened_emails': {
-                    'real': autocast_aggr_data.get('opened', 0),
-                    'percentage': '{:.3g}%'.format(autocast_aggr_data.get('opened_percentage', 0) * 100)
-                },
-                'clicked_emails': {
-                    'real': autocast_aggr_data.get('clicked', 0),
-                    'percentage': '{:.3g}%'.format(autocast_aggr_data.get('clicked_percentage', 0) * 100)
-                },
-                'unsubscribed': {
-                    'real': autocast_aggr_data.get('unsubscribed', 0),
-                    'percentage': '{:.3g}%'.format(autocast_aggr_data.get('unsubscribed_percentage', 0) * 100)
-                }
-            }
-
-            if include_test_emails:
-                autocast_test_data_aggregated = test_emails_aggrgegated_data.get(key, {})
-                stats['recipients_count']['test'] = autocast_test_data_aggregated.get('recipients_count', 0)
-                stats['delivered_emails']['test'] = autocast_test_data_aggregated.get('delivered', 0)
-                stats['opened_emails']['test'] = autocast_test_data_aggregated.get('opened', 0)
-                stats['clicked_emails']['test'] = autocast_test_data_aggregated.get('clicked', 0)
-
-            formatted_data.update(stats)
-
-            if autocast.cases:
-                cases = []
-                for case in autocast.cases:
-                    msg_id = case.message.id
-                    case_data = {
-                        'name': case.name,
-                        'message_name': case.message.name
-                    }
-                    case_aggr_data = aggregated_data.get(msg_id, {})
-                    case_data.update({
-                        'name': case.name,
-                        'message_name': case.message.name,
-                        'recipients_count': {
-                            'real': case_aggr_data.get('recipients_count', 0),
-                        },
-                        'delivered_emails': {
-                            'real': case_aggr_data.get('delivered', 0),
-                            'percentage': '{:.3g}%'.format(case_aggr_data.get('delivered_percentage', 0) * 100)
-                        },
-                        'opened_emails': {
-                            'real': case_aggr_data.get('opened', 0),
-                            'percentage': '{:.3g}%'.format(case_aggr_data.get('opened_percentage', 0) * 100)
-                        },
-                        'clicked_emails': {
-                            'real': case_aggr_data.get('clicked', 0),
-                            'percentage': '{:.3g}%'.format(case_aggr_data.get('clicked_percentage', 0) * 100)
-                        },
-                        'unsubscribed': {'real': 0}
-                    })
-                    if include_test_emails:
-                        case_test_data_aggregated = test_emails_aggrgegated_data.get(msg_id, {})
-                        case_data['recipients_count']['test'] = case_test_data_aggregated.get('recipients_count', 0)
-                        case_data['delivered_emails']['test'] = case_test_data_aggregated.get('delivered', 0)
-                        case_data['opened_emails']['test'] = case_test_data_aggregated.get('opened_emails', 0)
-                        case_data['clicked_emails']['test'] = case_test_data_aggregated.get('clicked', 0)
-
-                    cases.append(case_data)
-                    for case in cases[1:]:
-                        formatted_data['recipients_count']['real'] += case['recipients_count']['real']
-                        formatted_data['delivered_emails']['real'] += case['delivered_emails']['real']
-                        formatted_data['opened_emails']['real'] += case['opened_emails']['real']
-                        formatted_data['clicked_emails']['real'] += case['clicked_emails']['real']
-                    if include_test_emails and key in aggregated_data:
-                        for case in cases[1:]:
-                            formatted_data['recipients_count']['test'] += case['recipients_count']['test']
-                            formatted_data['delivered_emails']['test'] += case['delivered_emails']['test']
-                            formatted_data['opened_emails']['test'] += case['opened_emails']['test']
-                            formatted_data['clicked_emails']['test'] += case['clicked_emails']['test']
-                formatted_data['cases'] = cases
-            data.append(formatted_data)
+        stats = self.get_emails_stats(self.get_message_ids(autocasts), filters['start'], filters['end'])
+        totals = {autocast['_id']: self.get_autocast_totals(autocast, stats) for autocast in autocasts}
 
         sort_fields = [
-            lambda x: x['name'],
-            lambda x: x['recipients_count']['real'],
-            lambda x: x['delivered_emails']['real'],
-            lambda x: x['opened_emails']['real'],
-            lambda x: x['clicked_emails']['real'],
-            lambda x: x['unsubscribed']['real'],
+            lambda x: x.get('name'),
+            lambda x: totals[x['_id']]['recipients_count'],
+            lambda x: totals[x['_id']]['delivered'],
+            lambda x: totals[x['_id']]['opened'],
+            lambda x: totals[x['_id']]['clicked'],
+            lambda x: totals[x['_id']]['unsubscribed'],
         ]
 
         sort_directions = {
@@ -638,17 +684,165 @@ class AutocastsStatsView(TemplateView):
         sort_direction = sort_directions[request.POST['order[0][dir]']]
         field = sort_fields[int(request.POST['order[0][column]'])]
 
-        data.sort(key=field, reverse=sort_direction)
-        autocasts_list = Pagination(iterable=data, page=page, per_page=per_page)
+        autocasts.sort(key=field, reverse=sort_direction)
+        autocasts_list = Pagination(iterable=autocasts, page=page, per_page=per_page)
+
+        # messages of the visible autocasts and their cases are fetched with a single query
+        prefetch_references(Message, [
+            holder for autocast in autocasts_list.items for holder in [autocast] + (autocast.get('cases') or [])
+        ], 'message', only=('name',))
+
+        data = [
+            self.format_autocast(autocast, stats, totals[autocast['_id']], include_test_emails)
+            for autocast in autocasts_list.items
+        ]
 
         return JsonResponse({
-            'data': autocasts_list.items,
+            'data': data,
             'status': 'ok',
             'recordsTotal': autocasts_list.total,
             'recordsFiltered': autocasts_list.total,
             'draw': request.POST['draw'],
         })
 
+    def get_emails_stats(self, message_ids, start, end):
+        """
+            Real and test recipients stats of each message computed in one pass over 'emails'.
+            Test emails are the ones having 'None' lead_id.
+        """
+        match = {
+            '$match': {
+                'message': {'$in': [DBRef('messages', mid) for mid in message_ids]},
+                'time_added': {'$gte': start, '$lte': end}
+            }
+        }
+
+        group = {'$group': {'_id': '$message'}}
+        for prefix, condition in (('', {'$ne': ['$lead_id', 'None']}), ('test_', {'$eq': ['$lead_id', 'None']})):
+            group['$group'].update({
+                prefix + 'recipients_count': {'$sum': {'$cond': [condition, 1, 0]}},
+                prefix + 'delivered': {'$sum': {'$cond': [{'$and': [condition, {'$eq': ['$status', 'delivered']}]}, 1, 0]}},
+                prefix + 'opened': {'$sum': {'$cond': [{'$and': [condition, {'$eq': ['$opened', True]}]}, 1, 0]}},
+                prefix + 'clicked': {'$sum': {'$cond': [{'$and': [condition, {'$eq': ['$clicked', True]}]}, 1, 0]}},
+                prefix + 'unsubscribed': {'$sum': {'$cond': [{'$and': [condition, {'$eq': ['$unsubscribed', True]}]}, 1, 0]}},
+            })
+
+        return {item['_id'].id: item for item in db.emails.aggregate([match, group])}
+
+    def get_autocast_totals(self, autocast, stats):
+        """
+            Autocast stats are its own message stats plus the stats of its cases except the first one.
+        """
+        message_id = get_reference_id(autocast, 'message')
+        message_stats = stats.get(message_id, {})
+        totals = {field: message_stats.get(field, 0) for field in AUTOCAST_STATS_FIELDS}
+        for case in (autocast.get('cases') or [])[1:]:
+            case_stats = stats.get(get_reference_id(case, 'message'), {})
+            for field in ('recipients_count', 'delivered', 'opened', 'clicked'):
+                totals[field] += case_stats.get(field, 0)
+                if message_id in stats:
+                    totals['test_' + field] += case_stats.get('test_' + field, 0)
+        return totals
+
+    def format_stats(self, stats, totals, include_test_emails):
+        formatted_stats = {
+            'recipients_count': {
+                'real': totals['recipients_count'],
+            },
+            'delivered_emails': {
+                'real': totals['delivered'],
+                'percentage': get_percentage(stats.get('delivered', 0), stats.get('recipients_count', 0))
+            },
+            'opened_emails': {
+                'real': totals['opened'],
+                'percentage': get_percentage(stats.get('opened', 0), stats.get('delivered', 0))
+            },
+            'clicked_emails': {
+                'real': totals['clicked'],
+                'percentage': get_percentage(stats.get('clicked', 0), stats.get('opened', 0))
+            },
+            'unsubscribed': {
+                'real': totals['unsubscribed'],
+                'percentage': get_percentage(stats.get('unsubscribed', 0), stats.get('delivered', 0))
+            }
+        }
+
+        if include_test_emails:
+            formatted_stats['recipients_count']['test'] = totals['test_recipients_count']
+            formatted_stats['delivered_emails']['test'] = totals['test_delivered']
+            formatted_stats['opened_emails']['test'] = totals['test_opened']
+            formatted_stats['clicked_emails']['test'] = totals['test_clicked']
+
+        return formatted_stats
+
+    def format_autocast(self, autocast, stats, totals, include_test_emails):
+        message_id = get_reference_id(autocast, 'message')
+        formatted_data = {
+            'id': str(autocast['_id']),
+            'name': autocast.get('name'),
+            'message_name': getattr(autocast['message'], 'name', None),
+            'cases': [],
+            'archived': autocast.get('archived'),
+        }
+        formatted_data.update(self.format_stats(stats.get(message_id, {}), totals, include_test_emails))
+
+        for case in autocast.get('cases') or []:
+            case_message_id = get_reference_id(case, 'message')
+            case_stats = stats.get(case_message_id, {})
+            case_totals = {field: case_stats.get(field, 0) for field in AUTOCAST_STATS_FIELDS}
+            case_data = {
+                'name': case.get('name'),
+                'message_name': getattr(case['message'], 'name', None),
+            }
+            case_data.update(self.format_stats(case_stats, case_totals, include_test_emails))
+            case_data['unsubscribed'] = {'real': 0}
+            formatted_data['cases'].append(case_data)
+
+        return formatted_data
+
+
+class AutocastsStatsExportView(AutocastsStatsView):
+    """
+        Streams the unpaginated autocast stats table as CSV or NDJSON.
+    """
+    http_method_names = ['get']
+
+    def get(self, request):
+        export_format = request.GET.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return JsonResponse({'status': 'error', 'errors': {'format': [ugettext(u'Неизвестный формат')]}})
+
+        filters = self.get_filters(request.GET)
+        if filters['errors'].values():
+            return JsonResponse({'status': 'error', 'errors': filters['errors']})
+
+        message_ids = self.get_message_ids(self.get_autocasts(filters['include_archived']))
+        stats = self.get_emails_stats(message_ids, filters['start'], filters['end'])
+
+        fields = ['id', 'name', 'message_name', 'archived', 'recipients_count', 'delivered', 'opened', 'clicked', 'unsubscribed']
+        if filters['include_test_emails']:
+            fields.extend(['test_recipients_count', 'test_delivered', 'test_opened', 'test_clicked'])
+
+        rows = self.iter_export_rows(self.get_autocasts(filters['include_archived']), stats)
+        return streaming_export_response(rows, fields, export_format, 'autocasts')
+
+    def iter_export_rows(self, autocasts, stats):
+        autocasts = iter(autocasts)
+        while True:
+            chunk = list(islice(autocasts, EXPORT_CHUNK_SIZE))
+            if not chunk:
+                break
+            prefetch_references(Message, chunk, 'message', only=('name',))
+            for autocast in chunk:
+                row = {
+                    'id': str(autocast['_id']),
+                    'name': autocast.get('name'),
+                    'message_name': getattr(autocast['message'], 'name', None),
+                    'archived': autocast.get('archived'),
+                }
+                row.update(self.get_autocast_totals(autocast, stats))
+                yield row
+
 
 class SalesFunnelStatsView(SalesFunnelChart, TemplateView):
     template_name = 'analytics/sales_funnel.html'
@@ -664,28 +858,22 @@ class ShopKPIView(TemplateView):
     template_name = 'analytics/shops_kpi.html'
 
     def post(self, request):
-        validation_result = validate_time_period(request.POST.get('period_start'),
-                                                 request.POST.get('period_end'), date_format='%d.%m.%Y')
+        validation_result = validate_kpi_period(request.POST)
         if validation_result['status'] == 'error':
             return JsonResponse(validation_result)
 
-        period_start = validation_result['start']
-        period_end = validation_result['end']
-
-        current_week, current_day = datetime.now().isocalendar()[1:]
-
-        if (period_end - period_start).days < 6:
-            if not(period_start.isocalendar()[1:] == (current_week, 1) and
-                   period_end.isocalendar()[1] == current_week and period_end.isocalendar()[2] >= current_day):
-                return JsonResponse({
-                    'status': 'error',
-                    'errors': {ugettext(u'Период'): [ugettext(u'Минимальный период для выбора составляет 7 дней')]}
-                })
-
-        result_key = generate_redis_result_key()
-        tasks.get_shop_metrics.apply_async(
-            args=[self.request.site_id, period_start, period_end, result_key]
-        )
+        options = {
+            'site_id': self.request.site_id,
+            'period_start': validation_result['period_start'],
+            'period_end': validation_result['period_end']
+        }
+        result_key, created = claim_result_key('shop_metrics', options)
+        if created:
+            schedule_task(
+                get_shop_metrics,
+                [self.request.site_id, validation_result['period_start'], validation_result['period_end'], result_key],
+                {'language': get_language()}, self.request.site_id, estimate_cost('shop_metrics', options, self.request.site_id), [result_key]
+            )
 
         return JsonResponse({'result_key': result_key})
 
@@ -693,51 +881,62 @@ class ShopKPIView(TemplateView):
 class ShopKPIGraphDataView(AverageRevenuePerVisitorChart, View):
 
     def post(self, request):
-        validation_result = validate_time_period(request.POST.get('period_start'),
-                                                 request.POST.get('period_end'), date_format='%d.%m.%Y')
+        validation_result = validate_kpi_period(request.POST, align_to_weeks=True)
         if validation_result['status'] == 'error':
             return JsonResponse(validation_result)
 
-        period_start = validation_result['start']
-        period_end = validation_result['end']
+        graph_type = request.POST.get('graph_type')
 
-        current_week, current_day = datetime.now().isocalendar()[1:]
+        chart = KPI_CHARTS[graph_type]()
+        result_key = start_chart_task(chart, {
+            'period_start': validation_result['period_start'],
+            'period_end': validation_result['period_end'],
+            'site_id': self.request.site.id
+        })
 
-        if (period_end - period_start).days < 6:
-            if not(period_start.isocalendar()[1:] == (current_week, 1) and
-                   period_end.isocalendar()[1] == current_week and period_end.isocalendar()[2] >= current_day):
-                return JsonResponse({
-                    'status': 'error',
-                    'errors': {ugettext(u'Период'): [ugettext(u'Минимальный период для выбора составляет 7 дней')]}
-                })
+        return JsonResponse({'result_key': result_key})
 
-        period_start = period_start - timedelta(days=period_start.weekday())
-        period_end = period_end + timedelta(days=6 - period_end.weekday())
-        graph_type = request.POST.get('graph_type')
 
-        charts = {
-            'arpv': AverageRevenuePerVisitorChart,
-            'arpu': AverageRevenuePerUserChart,
-            'arppu': AverageRevenuePerPayingUserChart,
-            'car': CartAbandonmentRateChart,
-            'average_check': AverageCheckChart,
-            'purchase_frequency': PurchaseFrequencyChart,
-            'paid_orders_rate': PaidOrdersRateChart,
-            'rcr': RepeatCustomerRateChart
-        }
-        chart = charts[graph_type]()
-        result_key = generate_redis_result_key()
-        tasks.fetch_chart_data.apply_async(
-            args=[
-                chart,
-                {
-                    'period_start': period_start,
-                    'period_end': period_end,
-                    'site_id': self.request.site.id
-                },
-                result_key
-            ]
-        )
+@method_decorator(permission_required('analytics'), name="dispatch")
+class ChartExportView(View):
+    """
+        Streams the series of any chart as CSV or NDJSON: /<chart_name>/?format=csv&<chart options>
+    """
+    http_method_names = ['get']
 
-        return JsonResponse({'result_key': result_key})
+    def get(self, request, chart_name):
+        export_format = request.GET.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return JsonResponse({'status': 'error', 'errors': {'format': [ugettext(u'Неизвестный формат')]}})
+
+        site = request.site
+        if chart_name in KPI_CHARTS:
+            chart = KPI_CHARTS[chart_name]()
+            result = validate_kpi_period(request.GET, align_to_weeks=True)
+        elif chart_name in EXPORT_CHARTS:
+            chart_class = EXPORT_CHARTS[chart_name]
+            chart = chart_class(site_id=site.id) if chart_class in (SalesFunnelChart, SalesBarChart) else chart_class()
+            # some charts read the site from the request
+            chart.request = request
+            options = request.GET.copy()
+            options['site_id'] = site.id
+            result = chart.validate_input(options)
+        else:
+            raise Http404
 
+        if result.get('status') == 'error':
+            return JsonResponse(result)
+        result['site_id'] = site.id
+
+        rows = iter_export_rows(chart, result)
+        # the series get computed up to the first row before the response starts, an error can still be reported
+        try:
+            rows = chain([next(rows)], rows)
+        except StopIteration:
+            rows = []
+        except ExecutionTimeout:
+            return JsonResponse({
+                'status': 'error',
+                'errors': {ugettext(u'Период'): [ugettext(u'Расчет занимает слишком много времени, выберите период короче')]}
+            })
+        return streaming_export_response(rows, chart.get_export_fields(), export_format, chart_name)
@@ -0,0 +1,122 @@
+# coding: utf-8
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import translation
+
+from celery import shared_task
+
+from accounts.models import NewUser as User, Site
+from lib.helpers import generate_redis_result_key
+from analytics.chart import (
+    DashboardQueries, DASHBOARD_GRAPHS, get_chart_data, get_dashboard_chart, get_kpi_cube
+)
+from analytics.connections import redis
+from analytics.results import has_result, publish_result
+
+# Sites whose users logged in within that many days get their dashboards warmed
+WARMING_ACTIVITY_DAYS = getattr(settings, 'ANALYTICS_WARMING_ACTIVITY_DAYS', 7)
+WARMING_SITES_LIMIT = getattr(settings, 'ANALYTICS_WARMING_SITES_LIMIT', 500)
+# Has to cover the interval between two warming runs. Warm results are only used for the first paint
+# of a dashboard, a fresh computation is queued along with them.
+WARM_RESULT_TTL = getattr(settings, 'ANALYTICS_WARM_RESULT_TTL', 3 * 60 * 60)
+# Full ISO weeks of the KPI cube warmed in addition to the current one. The cube is cached per week,
+# so the warmed weeks serve any period including them.
+KPI_WARM_WEEKS = 4
+
+# Options the dashboard sends for the graphs by default, only these requests are answered from the warm results
+WARM_GRAPH_OPTIONS = {
+    'visits': {'aggr_condition': 'visits', 'source': 'all'},
+    'recommendations': {'widget_option': 'all'},
+}
+
+
+def get_warm_key(site_id, graph, period, language):
+    return 'analytics:warm:{}:{}:{}:{}'.format(site_id, graph, period, language)
+
+
+def get_default_period(site):
+    period = site.interface_configuration.dashboard.get('default_period')
+    return period if period and period != 'custom' else None
+
+
+def get_warm_result_key(site, graph, data, language):
+    """
+        Returns the result key of the warmed result matching the dashboard request, if there is one.
+        It is shown until the fresh result of the request is ready.
+    """
+    period = get_default_period(site)
+    if not period or data.get('period') != period:
+        return None
+    for field, value in WARM_GRAPH_OPTIONS.get(graph, {}).items():
+        if data.get(field, value) != value:
+            return None
+
+    result_key = redis.get(get_warm_key(site.id, graph, period, language))
+    if result_key is not None and has_result(result_key):
+        return result_key
+    return None
+
+
+def get_recently_active_sites(days=WARMING_ACTIVITY_DAYS, limit=WARMING_SITES_LIMIT):
+    """
+        Returns the active sites whose users logged in recently, the most recently visited first.
+    """
+    pipeline = [
+        {'$unwind': '$sites'},
+        {'$group': {'_id': '$sites', 'last_login': {'$max': '$last_login'}}},
+        {'$sort': {'last_login': -1}},
+        {'$limit': limit}
+    ]
+    users = User.objects(last_login__gte=datetime.now() - timedelta(days=days))
+    sites_ids = [getattr(item['_id'], 'id', item['_id']) for item in users.aggregate(*pipeline)]
+
+    sites = {site.id: site for site in Site.objects(id__in=sites_ids) if site.is_active}
+    return [sites[site_id] for site_id in sites_ids if site_id in sites]
+
+
+def get_kpi_warm_period():
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    period_start = today - timedelta(days=today.weekday(), weeks=KPI_WARM_WEEKS)
+    period_end = today + timedelta(days=6 - today.weekday(), hours=23, minutes=59, seconds=59)
+    return period_start, period_end
+
+
+def warm_site(site, language):
+    """
+        Computes the dashboard graphs of the site's default period into the result store and builds its KPI cube.
+    """
+    period = get_default_period(site)
+    if period:
+        queries = DashboardQueries()
+        for graph in DASHBOARD_GRAPHS:
+            chart = get_dashboard_chart(graph, site.id, queries)
+            options = dict(WARM_GRAPH_OPTIONS.get(graph, {}), graph=graph, period=period, site_id=str(site.id))
+            options = chart.validate_input(options)
+            if options.get('status') == 'error' or options.get('error'):
+                continue
+            options['site_id'] = site.id
+
+            result_key = generate_redis_result_key()
+            data = get_chart_data(chart, options, result_key)
+            # partial results are not worth serving instead of a fresh computation
+            if data.get('status') == 'error' or data.get('degraded'):
+                continue
+            publish_result(result_key, data, ttl=WARM_RESULT_TTL)
+            redis.setex(get_warm_key(site.id, graph, period, language), WARM_RESULT_TTL, result_key)
+
+    period_start, period_end = get_kpi_warm_period()
+    get_kpi_cube(site.id, period_start, period_end)
+
+
+@shared_task
+def warm_dashboards(language=settings.LANGUAGE_CODE):
+    """
+        Periodic job warming the dashboards of the recently active sites. Has to be scheduled in
+        CELERYBEAT_SCHEDULE more often than ANALYTICS_WARM_RESULT_TTL, e.g. every 2 hours.
+        The KPI weeks that are over stay cached for days (KPI_PAST_WEEKS_CACHE_TIMEOUT), only the current
+        one has to be rebuilt in the morning.
+    """
+    with translation.override(language):
+        for site in get_recently_active_sites():
+            warm_site(site, language)